@@ -10,86 +10,146 @@
 
 '''aggregate: group together output that is the same'''
 
-import subprocess
+import sys
+import time
+import hashlib
 
-from synctool.lib import stderr
 import synctool.range
 
+# how often to update the progress line (in seconds)
+PROGRESS_INTERVAL = 1.0
+
+
+class Aggregator(object):
+    '''group together output that is the same, as it comes in
+
+    The output of every node is hashed line by line; nodes that
+    have the same digest in the end have the same output.
+    Lines are stored as chains, so nodes that have the same output
+    (so far) share the storage for it
+    '''
+
+    def __init__(self):
+        '''initialize instance'''
+
+        # chain[digest] = (digest of the previous lines, line)
+        self.chain = {}
+        # digest[node] = digest of the output of node so far
+        self.digest = {}
+
+    def add(self, node, line):
+        '''add a line of output of node'''
+
+        prev = self.digest.get(node, '')
+        digest = hashlib.sha1(prev + line).digest()
+        if digest not in self.chain:
+            self.chain[digest] = (prev, line)
+
+        self.digest[node] = digest
+
+    def lines(self, digest):
+        '''Returns list of lines of output that have digest'''
+
+        lines = []
+        while digest:
+            digest, line = self.chain[digest]
+            lines.append(line)
+
+        lines.reverse()
+        return lines
+
+    def groups(self):
+        '''Returns list of tuples: (sorted list of nodes, digest)
+        ordered by the first node in the list
+        '''
+
+        nodes_per_digest = {}
+        for node in sorted(self.digest.keys()):
+            node_digest = self.digest[node]
+            if node_digest not in nodes_per_digest:
+                nodes_per_digest[node_digest] = [node,]
+            else:
+                nodes_per_digest[node_digest].append(node)
+
+        groups = [(nodes, digest)
+                  for digest, nodes in nodes_per_digest.items()]
+        groups.sort()
+        return groups
+
+    def show(self):
+        '''print the nodes that have the same output together'''
+
+        for nodes, digest in self.groups():
+            print synctool.range.compress(nodes) + ':'
+            for line in self.lines(digest):
+                print line
+
+    def summary(self):
+        '''Returns short progress message'''
+
+        return '%d nodes, %d different outputs' % \
+            (len(self.digest), len(set(self.digest.values())))
+
 
 def aggregate(f):
     '''group together input lines that are the same'''
 
-    lines = f.readlines()
-    if not lines:
-        return
+    aggr = Aggregator()
 
-    lines = [x.strip() for x in lines]
+    # show progress while the output comes in
+    progress = Progress()
 
-    output_per_node = {}
-
-    for line in lines:
+    # Note: do not use "for line in f" because it reads ahead
+    for line in iter(f.readline, ''):
+        line = line.strip()
         arr = line.split(':', 1)
 
         if len(arr) <= 1:
+            progress.clear()
             print line
             continue
 
-        node = arr[0]
-        output = arr[1]
-
-        if node not in output_per_node:
-            output_per_node[node] = [output,]
-        else:
-            output_per_node[node].append(output)
-
-    nodes = output_per_node.keys()
-    if not nodes:
-        return
+        aggr.add(arr[0], arr[1])
+        progress.update(aggr.summary)
 
-    nodes.sort()
+    progress.clear()
+    aggr.show()
 
-    while len(nodes) > 0:
-        node = nodes.pop(0)
 
-        out = output_per_node[node]
+class Progress(object):
+    '''live-updating progress line on the terminal'''
 
-        nodelist = [node,]
+    def __init__(self):
+        '''initialize instance'''
 
-        for node2 in nodes[:]:
-            if out == output_per_node[node2]:
-                nodelist.append(node2)
-                del output_per_node[node2]
-                nodes.remove(node2)
-
-        print synctool.range.compress(nodelist) + ':'
-        for line in out:
-            print line
+        self.enabled = sys.stderr.isatty()
+        self.last_update = time.time()
+        self.width = 0
 
+    def update(self, message_func):
+        '''show message, if it is time to do so'''
 
-def run(cmd_arr):
-    '''pipe the output through the aggregator
-    Returns False on error, else True
-    '''
+        if not self.enabled:
+            return
 
-    # simply re-run this command, but with a pipe
+        now = time.time()
+        if now - self.last_update < PROGRESS_INTERVAL:
+            return
 
-    if '-a' in cmd_arr:
-        cmd_arr.remove('-a')
+        self.last_update = now
 
-    if '--aggregate' in cmd_arr:
-        cmd_arr.remove('--aggregate')
+        msg = 'aggregating: %s' % message_func()
+        sys.stderr.write('\r%s' % msg.ljust(self.width))
+        sys.stderr.flush()
+        self.width = len(msg)
 
-    try:
-        f = subprocess.Popen(cmd_arr, shell=False, bufsize=4096,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT).stdout
-    except OSError as err:
-        stderr('failed to run command %s: %s' % (cmd_arr[0], err.strerror))
-        return False
+    def clear(self):
+        '''erase the progress line'''
 
-    with f:
-        aggregate(f)
+        if self.width:
+            sys.stderr.write('\r%s\r' % (' ' * self.width))
+            sys.stderr.flush()
+            self.width = 0
 
-    return True
 
 # EOB
@@ -0,0 +1,138 @@
+#
+#   synctool.bundle.py    WJ125
+#
+#   synctool Copyright 2015 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''compressed bundles of the repository, to sync nodes with
+synctool --bundle rather than with rsync
+
+For every set of group dirs, the master node packs the content that
+the nodes receive in a compressed tar file, once. The bundle is streamed
+over ssh to every node, which unpacks it next to the repository and
+swaps it in. When that fails, the node gets an rsync after all.
+This is much lighter on the master node than rsync when
+many nodes need the entire repository, like freshly installed nodes.
+The bundles are kept in the state dir until the repository changes
+'''
+
+import os
+import errno
+import pipes
+import tarfile
+import tempfile
+
+from synctool import param
+from synctool.lib import verbose, error
+import synctool.generation
+import synctool.state
+
+# the bundles are kept in this dir under param.STATE_DIR,
+# and the generation that they hold in this state file
+BUNDLE_DIR = 'bundle'
+FILENAME = 'bundles'
+
+COMPRESS_LEVEL = 6
+
+# FILES[signature] = filename of bundle, or None on error
+FILES = {}
+
+# GENERATIONS[name] = generation stamp of bundle
+GENERATIONS = None
+
+# shell code that unpacks the bundle from stdin next to the repository,
+# keeps the state dir of the node, and swaps it in
+# The swap fails when the repository is a mount point, or when its parent
+# dir is not writable; then the unpacked copy is removed again, and
+# the master falls back to rsync
+UNPACK_CMD = ('d=%s; n="$d.new"; o="$d.old"; '
+              '{ rm -rf "$n" "$o" && mkdir -p "$n" && tar xzf - -C "$n" && '
+              '{ test ! -d "$d/var/state" || '
+              'cp -pR "$d/var/state" "$n/var/"; } && '
+              '{ test ! -e "$d" || mv "$d" "$o"; } && '
+              '{ mv "$n" "$d" || { mv "$o" "$d"; false; }; } && '
+              'rm -rf "$o"; } || { rm -rf "$n"; false; }')
+
+
+def bundle(signature, filter_file):
+    '''Returns filename of bundle for nodes with the given signature,
+    or None on error
+    '''
+
+    if signature not in FILES:
+        FILES[signature] = _make(signature, filter_file)
+
+    return FILES[signature]
+
+
+def _make(signature, filter_file):
+    '''pack the repository for nodes with the given signature,
+    unless the bundle in the state dir is up to date
+    Returns filename of the bundle, or None on error
+    '''
+
+    global GENERATIONS
+
+    if GENERATIONS is None:
+        GENERATIONS = synctool.state.load(FILENAME)
+
+    name = synctool.generation.signature_name(signature)
+    bundle_dir = os.path.join(param.STATE_DIR, BUNDLE_DIR)
+    filename = os.path.join(bundle_dir, name + '.tar.gz')
+
+    stamp = synctool.generation.digest(signature, filter_file)
+    if GENERATIONS.get(name) == stamp and os.path.isfile(filename):
+        return filename
+
+    try:
+        os.makedirs(bundle_dir, 0700)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            error('failed to create directory %s: %s' % (bundle_dir,
+                                                         err.strerror))
+            return None
+
+    try:
+        (fd, tmp_filename) = tempfile.mkstemp(prefix='.%s-' % name,
+                                              dir=bundle_dir)
+    except OSError as err:
+        error('failed to create temp file: %s' % err.strerror)
+        return None
+
+    verbose('packing bundle %s' % name)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            tar = tarfile.open(fileobj=f, mode='w:gz',
+                               compresslevel=COMPRESS_LEVEL)
+            with tar:
+                for path in synctool.generation.tree(signature):
+                    arcname = os.path.relpath(path, param.ROOTDIR)
+                    tar.add(path, arcname, recursive=False)
+
+        os.rename(tmp_filename, filename)
+    except (IOError, OSError) as err:
+        error('failed to write bundle %s: %s' % (filename, err.strerror))
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            # silently ignore unlink error
+            pass
+        return None
+
+    GENERATIONS[name] = stamp
+    synctool.state.save(FILENAME, GENERATIONS)
+    return filename
+
+
+def unpack_cmd():
+    '''Returns remote command that unpacks a bundle from stdin
+    into the repository on the node
+    '''
+
+    return UNPACK_CMD % pipes.quote(param.ROOTDIR)
+
+# EOB
@@ -50,6 +50,11 @@ def read_config():
         synctool.param.TEMP_DIR = '/tmp/synctool'
         # do not make temp dir here; it is only used on the master node
 
+    # a batch is only applied to nodes that have the generation
+    # that it was made for
+    if synctool.param.RSYNC_BATCH:
+        synctool.param.GENERATION_STAMP = True
+
     # if commands not set, select sensible defaults
     # the existence of the commands is checked later ...
     if not synctool.param.SYNCTOOL_CMD:
@@ -89,6 +94,21 @@ def read_config():
     # initialize ALL_GROUPS
     synctool.param.ALL_GROUPS = make_all_groups()
 
+    for node, groups in synctool.param.RELAYS:
+        if node not in synctool.param.SLAVES:
+            error("relay '%s': not a slave node" % node)
+            errors += 1
+
+        for group in groups:
+            if group not in synctool.param.ALL_GROUPS:
+                error("relay '%s': no such group '%s'" % (node, group))
+                errors += 1
+
+    for group in synctool.param.MAX_PARALLEL:
+        if group not in synctool.param.ALL_GROUPS:
+            error("max_parallel: no such group '%s'" % group)
+            errors += 1
+
     if errors > 0:
         sys.exit(-1)
 
@@ -226,6 +246,15 @@ def get_node_ipaddress(node):
     return node
 
 
+def get_nodes_by_address():
+    '''Returns dict of nodenames by IP address (or by name,
+    for nodes that have no IP address configured)
+    '''
+
+    return dict([(get_node_ipaddress(node), node)
+                 for node in synctool.param.NODES])
+
+
 def make_all_groups():
     '''make a set of all possible groups
     This is a set of all group names plus all node names
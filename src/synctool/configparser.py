@@ -30,6 +30,11 @@ import synctool.range
 # Valid names are: node1 node1-10 node_10_0_0_2 node1+node2
 SPELLCHECK = re.compile(r'^[a-zA-Z](?:[_+-]?[a-zA-Z0-9])*$')
 
+# bandwidth like '400M', in kilobytes per second (as for rsync --bwlimit)
+BANDWIDTH = re.compile(r'^(\d+)([kmg]?)$')
+# multiplier for kilobytes
+BANDWIDTH_UNITS = {'': 1, 'k': 1, 'm': 1024, 'g': 1024 * 1024}
+
 # this will match "60", "1h30m", "1w4d10h3m50s", "yes", etc.
 PERSIST_TIME = re.compile(r'^\d+$|'
                           r'^(\d+[w])*(\d+[d])*(\d+[h])*(\d+[m])*(\d+[s])*$|'
@@ -330,6 +335,46 @@ def config_ssh_control_persist(arr, configfile, lineno):
     return 0
 
 
+def config_ssh_multiplex(arr, configfile, lineno):
+    '''parse keyword: ssh_multiplex'''
+
+    err, param.SSH_MULTIPLEX = _config_boolean('ssh_multiplex', arr[1],
+                                               configfile, lineno)
+    return err
+
+
+def config_longest_first(arr, configfile, lineno):
+    '''parse keyword: longest_first'''
+
+    err, param.LONGEST_FIRST = _config_boolean('longest_first', arr[1],
+                                               configfile, lineno)
+    return err
+
+
+def config_run_history(arr, configfile, lineno):
+    '''parse keyword: run_history'''
+
+    err, param.RUN_HISTORY = _config_boolean('run_history', arr[1],
+                                             configfile, lineno)
+    return err
+
+
+def config_generation_stamp(arr, configfile, lineno):
+    '''parse keyword: generation_stamp'''
+
+    err, param.GENERATION_STAMP = _config_boolean('generation_stamp',
+                                                  arr[1], configfile, lineno)
+    return err
+
+
+def config_rsync_batch(arr, configfile, lineno):
+    '''parse keyword: rsync_batch'''
+
+    err, param.RSYNC_BATCH = _config_boolean('rsync_batch', arr[1],
+                                             configfile, lineno)
+    return err
+
+
 def config_require_extension(arr, configfile, lineno):
     '''parse keyword: require_extension'''
 
@@ -346,6 +391,14 @@ def config_full_path(arr, configfile, lineno):
     return err
 
 
+def config_ship_scripts(arr, configfile, lineno):
+    '''parse keyword: ship_scripts'''
+
+    err, param.SHIP_SCRIPTS = _config_boolean('ship_scripts', arr[1],
+                                              configfile, lineno)
+    return err
+
+
 def config_backup_copies(arr, configfile, lineno):
     '''parse keyword: backup_copies'''
 
@@ -651,6 +704,49 @@ def config_slave(arr, configfile, lineno):
     return 0
 
 
+def config_relay(arr, configfile, lineno):
+    '''parse keyword: relay'''
+
+    if len(arr) < 3:
+        stderr("%s:%d: 'relay' requires at least 2 arguments: "
+               "the slave nodename and at least 1 group" %
+               (configfile, lineno))
+        return 1
+
+    slave = arr[1]
+    if not spellcheck(slave):
+        stderr("%s:%d: invalid node name '%s'" % (configfile, lineno, slave))
+        return 1
+
+    groups = []
+    for group in arr[2:]:
+        # range expression syntax: 'group generator'
+        if '[' in group:
+            try:
+                groups.extend(synctool.range.expand(group))
+            except synctool.range.RangeSyntaxError as err:
+                stderr("%s:%d: %s" % (configfile, lineno, err))
+                return 1
+        else:
+            groups.append(group)
+
+    for group in groups:
+        if not spellcheck(group):
+            stderr("%s:%d: invalid group name '%s'" % (configfile, lineno,
+                                                       group))
+            return 1
+
+    for node, relay_groups in param.RELAYS:
+        if node == slave:
+            relay_groups.extend(groups)
+            break
+    else:
+        param.RELAYS.append((slave, groups))
+
+    # check for valid slaves and groups is made later
+    return 0
+
+
 def config_group(arr, configfile, lineno):
     '''parse keyword: group'''
 
@@ -1019,6 +1115,9 @@ def config_pkg_cmd(arr, configfile, lineno):
 def config_num_proc(arr, configfile, lineno):
     '''parse keyword: num_proc'''
 
+    if arr[1].lower() == 'auto':
+        return _config_num_proc_auto(arr, configfile, lineno)
+
     err, param.NUM_PROC = _config_integer('num_proc', arr[1], configfile,
                                           lineno)
 
@@ -1029,6 +1128,267 @@ def config_num_proc(arr, configfile, lineno):
     return err
 
 
+def _config_num_proc_auto(arr, configfile, lineno):
+    '''parse keyword: num_proc auto [<min> <max>]'''
+
+    if not check_definition('num_proc', configfile, lineno):
+        return 1
+
+    if len(arr) == 4:
+        try:
+            param.NUM_PROC_MIN = int(arr[2])
+            param.NUM_PROC_MAX = int(arr[3])
+        except ValueError:
+            stderr("%s:%d: invalid argument for num_proc" %
+                   (configfile, lineno))
+            return 1
+
+    elif len(arr) != 2:
+        stderr("%s:%d: usage: num_proc auto [<min> <max>]" %
+               (configfile, lineno))
+        return 1
+
+    if (param.NUM_PROC_MIN < 1 or
+            param.NUM_PROC_MAX < param.NUM_PROC_MIN):
+        stderr("%s:%d: invalid bounds for num_proc auto" %
+               (configfile, lineno))
+        return 1
+
+    param.NUM_PROC_AUTO = True
+    param.NUM_PROC = param.NUM_PROC_MAX
+    return 0
+
+
+def config_fanout_engine(arr, configfile, lineno):
+    '''parse keyword: fanout_engine'''
+
+    if len(arr) != 2:
+        stderr("%s:%d: 'fanout_engine' requires a single argument" %
+               (configfile, lineno))
+        return 1
+
+    if not check_definition(arr[0], configfile, lineno):
+        return 1
+
+    engine = arr[1].lower()
+    if engine not in param.KNOWN_FANOUT_ENGINES:
+        stderr("%s:%d: unknown fanout_engine '%s'" % (configfile, lineno,
+                                                      arr[1]))
+        return 1
+
+    param.FANOUT_ENGINE = engine
+    return 0
+
+
+def config_rsync_timeout(arr, configfile, lineno):
+    '''parse keyword: rsync_timeout'''
+
+    err, param.RSYNC_TIMEOUT = _config_integer('rsync_timeout', arr[1],
+                                               configfile, lineno)
+
+    if not err and param.RSYNC_TIMEOUT < 0:
+        stderr("%s:%d: invalid argument for rsync_timeout" %
+               (configfile, lineno))
+        return 1
+
+    return err
+
+
+def config_exec_timeout(arr, configfile, lineno):
+    '''parse keyword: exec_timeout'''
+
+    err, param.EXEC_TIMEOUT = _config_integer('exec_timeout', arr[1],
+                                              configfile, lineno)
+
+    if not err and param.EXEC_TIMEOUT < 0:
+        stderr("%s:%d: invalid argument for exec_timeout" %
+               (configfile, lineno))
+        return 1
+
+    return err
+
+
+def config_straggler_skip(arr, configfile, lineno):
+    '''parse keyword: straggler_skip <percent> [<factor>]'''
+
+    if not check_definition('straggler_skip', configfile, lineno):
+        return 1
+
+    if len(arr) > 3:
+        stderr("%s:%d: usage: straggler_skip <percent> [<factor>]" %
+               (configfile, lineno))
+        return 1
+
+    try:
+        param.STRAGGLER_SKIP = int(arr[1].rstrip('%'))
+        if len(arr) == 3:
+            param.STRAGGLER_FACTOR = float(arr[2])
+    except ValueError:
+        stderr("%s:%d: invalid argument for straggler_skip" %
+               (configfile, lineno))
+        return 1
+
+    if not 0 <= param.STRAGGLER_SKIP < 100 or param.STRAGGLER_FACTOR < 1:
+        stderr("%s:%d: invalid argument for straggler_skip" %
+               (configfile, lineno))
+        return 1
+
+    return 0
+
+
+def config_pipeline(arr, configfile, lineno):
+    '''parse keyword: pipeline <transfers> <commands>'''
+
+    if not check_definition('pipeline', configfile, lineno):
+        return 1
+
+    if len(arr) != 3:
+        stderr("%s:%d: usage: pipeline <transfers> <commands>" %
+               (configfile, lineno))
+        return 1
+
+    try:
+        transfers = int(arr[1])
+        commands = int(arr[2])
+    except ValueError:
+        transfers = commands = 0
+
+    if transfers < 1 or commands < 1:
+        stderr("%s:%d: invalid argument for pipeline" % (configfile, lineno))
+        return 1
+
+    param.PIPELINE = (transfers, commands)
+    return 0
+
+
+def config_health_cache(arr, configfile, lineno):
+    '''parse keyword: health_cache <seconds> [skip|last]'''
+
+    if not check_definition('health_cache', configfile, lineno):
+        return 1
+
+    if len(arr) not in (2, 3):
+        stderr("%s:%d: usage: health_cache <seconds> [skip|last]" %
+               (configfile, lineno))
+        return 1
+
+    try:
+        param.HEALTH_TTL = int(arr[1])
+    except ValueError:
+        param.HEALTH_TTL = -1
+
+    if param.HEALTH_TTL < 0:
+        stderr("%s:%d: invalid argument for health_cache" %
+               (configfile, lineno))
+        return 1
+
+    if len(arr) == 3:
+        if arr[2] not in ('skip', 'last'):
+            stderr("%s:%d: health_cache action must be 'skip' or 'last'" %
+                   (configfile, lineno))
+            return 1
+
+        param.HEALTH_ACTION = arr[2]
+
+    return 0
+
+
+def config_max_bandwidth(arr, configfile, lineno):
+    '''parse keyword: max_bandwidth <number>[K|M|G]'''
+
+    if not check_definition('max_bandwidth', configfile, lineno):
+        return 1
+
+    if len(arr) != 2:
+        stderr("%s:%d: usage: max_bandwidth <number>[K|M|G]" %
+               (configfile, lineno))
+        return 1
+
+    m = BANDWIDTH.match(arr[1].lower())
+    if not m or not int(m.group(1)):
+        stderr("%s:%d: invalid argument for max_bandwidth" %
+               (configfile, lineno))
+        return 1
+
+    # in kilobytes per second, like rsync --bwlimit
+    param.MAX_BANDWIDTH = int(m.group(1)) * BANDWIDTH_UNITS[m.group(2)]
+    return 0
+
+
+def config_max_parallel(arr, configfile, lineno):
+    '''parse keyword: max_parallel <group> <number>'''
+
+    if len(arr) != 3:
+        stderr("%s:%d: usage: max_parallel <group> <number>" %
+               (configfile, lineno))
+        return 1
+
+    # range expression syntax: 'group generator'
+    if '[' in arr[1]:
+        try:
+            groups = synctool.range.expand(arr[1])
+        except synctool.range.RangeSyntaxError as err:
+            stderr("%s:%d: %s" % (configfile, lineno, err))
+            return 1
+    else:
+        groups = [arr[1],]
+
+    for group in groups:
+        if not spellcheck(group):
+            stderr("%s:%d: invalid group name '%s'" % (configfile, lineno,
+                                                       group))
+            return 1
+
+        if group in param.MAX_PARALLEL:
+            stderr("%s:%d: redefinition of max_parallel for group '%s'" %
+                   (configfile, lineno, group))
+            return 1
+
+    try:
+        num = int(arr[2])
+    except ValueError:
+        num = 0
+
+    if num < 1:
+        stderr("%s:%d: invalid argument for max_parallel" %
+               (configfile, lineno))
+        return 1
+
+    # check for valid groups is made later
+    for group in groups:
+        param.MAX_PARALLEL[group] = num
+
+    return 0
+
+
+def config_retry(arr, configfile, lineno):
+    '''parse keyword: retry <attempts> [<delay> [<exit code>,...]]'''
+
+    if not check_definition('retry', configfile, lineno):
+        return 1
+
+    if len(arr) > 4:
+        stderr("%s:%d: usage: retry <attempts> [<delay> [<exit code>,...]]" %
+               (configfile, lineno))
+        return 1
+
+    try:
+        param.RETRY_ATTEMPTS = int(arr[1])
+        if len(arr) >= 3:
+            param.RETRY_DELAY = int(arr[2])
+        if len(arr) == 4:
+            param.RETRY_EXITCODES = [int(x) for x in arr[3].split(',')]
+    except ValueError:
+        stderr("%s:%d: invalid argument for retry" % (configfile, lineno))
+        return 1
+
+    if param.RETRY_ATTEMPTS < 1 or param.RETRY_DELAY < 0:
+        stderr("%s:%d: invalid argument for retry" % (configfile, lineno))
+        return 1
+
+    return 0
+
+
 def expand_grouplist(grouplist):
     '''expand a list of (compound) groups recursively
     Returns the expanded group list
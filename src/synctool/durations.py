@@ -0,0 +1,116 @@
+#
+#   synctool.durations.py    WJ119
+#
+#   synctool Copyright 2015 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''remember how long every node takes, and start the slowest nodes first
+
+The master node keeps the expected duration of every node in a state file
+under the var dir. Starting the nodes that take longest first (known as
+LPT scheduling) keeps a slow node from being started near the end,
+and holding up the whole run
+'''
+
+from synctool import param
+import synctool.output
+import synctool.state
+
+# name of the state file in param.STATE_DIR
+FILENAME = 'durations'
+
+# weight of the latest run in the expected duration
+WEIGHT = 0.5
+
+# DURATIONS[nodename] = expected duration in seconds
+DURATIONS = None
+
+# THIS_RUN[nodename] = seconds taken in this run
+THIS_RUN = {}
+
+
+def load():
+    '''load the expected durations of nodes'''
+
+    global DURATIONS
+
+    DURATIONS = {}
+    for nodename, secs in synctool.state.load(FILENAME).items():
+        if isinstance(secs, (int, float)):
+            DURATIONS[nodename] = float(secs)
+
+
+def expected(nodename):
+    '''Returns expected duration of nodename in seconds,
+    or None if it is not known
+    '''
+
+    if DURATIONS is None:
+        load()
+
+    return DURATIONS.get(nodename)
+
+
+def longest_first(address_list, nodeset):
+    '''Returns address_list ordered by expected duration, longest first
+    Nodes that have not been seen before go first, as they get
+    a full copy of the repository
+    '''
+
+    if not param.LONGEST_FIRST:
+        return address_list
+
+    def _key(addr):
+        '''Returns sort key for addr'''
+
+        secs = expected(nodeset.get_nodename_from_address(addr))
+        if secs is None:
+            return float('inf')
+
+        return secs
+
+    # Note: the sort is stable, so nodes that take as long
+    # stay in the same order
+    return sorted(address_list, key=_key, reverse=True)
+
+
+def record(rec):
+    '''handle output record (see module output)'''
+
+    if not param.LONGEST_FIRST or rec[0] != synctool.output.DONE:
+        return
+
+    nodename, _, status, timings = rec[1:]
+    if status is not None:
+        # the node was killed before it was done
+        return
+
+    secs = sum([x[1] for x in timings])
+    THIS_RUN[nodename] = THIS_RUN.get(nodename, 0.0) + secs
+
+
+def save():
+    '''update the expected durations with this run,
+    and write them to the state file
+    '''
+
+    if not THIS_RUN:
+        return
+
+    if DURATIONS is None:
+        load()
+
+    for nodename, secs in THIS_RUN.items():
+        if nodename in DURATIONS:
+            secs = WEIGHT * secs + (1.0 - WEIGHT) * DURATIONS[nodename]
+        DURATIONS[nodename] = round(secs, 3)
+
+    THIS_RUN.clear()
+
+    synctool.state.save(FILENAME, DURATIONS)
+
+# EOB
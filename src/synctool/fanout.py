@@ -0,0 +1,929 @@
+#
+#   synctool.fanout.py    WJ115
+#
+#   synctool Copyright 2015 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''run commands on many nodes at once
+
+A Job is the list of commands (ssh, rsync, ...) to run for a single node.
+Jobs are run either by forked worker processes (module parallel),
+or all from within this one process by an event loop that polls
+the output pipes of all running commands
+Either way, the output is passed as records to the master process,
+which renders it (see module output)
+'''
+
+import os
+import errno
+import math
+import time
+import heapq
+import subprocess
+import collections
+
+from synctool import config, param
+import synctool.health
+import synctool.lib
+from synctool.lib import verbose, stderr, warning, unix_out
+import synctool.output
+import synctool.parallel
+import synctool.poller
+import synctool.range
+import synctool.report
+
+
+# phases that transfer files to the node
+TRANSFER_PHASES = ('rsync', 'batch', 'bundle', 'chain')
+
+
+class Step(object):
+    '''a command to run for a job'''
+
+    def __init__(self, cmd_arr, msg=None, interactive=False, timeout=0,
+                 phase=None, check=False, when=None, stdin=None):
+        '''initialize instance'''
+
+        self.cmd_arr = cmd_arr
+        # verbose message
+        self.msg = msg
+        self.interactive = interactive
+        self.timeout = timeout
+        # name of the step, for reporting timings
+        if phase is None:
+            phase = os.path.basename(cmd_arr[0])
+        self.phase = phase
+        # with 'pipeline', transfers and other commands
+        # have separate limits
+        self.transfer = phase in TRANSFER_PHASES
+        # the exit code of a check does not count for the job,
+        # and when it is 0, the next conditional commands are not needed
+        self.check = check
+        # run only when the previous command exited with 0 ('ok'),
+        # or as a fallback when it did not ('failed'); None means always
+        self.when = when
+        # name of file to feed to the command, or function that
+        # writes the data to feed to a file object
+        self.stdin = stdin
+        # 'max_bandwidth' applies to rsync commands only (see bwlimit());
+        # data fed to stdin can not be limited this way
+        self.bwlimit = self.transfer and stdin is None
+
+
+class Job(object):
+    '''class representing the commands to run for a single node'''
+
+    def __init__(self, nodename):
+        '''initialize instance'''
+
+        self.nodename = nodename
+        # list of Step instances
+        self.steps = []
+        # temp files to delete when the job is done
+        self.tempfiles = []
+        self.exitcode = 0
+        # exit code of the job before the previous command ran
+        self.prev_exitcode = 0
+        # exit code of the previous command that ran;
+        # None if a check passed
+        self.last = None
+        # set to TIMED_OUT or SKIPPED when the job was killed
+        self.status = None
+        # list of tuples: (phase, duration in seconds)
+        self.timings = []
+        # function that passes output records on to the Multiplexer
+        # (see module output); set by attach()
+        self._held = []
+        self.emit = self._held.append
+
+    def add_step(self, cmd_arr, msg=None, interactive=False, timeout=0,
+                 phase=None, check=False, when=None, stdin=None):
+        '''add a command to run
+        An interactive command may prompt the user; it can only be run
+        when running one node at a time
+        The command is killed when it runs longer than timeout seconds
+        (0 means no timeout)
+        phase names the step in reports; by default it is the command name
+        A check only decides whether the next commands are run (see when);
+        its exit code does not count for the job
+        when is 'ok' to run the command only when the previous command
+        exited with 0, or 'failed' to run it only when it did not;
+        these commands are not run at all when a check passed
+        A command that runs because the previous one failed, is a fallback:
+        when it runs, the failure of the previous command does not count
+        stdin is the name of a file to feed to the command, or a function
+        func(f) that writes the data to file object f; it runs in a forked
+        process, so the data is streamed to the command
+        '''
+
+        self.steps.append(Step(cmd_arr, msg, interactive, timeout, phase,
+                               check, when, stdin))
+
+    def wanted(self, step):
+        '''Returns True if command number step is to be run
+        Commands that are not run are passed over; the next command
+        looks at the exit code of the command before
+        '''
+
+        when = self.steps[step].when
+        if when is None:
+            return True
+
+        if self.last is None:
+            # a check passed; not needed
+            return False
+
+        if when == 'ok':
+            return self.last == 0
+
+        if self.last == 0:
+            return False
+
+        # fallback; forget about the failure
+        self.exitcode = self.prev_exitcode
+        return True
+
+    def attach(self, emit):
+        '''set function that passes output records on, and
+        pass on the output made before the job was started
+        '''
+
+        self.emit = emit
+        for rec in self._held:
+            emit(rec)
+
+        self._held = []
+
+    def output(self, line):
+        '''handle a line of output of the running command'''
+
+        if line[:15] == '%synctool-log% ':
+            self.emit((synctool.output.LOG, self.nodename, line[15:]))
+
+        elif line[:synctool.report.PREFIX_LEN] == synctool.report.PREFIX:
+            for rec in synctool.report.parse(
+                    self.nodename, line[synctool.report.PREFIX_LEN:]):
+                self.emit(rec)
+        else:
+            self.emit((synctool.output.OUT, self.nodename, line))
+
+    def step_done(self, exitcode, check=False):
+        '''a command has finished'''
+
+        self.prev_exitcode = self.exitcode
+        if check:
+            if exitcode == 0:
+                self.last = None
+            else:
+                self.last = exitcode
+            return
+
+        self.last = exitcode
+        if exitcode != 0 and self.exitcode == 0:
+            self.exitcode = exitcode
+
+    def finish(self):
+        '''all commands have run; clean up
+        Returns exit code of the job
+        '''
+
+        for filename in self.tempfiles:
+            try:
+                os.unlink(filename)
+            except OSError:
+                # silently ignore unlink error
+                pass
+
+        return self.exitcode
+
+
+# status of jobs that were killed, or not started
+TIMED_OUT = 'timed out'
+SKIPPED = 'skipped'
+DOWN = 'down'
+
+
+def do(make_job, work):
+    '''make a Job for every work item by calling make_job(item),
+    and run the jobs in parallel
+    make_job() may return None if there is nothing to do for the item
+    Returns list of results (exit codes) in the same order as work
+    '''
+
+    mux = synctool.output.Multiplexer()
+    retry = _Retry(mux.record)
+
+    # nodes that are known to be down are skipped, or go last
+    order, down = synctool.health.split(work)
+    todo = [work[idx] for idx in order]
+    group_limits = synctool.parallel.GroupLimits(todo)
+
+    # --zzz and interactive commands need to run
+    # one at a time, by a forked worker
+    if (param.FANOUT_ENGINE != 'poll' or param.SLEEP_TIME != 0 or
+            param.NUM_PROC <= 1):
+        def _worker(item):
+            '''make the job and run it'''
+
+            job = make_job(item)
+            if job is None:
+                return None
+
+            # pass output on to the parent process
+            job.attach(synctool.parallel.message)
+
+            exitcode = run_job(job)
+            return job.nodename, exitcode, job.status, job.timings
+
+        def _result(idx, outcome):
+            '''the worker is done with the job'''
+
+            if outcome is None:
+                return None
+
+            return retry.done(idx, *outcome)
+
+        def _lost(idx):
+            '''the worker died while running the job,
+            or no worker could be spawned to run it
+            '''
+
+            nodename = config.get_nodes_by_address().get(todo[idx], todo[idx])
+            mux.record((synctool.output.OUT, nodename,
+                        'error: lost the worker process'))
+            return nodename, -1, None, []
+
+        outcomes = synctool.parallel.do(_worker, todo, mux.record, mux.flush,
+                                        _result, group_limits, _lost)
+    else:
+        outcomes = run(make_job, todo, mux.record, mux.flush, retry,
+                       group_limits, _Bandwidth(param.MAX_BANDWIDTH))
+
+    # put the outcomes in the same order as work
+    results = [None] * len(work)
+    for idx, outcome in zip(order, outcomes):
+        results[idx] = outcome
+
+    if down:
+        names = config.get_nodes_by_address()
+        for idx in down:
+            nodename = names.get(work[idx], work[idx])
+            exitcode = synctool.health.EXIT_UNREACHABLE
+            mux.record((synctool.output.DONE, nodename, exitcode, DOWN, []))
+            results[idx] = (nodename, exitcode, DOWN)
+
+    mux.finish()
+    report(results)
+    synctool.health.save()
+
+    return [outcome[1] if outcome is not None else None
+            for outcome in results]
+
+
+def report(outcomes):
+    '''print which nodes timed out or were skipped'''
+
+    for status, label in ((TIMED_OUT, TIMED_OUT), (SKIPPED, SKIPPED),
+                          (DOWN, 'skipped, down')):
+        nodes = [outcome[0] for outcome in outcomes
+                 if outcome is not None and outcome[2] == status]
+        if nodes:
+            warning('%s: %s' % (label, synctool.range.compress(nodes)))
+
+
+class _Retry(object):
+    '''the 'retry' policy
+    Jobs that fail with an exit code in param.RETRY_EXITCODES are run
+    again, up to param.RETRY_ATTEMPTS times in total. The delay before
+    the next attempt doubles with every attempt
+    '''
+
+    def __init__(self, emit):
+        '''initialize instance'''
+
+        # function that passes output records on
+        self.emit = emit
+        # attempts[idx] = number of attempts made for work item idx
+        self.attempts = {}
+        # timings of the previous attempts
+        self.timings = {}
+
+    def done(self, idx, nodename, exitcode, status, timings):
+        '''the job for work item idx is done
+        Returns delay in seconds before running the job again,
+        or None if it is done for good
+        '''
+
+        timings = self.timings.pop(idx, []) + timings
+        attempt = self.attempts.get(idx, 1)
+
+        if (attempt < param.RETRY_ATTEMPTS and status is None and
+                exitcode in param.RETRY_EXITCODES):
+            delay = param.RETRY_DELAY * 2 ** (attempt - 1)
+            self.attempts[idx] = attempt + 1
+            self.timings[idx] = timings
+            self.emit((synctool.output.OUT, nodename,
+                       'exit code %d; retrying in %d seconds '
+                       '(attempt %d of %d)' % (exitcode, delay, attempt + 1,
+                                               param.RETRY_ATTEMPTS)))
+            return delay
+
+        self.emit((synctool.output.DONE, nodename, exitcode, status,
+                   timings))
+        return None
+
+
+def run_job(job):
+    '''run all commands of a job in sequence
+    Returns exit code of the job
+    '''
+
+    # every worker process gets an equal part of the bandwidth budget;
+    # the parent says how many jobs it runs at once (which is fewer
+    # than num_proc with 'num_proc auto', or with fewer nodes)
+    share = None
+    if param.MAX_BANDWIDTH is not None:
+        share = max(1, param.MAX_BANDWIDTH / max(1, synctool.parallel.SLOTS))
+
+    # interactive commands write to the terminal directly,
+    # so they can only be used when output is not rendered otherwise
+    interactive = synctool.output.MODE == 'prefix' and \
+        synctool.output.OUTPUT_DIR is None
+    if not interactive or not [step for step in job.steps
+                               if step.interactive]:
+        # this kills commands that run into their timeout
+        return _run_steps(job, share)
+
+    for idx, step in enumerate(job.steps):
+        if not job.wanted(idx):
+            continue
+
+        if step.msg:
+            verbose(step.msg)
+
+        cmd_arr = step.cmd_arr
+        if step.bwlimit and share is not None:
+            cmd_arr = bwlimit(cmd_arr, share)
+
+        start = time.time()
+        if step.interactive:
+            # run with -N 1 : wait on prompts, flush output
+            print job.nodename + ': ',
+            exitcode = synctool.lib.exec_command(cmd_arr)
+        else:
+            exitcode = synctool.lib.run_with_output(cmd_arr, job.output)
+
+        job.timings.append((step.phase, time.time() - start))
+        job.step_done(exitcode, step.check)
+
+    return job.finish()
+
+
+class _Running(object):
+    '''a command of a job that is running right now'''
+
+    def __init__(self, idx, job, step, proc, feeder=None):
+        '''initialize instance'''
+
+        self.idx = idx
+        self.job = job
+        self.step = step
+        self.proc = proc
+        # pid of the process that feeds the command its input
+        self.feeder = feeder
+        self.buf = ''
+        self.start = time.time()
+
+        timeout = job.steps[step].timeout
+        if timeout > 0:
+            self.deadline = self.start + timeout
+        else:
+            self.deadline = None
+
+    def read(self):
+        '''read output of the command, and pass on complete lines
+        Returns False at end of output
+        '''
+
+        try:
+            data = os.read(self.proc.stdout.fileno(), 4096)
+        except OSError as err:
+            if err.errno == errno.EINTR:
+                return True
+
+            data = ''
+
+        if not data:
+            return False
+
+        self.buf += data
+        lines = self.buf.split('\n')
+        self.buf = lines.pop()
+        for line in lines:
+            self.job.output(line.rstrip())
+
+        return True
+
+    def end(self):
+        '''the command has finished, or was killed'''
+
+        if self.buf:
+            self.job.output(self.buf.rstrip())
+
+        self.proc.stdout.close()
+        self.proc.wait()
+        exitcode = self.proc.returncode
+        if exitcode != 0:
+            verbose('exit code %d' % exitcode)
+
+        if self.feeder is not None and not _reap(self.feeder) and \
+                exitcode == 0:
+            # the command did not get all of its input
+            exitcode = -1
+
+        step = self.job.steps[self.step]
+        self.job.timings.append((step.phase, time.time() - self.start))
+        self.job.step_done(exitcode, step.check)
+
+    def kill(self, status, msg):
+        '''kill the command, and mark the job with status'''
+
+        self.job.status = status
+        self.job.output(msg)
+        try:
+            self.proc.kill()
+        except OSError:
+            # it already exited
+            pass
+
+    def timed_out(self):
+        '''kill the command because it ran into its timeout'''
+
+        step = self.job.steps[self.step]
+        self.kill(TIMED_OUT, '%s timed out after %d seconds' %
+                  (os.path.basename(step.cmd_arr[0]), step.timeout))
+
+
+def run(make_job, work, emit, flush=None, retry=None, group_limits=None,
+        bandwidth=None):
+    '''run jobs for all work items from this process, using
+    an event loop over the output pipes of the commands
+    The jobs pass their output records to emit()
+    flush() is called before waiting for output
+    When a _Retry instance is given, it decides whether jobs are
+    run again, and passes on the DONE records of the jobs
+    group_limits is a GroupLimits instance (see module parallel)
+    bandwidth is a _Bandwidth instance that divides the budget
+    for transfers
+    Returns list of tuples: (nodename, exit code, status)
+    in the same order as work
+    '''
+
+    len_work = len(work)
+    results = [None] * len_work
+
+    pending = collections.deque(xrange(len_work))
+    # heap of (time, index) of jobs to run again
+    delayed = []
+    # running[fd] = _Running instance
+    running = {}
+    # started[idx] = time at which the job was started
+    started = {}
+    poller = synctool.poller.Poller()
+    control = synctool.parallel.Concurrency()
+    stragglers = _Stragglers(len_work)
+    if group_limits is None:
+        group_limits = synctool.parallel.GroupLimits([])
+
+    # with 'pipeline', transfers and other commands have separate limits;
+    # commands wait in line until there is a free slot
+    # (the dicts are keyed by Step.transfer)
+    limits = busy = waiting = None
+    if param.PIPELINE is not None:
+        limits = {True: param.PIPELINE[0], False: param.PIPELINE[1]}
+        busy = {True: 0, False: 0}
+        waiting = {True: collections.deque(), False: collections.deque()}
+
+    def _finish(idx, job):
+        '''the job is done'''
+
+        exitcode = job.finish()
+        results[idx] = (job.nodename, exitcode, job.status)
+
+        duration = time.time() - started.pop(idx)
+        control.finished(duration)
+        group_limits.finished(idx)
+
+        if retry is not None:
+            delay = retry.done(idx, job.nodename, exitcode, job.status,
+                               job.timings)
+            if delay is not None:
+                heapq.heappush(delayed, (time.time() + delay, idx))
+                return
+
+        stragglers.finished(duration)
+
+    def _start(idx, job, step):
+        '''start command number step of the job,
+        or finish the job if it has no more commands
+        '''
+
+        while job.status is None and step < len(job.steps):
+            if not job.wanted(step):
+                step += 1
+                continue
+
+            transfer = job.steps[step].transfer
+            limited = job.steps[step].bwlimit
+            if limits is not None:
+                if busy[transfer] >= limits[transfer]:
+                    waiting[transfer].append((idx, job, step))
+                    return
+
+            bw = None
+            if limited and bandwidth is not None:
+                if limits is not None:
+                    slots = limits[True] - busy[True]
+                else:
+                    slots = control.limit - bandwidth.count()
+                # transfers that may yet start, including this one
+                todo = len(pending) + len(delayed) + 1
+                if limits is not None:
+                    todo += len(waiting[True])
+                bw = bandwidth.take(idx, min(slots, todo))
+
+            task = _start_step(idx, job, step, bw)
+            if task is not None:
+                if limits is not None:
+                    busy[transfer] += 1
+
+                fd = task.proc.stdout.fileno()
+                running[fd] = task
+                poller.register(fd)
+                return
+
+            # failed to start; move on to the next command
+            if limited and bandwidth is not None:
+                bandwidth.release(idx)
+            step += 1
+
+        _finish(idx, job)
+
+    def _end(fd):
+        '''the command has finished, or was killed'''
+
+        task = running.pop(fd)
+        poller.unregister(fd)
+        task.end()
+
+        job = task.job
+        step = job.steps[task.step]
+
+        if limits is not None:
+            busy[step.transfer] -= 1
+
+        if step.bwlimit and bandwidth is not None:
+            bandwidth.release(task.idx)
+
+        # move on to the next command of this job
+        _start(task.idx, job, task.step + 1)
+
+        if limits is not None:
+            # a slot came free for a waiting command
+            queue = waiting[step.transfer]
+            while queue and busy[step.transfer] < limits[step.transfer]:
+                _start(*queue.popleft())
+
+    while pending or delayed or running:
+        # jobs to run again go to the back of the queue
+        while delayed and delayed[0][0] <= time.time():
+            pending.append(heapq.heappop(delayed)[1])
+
+        # start new jobs while there are free slots
+        if limits is not None:
+            limit = limits[True] + limits[False]
+        else:
+            limit = control.limit
+
+        while len(started) < limit:
+            # (a job may have to wait for its group)
+            idx = group_limits.pop(pending)
+            if idx is None:
+                break
+
+            job = make_job(work[idx])
+            if job is None:
+                group_limits.finished(idx)
+                stragglers.total -= 1
+                continue
+
+            job.attach(emit)
+            started[idx] = time.time()
+            _start(idx, job, 0)
+
+        if not running:
+            if delayed and not pending:
+                # wait for the next job to run again
+                time.sleep(max(0, delayed[0][0] - time.time()))
+            continue
+
+        # wait for output, but no longer than the nearest deadline
+        deadlines = [task.deadline for task in running.values()
+                     if task.deadline is not None]
+        if delayed:
+            deadlines.append(delayed[0][0])
+        cutoff = None
+        if not pending and not delayed:
+            cutoff = stragglers.cutoff()
+            if cutoff is not None:
+                deadlines.extend([started[task.idx] + cutoff
+                                  for task in running.values()])
+
+        timeout = None
+        if deadlines:
+            timeout = max(0, min(deadlines) - time.time())
+
+        if flush is not None:
+            flush()
+
+        for fd in poller.poll(timeout):
+            if not running[fd].read():
+                # end of output; the command has finished
+                _end(fd)
+
+        # kill commands that ran into their deadline
+        now = time.time()
+        for fd, task in running.items():
+            if task.deadline is not None and now >= task.deadline:
+                task.timed_out()
+
+            elif cutoff is not None and now >= started[task.idx] + cutoff:
+                task.kill(SKIPPED, 'skipped; slower than %.1f seconds' %
+                          cutoff)
+
+            else:
+                continue
+
+            # do not wait for end of output; child processes
+            # of the killed command may still hold the pipe open
+            _end(fd)
+
+    return results
+
+
+def _run_steps(job, bw=None):
+    '''run the commands of a single job in sequence,
+    killing commands that run into their timeout
+    There is no concurrency control or straggler skip for a single job
+    bw is the bandwidth limit for transfers, in kilobytes per second
+    Returns exit code of the job
+    '''
+
+    poller = synctool.poller.Poller()
+
+    step = 0
+    while job.status is None and step < len(job.steps):
+        if not job.wanted(step):
+            step += 1
+            continue
+
+        limit = None
+        if job.steps[step].bwlimit:
+            limit = bw
+
+        task = _start_step(0, job, step, limit)
+        step += 1
+        if task is None:
+            # failed to start; move on to the next command
+            continue
+
+        fd = task.proc.stdout.fileno()
+        poller.register(fd)
+        while True:
+            timeout = None
+            if task.deadline is not None:
+                timeout = max(0, task.deadline - time.time())
+
+            if poller.poll(timeout):
+                if task.read():
+                    continue
+
+                # end of output; the command has finished
+                break
+
+            if task.deadline is not None and time.time() >= task.deadline:
+                # do not wait for end of output
+                task.timed_out()
+                break
+
+        poller.unregister(fd)
+        task.end()
+
+    return job.finish()
+
+
+class _Stragglers(object):
+    '''the 'straggler_skip' deadline
+    When only the last N percent of nodes are still running, those that
+    take longer than a multiple of the time in which the other nodes
+    completed are skipped
+    '''
+
+    def __init__(self, total):
+        '''initialize instance'''
+
+        self.total = total
+        self.durations = []
+
+    def finished(self, duration):
+        '''a job completed, taking duration seconds'''
+
+        self.durations.append(duration)
+
+    def cutoff(self):
+        '''Returns deadline (in seconds since start of the job)
+        for the remaining jobs, or None if there is no deadline
+        '''
+
+        if not param.STRAGGLER_SKIP:
+            return None
+
+        # the percentile of nodes that must be complete
+        needed = int(math.ceil(self.total *
+                               (100 - param.STRAGGLER_SKIP) / 100.0))
+        if needed < 1 or len(self.durations) < needed:
+            return None
+
+        return sorted(self.durations)[needed - 1] * param.STRAGGLER_FACTOR
+
+
+def _start_step(idx, job, step, bw=None):
+    '''start command number 'step' of the job
+    bw is the bandwidth limit for a transfer, in kilobytes per second
+    Returns _Running instance, or None on error
+    '''
+
+    cmd_arr = job.steps[step].cmd_arr
+    if bw is not None:
+        cmd_arr = bwlimit(cmd_arr, bw)
+    if job.steps[step].msg:
+        verbose(job.steps[step].msg)
+
+    stdin = None
+    feeder = None
+    if callable(job.steps[step].stdin):
+        unix_out(' '.join(cmd_arr))
+        fed = _feed(job.steps[step].stdin)
+        if fed is None:
+            # error message already printed
+            job.step_done(-1, job.steps[step].check)
+            return None
+
+        stdin, feeder = fed
+
+    elif job.steps[step].stdin is not None:
+        unix_out(' '.join(cmd_arr) + ' <' + job.steps[step].stdin)
+        try:
+            stdin = open(job.steps[step].stdin, 'rb')
+        except IOError as err:
+            stderr('failed to open %s: %s' % (job.steps[step].stdin,
+                                              err.strerror))
+            job.step_done(-1, job.steps[step].check)
+            return None
+    else:
+        unix_out(' '.join(cmd_arr))
+
+    try:
+        proc = subprocess.Popen(cmd_arr, shell=False, close_fds=True,
+                                stdin=stdin, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+    except OSError as err:
+        stderr('failed to run command %s: %s' % (cmd_arr[0], err.strerror))
+        job.step_done(-1, job.steps[step].check)
+        if feeder is not None:
+            # it stops writing when the pipe is closed
+            stdin.close()
+            _reap(feeder)
+        return None
+    finally:
+        if stdin is not None and not stdin.closed:
+            # the command has it open now
+            stdin.close()
+
+    return _Running(idx, job, step, proc, feeder)
+
+
+def _feed(func):
+    '''fork a process that calls func(f) to write to a pipe
+    Returns tuple: (read end of the pipe, pid of the process),
+    or None on error
+    '''
+
+    try:
+        rfd, wfd = os.pipe()
+    except OSError as err:
+        stderr('failed to create pipe: %s' % err.strerror)
+        return None
+
+    try:
+        pid = os.fork()
+    except OSError as err:
+        stderr('failed to fork(): %s' % err.strerror)
+        os.close(rfd)
+        os.close(wfd)
+        return None
+
+    if pid == 0:
+        # child process
+        exitcode = 1
+        try:
+            os.close(rfd)
+            with os.fdopen(wfd, 'wb') as f:
+                func(f)
+            exitcode = 0
+        except (IOError, OSError) as err:
+            if err.errno != errno.EPIPE:
+                stderr('failed to write input of command: %s' %
+                       err.strerror)
+        finally:
+            # never return into the code of the parent process
+            os._exit(exitcode)
+
+    os.close(wfd)
+    return os.fdopen(rfd, 'rb'), pid
+
+
+def _reap(pid):
+    '''wait for process pid to exit
+    Returns True if it exited with 0
+    '''
+
+    while True:
+        try:
+            _, status = os.waitpid(pid, 0)
+        except OSError as err:
+            if err.errno == errno.EINTR:
+                continue
+
+            # it was already waited for
+            return True
+
+        return status == 0
+
+
+class _Bandwidth(object):
+    '''the 'max_bandwidth' budget for transfers
+    A transfer gets its share of the budget when it starts, as option
+    rsync --bwlimit. Because a running rsync can not be given a new
+    limit, the share is the part of the budget that is not in use,
+    divided over the transfers that may start alongside it.
+    Towards the end of a run, when fewer transfers are left,
+    the transfers that start get a larger share
+    '''
+
+    def __init__(self, budget):
+        '''initialize instance
+        budget is in kilobytes per second, or None for no limit
+        '''
+
+        self.budget = budget
+        # in_use[idx] = share of running transfer of work item idx
+        self.in_use = {}
+
+    def count(self):
+        '''Returns number of running transfers'''
+
+        return len(self.in_use)
+
+    def take(self, idx, slots):
+        '''a transfer for work item idx starts, and it may be joined
+        by up to slots - 1 others
+        Returns its bandwidth limit, or None for no limit
+        '''
+
+        if self.budget is None:
+            return None
+
+        free = self.budget - sum(self.in_use.values())
+        share = max(1, free / max(1, slots))
+        self.in_use[idx] = share
+        return share
+
+    def release(self, idx):
+        '''the transfer for work item idx has finished'''
+
+        self.in_use.pop(idx, None)
+
+
+def bwlimit(cmd_arr, limit):
+    '''Returns rsync command cmd_arr with bandwidth limit
+    (in kilobytes per second)
+    '''
+
+    return cmd_arr[:1] + ['--bwlimit=%d' % limit] + cmd_arr[1:]
+
+# EOB
@@ -0,0 +1,207 @@
+#
+#   synctool.generation.py    WJ124
+#
+#   synctool Copyright 2015 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''generation stamps of the repository, to skip rsyncs that would
+not change anything
+
+The master node computes a digest of the content that a node receives,
+which is the same for all nodes that have the same group dirs.
+After a successful rsync, the digest is written to the node, in the
+state dir under the var dir. The next run checks the stamp on the node
+over ssh first, and only runs rsync when it differs
+'''
+
+import os
+import stat
+import pipes
+import hashlib
+
+from synctool import param
+
+# name of the stamp file in the state dir of the node
+FILENAME = 'generation'
+
+# DIGESTS[signature] = digest of content for nodes with that signature
+DIGESTS = {}
+
+# digests of the parts of the tree; the tree outside the group dirs,
+# and the group dirs by path
+BASE_DIGEST = None
+GROUP_DIGESTS = {}
+
+# compiled Python files that are not synced (see the rsync filter)
+PYC_DIRS = ('sbin', 'lib/synctool', 'lib/synctool/pkg')
+
+
+def digest(signature, filter_file):
+    '''Returns digest of the content that nodes with the given signature
+    receive: the tree under ROOTDIR, with only the group dirs
+    in signature (or all of them, if signature is None),
+    and the rsync filter and command
+    '''
+
+    global BASE_DIGEST
+
+    if signature in DIGESTS:
+        return DIGESTS[signature]
+
+    if BASE_DIGEST is None:
+        BASE_DIGEST = _tree_digest(param.ROOTDIR, _base_skip())
+
+    h = hashlib.sha1()
+    h.update(BASE_DIGEST)
+    h.update(param.RSYNC_CMD + '\0')
+    try:
+        with open(filter_file) as f:
+            h.update(f.read())
+    except IOError:
+        # the digest will not match anything; rsync runs
+        h.update(os.urandom(20))
+
+    for path in _group_dirs(signature):
+        if path not in GROUP_DIGESTS:
+            GROUP_DIGESTS[path] = _tree_digest(path)
+        h.update(path + '\0' + GROUP_DIGESTS[path])
+
+    DIGESTS[signature] = h.hexdigest()
+    return DIGESTS[signature]
+
+
+def signature_name(signature):
+    '''Returns name for signature that can be used as filename'''
+
+    if signature is None:
+        key = 'slave'
+    else:
+        key = ' '.join(signature)
+
+    return hashlib.sha1(key).hexdigest()[:16]
+
+
+def tree(signature):
+    '''Returns generator of the paths under ROOTDIR that nodes with
+    the given signature receive (see digest())
+    '''
+
+    for path in walk(param.ROOTDIR, _base_skip()):
+        yield path
+
+    for topdir in (param.OVERLAY_DIR, param.DELETE_DIR, param.PURGE_DIR):
+        yield topdir
+
+    for top in _group_dirs(signature):
+        for path in walk(top):
+            yield path
+
+
+def _base_skip():
+    '''Returns list of dirs that are not part of the tree
+    outside the group dirs
+    '''
+
+    return [param.OVERLAY_DIR, param.DELETE_DIR, param.PURGE_DIR,
+            param.STATE_DIR, param.TEMP_DIR]
+
+
+def _group_dirs(signature):
+    '''Returns list of paths of the group dirs for signature'''
+
+    paths = []
+    for topdir in (param.OVERLAY_DIR, param.DELETE_DIR, param.PURGE_DIR):
+        if signature is None:
+            groups = sorted(os.listdir(topdir))
+        else:
+            groups = signature
+
+        for g in groups:
+            path = os.path.join(topdir, g)
+            if os.path.isdir(path):
+                paths.append(path)
+
+    return paths
+
+
+def walk(top, skip=None):
+    '''Returns generator of top and all paths under it in a fixed order,
+    leaving out the dirs in skip, and the compiled Python files
+    that are not synced
+    '''
+
+    if skip is None:
+        skip = []
+
+    pyc_dirs = [os.path.join(param.ROOTDIR, d) for d in PYC_DIRS]
+
+    yield top
+    for path, dirs, files in os.walk(top):
+        dirs[:] = sorted([d for d in dirs
+                          if os.path.join(path, d) not in skip])
+
+        if path in pyc_dirs:
+            files = [x for x in files if not x.endswith('.pyc')]
+
+        for name in sorted(files + dirs):
+            yield os.path.join(path, name)
+
+
+def _tree_digest(top, skip=None):
+    '''Returns digest of the metadata of all entries under top,
+    leaving out the dirs in skip
+    Files are not read; rsync also sees them as unchanged when
+    the size and mtime are the same
+    '''
+
+    h = hashlib.sha1()
+    for path in walk(top, skip):
+        _stat_digest(h, path)
+
+    return h.hexdigest()
+
+
+def _stat_digest(h, path):
+    '''add metadata of path to hash h'''
+
+    try:
+        st = os.lstat(path)
+    except OSError:
+        # it was removed; it is not there for rsync either
+        return
+
+    h.update('%s\0%o %d %d %d %r\0' % (path, st.st_mode, st.st_uid,
+                                        st.st_gid, st.st_size, st.st_mtime))
+    if stat.S_ISLNK(st.st_mode):
+        h.update(os.readlink(path) + '\0')
+
+
+def _stamp_path():
+    '''Returns path of the stamp file on the node'''
+
+    return os.path.join(param.STATE_DIR, FILENAME)
+
+
+def check_cmd(stamp):
+    '''Returns remote command (array) that exits with 0
+    when the node has the given stamp
+    '''
+
+    return ['test', '"$(cat %s 2>/dev/null)"' % pipes.quote(_stamp_path()),
+            '=', stamp]
+
+
+def stamp_cmd(stamp):
+    '''Returns remote command (array) that writes the stamp on the node'''
+
+    path = pipes.quote(_stamp_path())
+    return ['mkdir', '-p', pipes.quote(param.STATE_DIR), '&&',
+            'echo', stamp, '>', path + '.new', '&&',
+            'mv', '-f', path + '.new', path]
+
+
+# EOB
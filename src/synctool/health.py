@@ -0,0 +1,136 @@
+#
+#   synctool.health.py    WJ123
+#
+#   synctool Copyright 2015 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''remember which nodes could not be reached recently
+
+A node is marked down when ssh fails to connect to it (exit code 255),
+or when dsh-ping finds that it is not responding. For the next
+param.HEALTH_TTL seconds, the node is skipped or started last,
+so that it does not hold up a slot while ssh waits for it to time out.
+The node is marked up again as soon as it is reached
+'''
+
+import time
+
+from synctool import config, param
+import synctool.output
+import synctool.state
+
+# name of the state file in param.STATE_DIR
+FILENAME = 'down'
+
+# exit code of ssh when it could not connect
+EXIT_UNREACHABLE = 255
+
+# set by dsh-ping, which checks whether nodes are down
+# rather than skipping them; ping exits with 1 when a node is down
+PROBING = False
+
+# DOWN[nodename] = time at which the node was marked down
+DOWN = None
+CHANGED = False
+
+
+def load():
+    '''load the nodes that are marked down'''
+
+    global DOWN
+
+    DOWN = {}
+    for nodename, t in synctool.state.load(FILENAME).items():
+        if isinstance(t, (int, float)):
+            DOWN[nodename] = t
+
+
+def is_down(nodename):
+    '''Returns True if nodename was marked down recently'''
+
+    if DOWN is None:
+        load()
+
+    return (nodename in DOWN and
+            time.time() - DOWN[nodename] < param.HEALTH_TTL)
+
+
+def split(work):
+    '''split addresses of nodes in work into those that are up,
+    and those that are down
+    Returns tuple: list of indices of nodes to run,
+    list of indices of nodes that are skipped
+    '''
+
+    order = range(len(work))
+    if not param.HEALTH_TTL or PROBING:
+        return order, []
+
+    names = config.get_nodes_by_address()
+    down = [idx for idx in order if is_down(names.get(work[idx],
+                                                      work[idx]))]
+    if not down:
+        return order, []
+
+    skip = set(down)
+    up = [idx for idx in order if idx not in skip]
+    if param.HEALTH_ACTION == 'last':
+        return up + down, []
+
+    return up, down
+
+
+def record(rec):
+    '''handle output record (see module output)'''
+
+    global CHANGED
+
+    if not param.HEALTH_TTL or rec[0] != synctool.output.DONE:
+        return
+
+    nodename, exitcode, status = rec[1:4]
+    if status is not None:
+        # killed or skipped; this says nothing about the node
+        return
+
+    if PROBING:
+        # ping says 1 when the node is not responding
+        down_exitcode = 1
+    else:
+        down_exitcode = EXIT_UNREACHABLE
+
+    if DOWN is None:
+        load()
+
+    if exitcode == down_exitcode:
+        DOWN[nodename] = int(time.time())
+        CHANGED = True
+
+    elif exitcode >= 0 and nodename in DOWN:
+        # it responded, so it is up
+        del DOWN[nodename]
+        CHANGED = True
+
+
+def save():
+    '''write the nodes that are down to the state file'''
+
+    global CHANGED
+
+    if not CHANGED:
+        return
+
+    # forget about nodes that were down long ago
+    now = time.time()
+    for nodename, t in DOWN.items():
+        if now - t >= param.HEALTH_TTL:
+            del DOWN[nodename]
+
+    synctool.state.save(FILENAME, DOWN)
+    CHANGED = False
+
+# EOB
@@ -0,0 +1,349 @@
+#
+#   synctool.history.py    WJ120
+#
+#   synctool Copyright 2015 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''keep the history of synctool runs in a database on the master node
+
+For every run the database holds, per node, the exit code, the time
+taken by every phase, the number of updates, and the changes that were
+made (as logged by synctool-client, like "updating /etc/ntp.conf").
+This can be queried with synctool --history
+'''
+
+import os
+import re
+import time
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from synctool import config, param
+from synctool.lib import error, print_timestamp
+import synctool.output
+
+# name of the database file in param.STATE_DIR
+FILENAME = 'history.db'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    program TEXT,
+    start REAL,
+    end REAL,
+    dry_run INTEGER
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    run INTEGER,
+    node TEXT,
+    exitcode INTEGER,
+    status TEXT,
+    duration REAL,
+    updates INTEGER
+);
+CREATE TABLE IF NOT EXISTS phases (
+    run INTEGER,
+    node TEXT,
+    phase TEXT,
+    secs REAL
+);
+CREATE TABLE IF NOT EXISTS changes (
+    run INTEGER,
+    node TEXT,
+    time REAL,
+    message TEXT
+);
+CREATE INDEX IF NOT EXISTS nodes_run ON nodes (run);
+CREATE INDEX IF NOT EXISTS changes_time ON changes (time);
+'''
+
+# kinds of events that are not an update (see synctool.lib.TERSE_TXT)
+NOT_UPDATES = ('info', 'warn', 'error', 'fail', 'dryrun', 'fixing', 'ok')
+
+# the History of this run; set when config parameter run_history is set
+HISTORY = None
+
+# time spec like '1w', '2d', '12h', '1h30m'
+SINCE_SPEC = re.compile(r'^(\d+[w])?(\d+[d])?(\d+[h])?(\d+[m])?(\d+[s])?$')
+SINCE_UNITS = {'w': 7 * 24 * 3600, 'd': 24 * 3600, 'h': 3600, 'm': 60,
+               's': 1}
+
+
+class History(object):
+    '''class holding the results of a run, for storing in the database'''
+
+    def __init__(self, progname):
+        '''initialize instance'''
+
+        self.progname = progname
+        self.start = time.time()
+        self.dry_run = True
+        # nodes[nodename] = dict with results of node
+        self.nodes = {}
+        # list of (nodename, time, message)
+        self.changes = []
+
+    def _node(self, nodename):
+        '''Returns dict with results of nodename'''
+
+        if nodename not in self.nodes:
+            self.nodes[nodename] = {'exitcode': None,
+                                    'status': None,
+                                    'phases': {},
+                                    'updates': 0}
+        return self.nodes[nodename]
+
+    def record(self, rec):
+        '''handle output record (see module output)'''
+
+        kind = rec[0]
+        if kind == synctool.output.DONE:
+            nodename, exitcode, status, timings = rec[1:]
+            node = self._node(nodename)
+
+            # a relay reports on itself twice: as relay,
+            # and for running synctool on itself
+            if node['exitcode'] in (None, 0):
+                node['exitcode'] = exitcode
+            if node['status'] is None:
+                node['status'] = status
+
+            phases = node['phases']
+            for phase, secs in timings:
+                phases[phase] = phases.get(phase, 0.0) + secs
+
+        elif kind == synctool.output.REPORT:
+            node = self._node(rec[1])
+            for name, count in rec[2].items():
+                if name not in NOT_UPDATES:
+                    node['updates'] += count
+
+        elif kind == synctool.output.LOG:
+            if rec[2] != '--':
+                self.changes.append((rec[1], time.time(), rec[2]))
+
+    def save(self):
+        '''store the run in the database'''
+
+        db = connect()
+        if db is None:
+            # error message already printed
+            return
+
+        try:
+            with db:
+                cursor = db.execute('INSERT INTO runs (program, start, end, '
+                                    'dry_run) VALUES (?, ?, ?, ?)',
+                                    (self.progname, self.start, time.time(),
+                                     int(self.dry_run)))
+                run = cursor.lastrowid
+
+                for nodename, node in self.nodes.items():
+                    # time spent relaying is time of other nodes
+                    duration = sum([secs for phase, secs in
+                                    node['phases'].items()
+                                    if phase != 'relay'])
+                    db.execute('INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?)',
+                               (run, nodename, node['exitcode'],
+                                node['status'], duration, node['updates']))
+                    db.executemany('INSERT INTO phases VALUES (?, ?, ?, ?)',
+                                   [(run, nodename, phase, secs)
+                                    for phase, secs in
+                                    node['phases'].items()])
+
+                db.executemany('INSERT INTO changes VALUES (?, ?, ?, ?)',
+                               [(run, nodename, t, msg)
+                                for nodename, t, msg in self.changes])
+        except sqlite3.Error as err:
+            error('failed to update run history: %s' % err)
+        finally:
+            db.close()
+
+
+def connect():
+    '''open the history database
+    Returns sqlite3 connection, or None on error
+    '''
+
+    if sqlite3 is None:
+        error('run history requires Python with the sqlite3 module')
+        return None
+
+    if not os.path.isdir(param.STATE_DIR):
+        try:
+            os.makedirs(param.STATE_DIR)
+        except OSError as err:
+            error('failed to create directory %s: %s' % (param.STATE_DIR,
+                                                         err.strerror))
+            return None
+
+    filename = os.path.join(param.STATE_DIR, FILENAME)
+    try:
+        db = sqlite3.connect(filename, timeout=30)
+        db.executescript(SCHEMA)
+    except sqlite3.Error as err:
+        error('failed to open %s: %s' % (filename, err))
+        return None
+
+    return db
+
+
+def record(rec):
+    '''handle output record (see module output)'''
+
+    if HISTORY is not None:
+        HISTORY.record(rec)
+
+
+def parse_since(spec):
+    '''parse time spec like '1w' or '1h30m'
+    Returns number of seconds, or None on error
+    '''
+
+    m = SINCE_SPEC.match(spec.lower())
+    if not m or not spec:
+        return None
+
+    secs = 0
+    for part in m.groups():
+        if part:
+            secs += int(part[:-1]) * SINCE_UNITS[part[-1]]
+    return secs
+
+
+def query(what, since=None, nodes=None):
+    '''print answer to query from the history database
+    what is 'runs', 'changes', 'times', or a path;
+    since is a number of seconds back in time;
+    nodes is a list of nodenames to limit the query to
+    Returns False on error
+    '''
+
+    db = connect()
+    if db is None:
+        # error message already printed
+        return False
+
+    if since is None:
+        start = 0.0
+    else:
+        start = time.time() - since
+
+    try:
+        if what == 'runs':
+            _query_runs(db, start, nodes)
+        elif what == 'times':
+            _query_times(db, start, nodes)
+        else:
+            if what == 'changes':
+                path = None
+            else:
+                path = what
+            _query_changes(db, start, nodes, path)
+
+    except sqlite3.Error as err:
+        error('failed to query run history: %s' % err)
+        return False
+    finally:
+        db.close()
+
+    return True
+
+
+def _node_filter(nodes):
+    '''Returns tuple: SQL condition, parameters
+    that selects the nodes in the nodes column
+    '''
+
+    if nodes is None:
+        return '1', []
+
+    return ('node IN (%s)' % ', '.join(['?'] * len(nodes)), list(nodes))
+
+
+def _query_runs(db, start, nodes):
+    '''print the runs since start'''
+
+    cond, args = _node_filter(nodes)
+    rows = db.execute('SELECT runs.id, runs.start, runs.end, runs.dry_run, '
+                      'COUNT(*), '
+                      'SUM(exitcode != 0 OR status IS NOT NULL), '
+                      'SUM(updates) '
+                      'FROM runs JOIN nodes ON nodes.run = runs.id '
+                      'WHERE runs.start >= ? AND ' + cond + ' '
+                      'GROUP BY runs.id ORDER BY runs.start',
+                      [start] + args)
+
+    for run, t0, t1, dry_run, count, failed, updates in rows:
+        if dry_run:
+            mode = 'dry run'
+        else:
+            mode = 'fix'
+
+        print ('%5d  %s  %6.1fs  %4d nodes  %4d failed  %5d updates  %s' %
+               (run, print_timestamp(t0), t1 - t0, count, failed, updates,
+                mode))
+
+
+def _query_changes(db, start, nodes, path):
+    '''print the changes since start
+    When path is given, print only the changes made to path
+    '''
+
+    cond, args = _node_filter(nodes)
+    sql = ('SELECT time, node, message FROM changes '
+           'WHERE time >= ? AND ' + cond)
+    args = [start] + args
+
+    if path is not None:
+        # messages look like "updating /etc/ntp.conf"
+        path = ' ' + path
+        sql += ' AND substr(message, ?) = ?'
+        args.extend([-len(path), path])
+
+    for t, nodename, message in db.execute(sql + ' ORDER BY time', args):
+        print '%s  %s: %s' % (print_timestamp(t), nodename, message)
+
+
+def _query_times(db, start, nodes):
+    '''print percentiles of the time taken per node, by group'''
+
+    cond, args = _node_filter(nodes)
+    rows = db.execute('SELECT node, duration FROM nodes '
+                      'JOIN runs ON nodes.run = runs.id '
+                      'WHERE runs.start >= ? AND status IS NULL AND ' + cond,
+                      [start] + args)
+
+    # by_group[group] = list of durations
+    by_group = {}
+    for nodename, duration in rows:
+        for group in config.get_groups(nodename):
+            if group != nodename:
+                by_group.setdefault(group, []).append(duration)
+
+    if not by_group:
+        return
+
+    print '%-20s %6s %8s %8s %8s' % ('group', 'count', 'p50', 'p95', 'max')
+    for group in sorted(by_group.keys()):
+        durations = sorted(by_group[group])
+        print ('%-20s %6d %7.1fs %7.1fs %7.1fs' %
+               (group, len(durations), _percentile(durations, 50),
+                _percentile(durations, 95), durations[-1]))
+
+
+def _percentile(durations, pct):
+    '''Returns the pct percentile of sorted list of durations'''
+
+    # nearest rank
+    rank = (len(durations) * pct + 99) / 100
+    return durations[max(rank, 1) - 1]
+
+# EOB
@@ -0,0 +1,162 @@
+#
+#   synctool.journal.py    WJ121
+#
+#   synctool Copyright 2015 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''journal of the nodes that completed, so an interrupted run can be
+resumed with synctool --fix --resume
+
+The journal is a text file in the state dir on the master node.
+Every run (or resumed run) starts with a line:
+
+    # synctool run <timestamp>
+
+followed by a line per node as it completes:
+
+    <nodename> <exit code>
+
+The lines are written as the nodes complete, so the journal is still
+good when the master node goes down halfway through a run
+'''
+
+import os
+import time
+import errno
+
+from synctool import param
+from synctool.lib import error
+import synctool.output
+
+# name of the journal file in param.STATE_DIR
+FILENAME = 'journal'
+
+HEADER = '# synctool run '
+
+# open journal file of this run
+JOURNAL = None
+
+
+def _filename():
+    '''Returns path of the journal file'''
+
+    return os.path.join(param.STATE_DIR, FILENAME)
+
+
+def start(resume=False):
+    '''start a new journal, or add to the last one when resuming
+    Returns False on error
+    '''
+
+    global JOURNAL
+
+    try:
+        os.makedirs(param.STATE_DIR)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            error('failed to create directory %s: %s' % (param.STATE_DIR,
+                                                         err.strerror))
+            return False
+
+    if resume:
+        mode = 'a'
+    else:
+        mode = 'w'
+
+    try:
+        JOURNAL = open(_filename(), mode)
+    except IOError as err:
+        error('failed to open %s: %s' % (_filename(), err.strerror))
+        return False
+
+    _write('%s%d\n' % (HEADER, int(time.time())))
+    return True
+
+
+def _write(line):
+    '''write line to the journal, and make sure it is on disk'''
+
+    try:
+        JOURNAL.write(line)
+        JOURNAL.flush()
+        os.fsync(JOURNAL.fileno())
+    except (IOError, OSError) as err:
+        error('failed to write %s: %s' % (_filename(), err.strerror))
+
+
+def record(rec):
+    '''handle output record (see module output)'''
+
+    if JOURNAL is None or rec[0] != synctool.output.DONE:
+        return
+
+    nodename, exitcode, status = rec[1:4]
+    if status is not None:
+        # killed; it did not complete
+        exitcode = -1
+
+    _write('%s %d\n' % (nodename, exitcode))
+
+
+def finish():
+    '''close the journal'''
+
+    global JOURNAL
+
+    if JOURNAL is not None:
+        JOURNAL.close()
+        JOURNAL = None
+
+
+def load():
+    '''read the journal of the last run
+    Returns set of nodenames that completed successfully,
+    or None on error
+    '''
+
+    try:
+        f = open(_filename())
+    except IOError as err:
+        if err.errno == errno.ENOENT:
+            error('there is no run to resume')
+        else:
+            error('failed to read %s: %s' % (_filename(), err.strerror))
+        return None
+
+    # exitcodes[nodename] = exit code
+    exitcodes = {}
+    # exit codes in the current (resumed) run
+    this_run = {}
+
+    with f:
+        for line in f:
+            if line.startswith(HEADER):
+                # a later run overrides what happened before
+                exitcodes.update(this_run)
+                this_run = {}
+                continue
+
+            arr = line.split()
+            if len(arr) != 2:
+                # may be a partially written last line
+                continue
+
+            nodename, exitcode = arr
+            try:
+                exitcode = int(exitcode)
+            except ValueError:
+                continue
+
+            # a relay reports on itself twice; a failure sticks
+            if this_run.get(nodename, 0) == 0:
+                this_run[nodename] = exitcode
+
+    exitcodes.update(this_run)
+
+    return set([node for node, code in exitcodes.items() if code == 0])
+
+# EOB
@@ -58,6 +58,9 @@ TERSE_TXT = ('info', 'WARN', 'ERROR', 'FAIL',
              'sync', 'link', 'mkdir', 'rm', 'chown', 'chmod', 'exec',
              'upload', 'new', 'type', 'DRYRUN', 'FIXING', 'OK')
 
+# how many times every kind of terse message was given (for reports)
+TERSE_COUNT = [0] * len(TERSE_TXT)
+
 COLORMAP = {'black'   : 30,
             'darkgray': 30,
             'red'     : 31,
@@ -108,6 +111,8 @@ def warning(msg):
 def terse(code, msg):
     '''print short message + shortened filename'''
 
+    TERSE_COUNT[code] += 1
+
     if param.TERSE:
         # convert any path to terse path
         if msg.find(' ') >= 0:
@@ -286,12 +291,13 @@ def _masterlog(msg):
 def log(msg):
     '''log message to syslog'''
 
-    if DRY_RUN or not param.SYSLOGGING:
+    if DRY_RUN:
         return
 
     if MASTERLOG:
         # print it with magic prefix,
         # synctool-master will pick it up
+        # (and keeps it in the run history, even without syslogging)
         print '%synctool-log%', msg
     else:
         _masterlog(msg)
@@ -303,6 +309,20 @@ def run_with_nodename(cmd_arr, nodename):
     Returns process return code or -1 on error
     '''
 
+    def _output(line):
+        '''show line of output with nodename'''
+
+        output_with_nodename(nodename, line)
+
+    return run_with_output(cmd_arr, _output)
+
+
+def run_with_output(cmd_arr, output_func):
+    '''run command and pass every line of output to output_func
+    It will run regardless of what DRY_RUN is
+    Returns process return code or -1 on error
+    '''
+
     unix_out(' '.join(cmd_arr))
 
     sys.stdout.flush()
@@ -319,22 +339,7 @@ def run_with_nodename(cmd_arr, nodename):
     f = proc.stdout
     with f:
         for line in f:
-            line = line.rstrip()
-
-            # if output is a log line, pass it to the master's syslog
-            if line[:15] == '%synctool-log% ':
-                if line[15:] == '--':
-                    pass
-                else:
-                    _masterlog('%s: %s' % (nodename, line[15:]))
-            else:
-                # pass output on; simply use 'print' rather than 'stdout()'
-                if OPT_NODENAME:
-                    print '%s: %s' % (nodename, line)
-                else:
-                    # do not prepend the nodename of this node to the output
-                    # if option --no-nodename was given
-                    print line
+            output_func(line.rstrip())
 
     proc.wait()
     if proc.returncode != 0:
@@ -343,6 +348,36 @@ def run_with_nodename(cmd_arr, nodename):
     return proc.returncode
 
 
+def output_with_nodename(nodename, line):
+    '''show a line of output of a command that ran for nodename
+    If the line is a log line, it is passed to the master's syslog
+    '''
+
+    if line[:15] == '%synctool-log% ':
+        log_with_nodename(nodename, line[15:])
+    else:
+        # pass output on; simply use 'print' rather than 'stdout()'
+        if OPT_NODENAME:
+            print '%s: %s' % (nodename, line)
+        else:
+            # do not prepend the nodename of this node to the output
+            # if option --no-nodename was given
+            print line
+
+
+def log_with_nodename(nodename, msg):
+    '''pass log message of nodename on to the master's syslog'''
+
+    if msg == '--':
+        return
+
+    if MASTERLOG:
+        # running on a relay; pass it on to the master node
+        print '%%synctool-log%% %s: %s' % (nodename, msg)
+    else:
+        _masterlog('%s: %s' % (nodename, msg))
+
+
 def shell_command(cmd):
     '''run a shell command
     Unless DRY_RUN is set
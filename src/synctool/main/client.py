@@ -23,6 +23,7 @@ from synctool.lib import verbose, stdout, stderr, error, warning, terse
 from synctool.lib import unix_out, prettypath
 from synctool.main.wrapper import catch_signals
 import synctool.overlay
+import synctool.report
 import synctool.syncstat
 
 # hardcoded name because otherwise we get "synctool_client.py"
@@ -36,6 +37,9 @@ ACTION_REFERENCE = 3
 
 SINGLE_FILES = []
 
+# print counts of changes made, for the master's report
+OPT_STATS = False
+
 
 def generate_template(obj, post_dict):
     '''run template .post script, generating a new file
@@ -716,14 +720,14 @@ Note that synctool does a dry run unless you specify --fix
 def get_options():
     '''parse command-line options'''
 
-    global SINGLE_FILES
+    global SINGLE_FILES, OPT_STATS
 
     try:
         opts, args = getopt.getopt(sys.argv[1:], 'hc:d:1:r:efNFTvq',
                                    ['help', 'conf=', 'diff=', 'single=',
                                     'ref=', 'erase-saved', 'fix', 'no-post',
                                     'fullpath', 'terse', 'color', 'no-color',
-                                    'masterlog', 'node=', 'nodename=',
+                                    'masterlog', 'stats', 'node=', 'nodename=',
                                     'verbose', 'quiet', 'unix', 'version'])
     except getopt.GetoptError as reason:
         print '%s: %s' % (PROGNAME, reason)
@@ -829,6 +833,11 @@ def get_options():
             synctool.lib.MASTERLOG = True
             continue
 
+        if opt == '--stats':
+            # used by the master for the report of the run
+            OPT_STATS = True
+            continue
+
         if opt in ('-N', '--node', '--nodename'):
             # used by the master to set the client's nodename
             # or to force the nodename when running in stand-alone mode
@@ -1000,4 +1009,7 @@ def main():
 
     unix_out('# EOB')
 
+    if OPT_STATS:
+        synctool.report.print_events()
+
 # EOB
@@ -480,7 +480,10 @@ def main():
         print param.PACKAGE_MANAGER
 
     elif ACTION == ACTION_NUMPROC:
-        print param.NUM_PROC
+        if param.NUM_PROC_AUTO:
+            print 'auto %d %d' % (param.NUM_PROC_MIN, param.NUM_PROC_MAX)
+        else:
+            print param.NUM_PROC
 
     elif ACTION == ACTION_LIST_DIRS:
         list_dirs()
@@ -14,16 +14,19 @@ import os
 import sys
 import getopt
 import shlex
+import pipes
 
 from synctool import config, param
-import synctool.aggr
 import synctool.configparser
+import synctool.fanout
 import synctool.lib
 from synctool.lib import verbose, error
 from synctool.main.wrapper import catch_signals
 import synctool.multiplex
 import synctool.nodeset
+import synctool.output
 import synctool.parallel
+import synctool.report
 import synctool.unbuffered
 
 # hardcoded name because otherwise we get "dsh.py"
@@ -32,8 +35,6 @@ PROGNAME = 'dsh'
 NODESET = synctool.nodeset.NodeSet()
 
 OPT_SKIP_RSYNC = False
-OPT_AGGREGATE = False
-MASTER_OPTS = None
 SSH_OPTIONS = None
 OPT_MULTIPLEX = False
 CTL_CMD = None
@@ -49,11 +50,25 @@ REMOTE_CMD_ARR = None
 # immediately run it using 'dsh'
 SYNC_IT = False
 
+# contents of the script to pass along over ssh (see 'ship_scripts')
+SCRIPT = None
+
+# scripts larger than this are synced with rsync anyway,
+# because the entire script is passed on the (remote) command line
+MAX_SHIP_SIZE = 65536
+
+# shell code that writes the script to a temp dir, runs it, and cleans up
+# When mktemp fails, it exits with 127 rather than 255, which would be
+# taken for an unreachable node (see retry and the health cache)
+SHIP_CMD = ('umask 077; d=`mktemp -d "${TMPDIR:-/tmp}/dsh.XXXXXX"` || '
+            'exit 127; printf %%s %s > "$d/%s" && chmod 700 "$d/%s" && '
+            '"$d/%s" %s; r=$?; rm -rf "$d"; exit $r')
+
 
 def run_dsh(address_list, remote_cmd_arr):
     '''run remote command to a set of nodes using ssh (param ssh_cmd)'''
 
-    global SSH_CMD_ARR, REMOTE_CMD_ARR, SYNC_IT
+    global SSH_CMD_ARR, REMOTE_CMD_ARR, SYNC_IT, SCRIPT
 
     # if the command is under scripts/, assume its full path
     # This is nice because scripts/ isn't likely to be in PATH
@@ -85,6 +100,9 @@ def run_dsh(address_list, remote_cmd_arr):
         verbose('%s: %s' % (full_path, err.strerror))
         SYNC_IT = False
 
+    if SYNC_IT and param.SHIP_SCRIPTS:
+        SCRIPT = read_script(remote_cmd_arr[0])
+
     SSH_CMD_ARR = shlex.split(param.SSH_CMD)
 
     if SSH_OPTIONS:
@@ -98,11 +116,45 @@ def run_dsh(address_list, remote_cmd_arr):
 
     REMOTE_CMD_ARR = remote_cmd_arr
 
-    synctool.parallel.do(worker_ssh, address_list)
+    synctool.fanout.do(ssh_job, address_list)
+
+
+def read_script(filename):
+    '''read script to ship to the nodes
+    Returns contents of the script, or None if it should be
+    synced with rsync instead
+    '''
+
+    try:
+        with open(filename) as f:
+            script = f.read(MAX_SHIP_SIZE + 1)
+    except IOError as err:
+        verbose('%s: %s' % (filename, err.strerror))
+        return None
+
+    if len(script) > MAX_SHIP_SIZE:
+        verbose('%s is too large to ship; using rsync' % filename)
+        return None
+
+    if '\0' in script:
+        verbose('%s is a binary file; using rsync' % filename)
+        return None
 
+    return script
 
-def worker_ssh(addr):
-    '''worker process: sync script and run ssh+command to the node'''
+
+def ship_cmd(cmd_arr):
+    '''Returns remote shell command that runs the script
+    from a temp file on the node
+    '''
+
+    name = pipes.quote(os.path.basename(cmd_arr[0]))
+    return SHIP_CMD % (pipes.quote(SCRIPT), name, name, name,
+                       ' '.join(cmd_arr[1:]))
+
+
+def ssh_job(addr):
+    '''make job: sync script and run ssh+command to the node'''
 
     # Note that this func even runs ssh to the local node if
     # the master is also managed by synctool
@@ -111,15 +163,19 @@ def worker_ssh(addr):
 
     nodename = NODESET.get_nodename_from_address(addr)
 
+    job = synctool.fanout.Job(nodename)
+
     # use ssh connection multiplexing (if possible)
     use_multiplex = synctool.multiplex.use_mux(nodename)
 
-    if SYNC_IT and not (OPT_SKIP_RSYNC or nodename in param.NO_RSYNC):
+    # the script is either passed along with the command,
+    # or synced to the node with rsync
+    sync_it = SYNC_IT and not (OPT_SKIP_RSYNC or nodename in param.NO_RSYNC)
+    ship_it = sync_it and SCRIPT is not None
+
+    if sync_it and not ship_it:
         # first, sync the script to the node using rsync
         # REMOTE_CMD_ARR[0] is the full path to the cmd in SCRIPT_DIR
-        verbose('running rsync $SYNCTOOL/scripts/%s to node %s' %
-                (os.path.basename(REMOTE_CMD_ARR[0]), nodename))
-
         cmd_arr = shlex.split(param.RSYNC_CMD)
 
         # add "-e ssh_cmd" to rsync command
@@ -137,7 +193,9 @@ def worker_ssh(addr):
         cmd_arr.append('--')
         cmd_arr.append('%s' % REMOTE_CMD_ARR[0])
         cmd_arr.append('%s:%s' % (addr, REMOTE_CMD_ARR[0]))
-        synctool.lib.run_with_nodename(cmd_arr, nodename)
+        job.add_step(cmd_arr, 'running rsync $SYNCTOOL/scripts/%s to node %s' %
+                     (os.path.basename(REMOTE_CMD_ARR[0]), nodename),
+                     timeout=param.RSYNC_TIMEOUT, phase='rsync')
 
     cmd_str = ' '.join(REMOTE_CMD_ARR)
 
@@ -145,26 +203,26 @@ def worker_ssh(addr):
     # or else parallelism may screw things up
     ssh_cmd_arr = SSH_CMD_ARR[:]
 
-    verbose('running %s to %s %s' % (os.path.basename(SSH_CMD_ARR[0]),
-                                     nodename, cmd_str))
-
     # add extra arguments for ssh multiplexing (if OK to use)
     if use_multiplex:
         synctool.multiplex.ssh_args(ssh_cmd_arr, nodename)
 
     ssh_cmd_arr.append('--')
     ssh_cmd_arr.append(addr)
-    ssh_cmd_arr.extend(REMOTE_CMD_ARR)
+    if ship_it:
+        ssh_cmd_arr.append(ship_cmd(REMOTE_CMD_ARR))
+    else:
+        ssh_cmd_arr.extend(REMOTE_CMD_ARR)
 
     # execute ssh+remote command and show output with the nodename
-    if param.NUM_PROC <= 1:
-        # run with -N 1 : wait on prompts, flush output
-        print nodename + ': ',
-        synctool.lib.exec_command(ssh_cmd_arr)
-    else:
-        # run_with_nodename() shows the nodename, but
-        # does not expect any prompts while running the cmd
-        synctool.lib.run_with_nodename(ssh_cmd_arr, nodename)
+    # with -N 1 : wait on prompts, flush output
+    # otherwise the output is shown with the nodename, but
+    # it does not expect any prompts while running the cmd
+    job.add_step(ssh_cmd_arr, 'running %s to %s %s' %
+                 (os.path.basename(SSH_CMD_ARR[0]), nodename, cmd_str),
+                 interactive=param.NUM_PROC <= 1,
+                 timeout=param.EXEC_TIMEOUT, phase='exec')
+    return job
 
 
 def start_multiplex(address_list):
@@ -286,8 +344,13 @@ def usage():
       --unix                  Output actions as unix shell commands
   -v, --verbose               Be verbose
   -a, --aggregate             Condense output; list nodes per change
+      --grouped               Show output per node, when the node is done
+      --output-dir=DIR        Write output of every node to DIR/nodename
+      --report=FILE           Write report of the run in JSON format
       --skip-rsync            Do not sync commands from the scripts/ dir
                               (eg. when it is on a shared filesystem)
+      --ship                  Pass scripts along over ssh, not with rsync
+      --no-ship               Sync scripts with rsync
 
 CTL_CMD can be: check, stop, exit
 '''
@@ -296,7 +359,7 @@ CTL_CMD can be: check, stop, exit
 def get_options():
     '''parse command-line options'''
 
-    global MASTER_OPTS, OPT_SKIP_RSYNC, OPT_AGGREGATE, SSH_OPTIONS
+    global OPT_SKIP_RSYNC, SSH_OPTIONS
     global OPT_MULTIPLEX, CTL_CMD, PERSIST
 
     if len(sys.argv) <= 1:
@@ -310,7 +373,9 @@ def get_options():
                                     'options=', 'master', 'multiplex',
                                     'persist=', 'numproc=', 'zzz=',
                                     'no-nodename', 'unix', 'verbose',
-                                    'aggregate', 'skip-rsync', 'quiet'])
+                                    'aggregate', 'skip-rsync', 'quiet',
+                                    'grouped', 'output-dir=', 'report=',
+                                    'ship', 'no-ship'])
     except getopt.GetoptError as reason:
         print '%s: %s' % (PROGNAME, reason)
 #        usage()
@@ -345,14 +410,7 @@ def get_options():
     check_cmd_config()
 
     # then process the other options
-    MASTER_OPTS = [sys.argv[0],]
-
     for opt, arg in opts:
-        if opt:
-            MASTER_OPTS.append(opt)
-        if arg:
-            MASTER_OPTS.append(arg)
-
         if opt in ('-h', '--help', '-?', '-c', '--conf'):
             continue
 
@@ -409,6 +467,9 @@ def get_options():
                 print '%s: invalid value for numproc' % PROGNAME
                 sys.exit(1)
 
+            # a fixed number overrides 'num_proc auto'
+            param.NUM_PROC_AUTO = False
+
             continue
 
         if opt in ('-z', '--zzz'):
@@ -432,7 +493,20 @@ def get_options():
             continue
 
         if opt in ('-a', '--aggregate'):
-            OPT_AGGREGATE = True
+            synctool.output.MODE = 'aggregate'
+            continue
+
+        if opt == '--grouped':
+            synctool.output.MODE = 'grouped'
+            continue
+
+        if opt == '--output-dir':
+            synctool.output.check_output_dir(arg)
+            synctool.output.OUTPUT_DIR = arg
+            continue
+
+        if opt == '--report':
+            synctool.report.REPORT = synctool.report.Report(PROGNAME, arg)
             continue
 
         if opt == '--no-nodename':
@@ -447,6 +521,14 @@ def get_options():
             OPT_SKIP_RSYNC = True
             continue
 
+        if opt == '--ship':
+            param.SHIP_SCRIPTS = True
+            continue
+
+        if opt == '--no-ship':
+            param.SHIP_SCRIPTS = False
+            continue
+
         if opt in ('-v', '--verbose'):
             synctool.lib.VERBOSE = True
             continue
@@ -472,9 +554,6 @@ def get_options():
         print '%s: missing remote command' % PROGNAME
         sys.exit(1)
 
-    if len(args) > 0:
-        MASTER_OPTS.extend(args)
-
     return args
 
 
@@ -493,12 +572,6 @@ def main():
         error(str(err))
         sys.exit(1)
 
-    if OPT_AGGREGATE:
-        if not synctool.aggr.run(MASTER_OPTS):
-            sys.exit(-1)
-
-        sys.exit(0)
-
     config.init_mynodename()
 
     address_list = NODESET.addresses()
@@ -513,4 +586,7 @@ def main():
     else:
         run_dsh(address_list, cmd_args)
 
+        if synctool.report.REPORT is not None:
+            synctool.report.REPORT.write()
+
 # EOB
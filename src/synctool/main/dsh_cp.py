@@ -14,15 +14,19 @@ import os
 import sys
 import getopt
 import shlex
+import pipes
+import tarfile
+import subprocess
 
 from synctool import config, param
-import synctool.aggr
+import synctool.fanout
+import synctool.health
 import synctool.lib
-from synctool.lib import stdout, error, unix_out
+from synctool.lib import error, unix_out
 import synctool.multiplex
 from synctool.main.wrapper import catch_signals
 import synctool.nodeset
-import synctool.parallel
+import synctool.output
 import synctool.unbuffered
 
 # hardcoded name because otherwise we get "dsh_cp.py"
@@ -31,15 +35,99 @@ PROGNAME = 'dsh-cp'
 NODESET = synctool.nodeset.NodeSet()
 
 DESTDIR = None
-OPT_AGGREGATE = False
-MASTER_OPTS = None
 DSH_CP_OPTIONS = None
 OPT_PURGE = False
 
+# number of chains of nodes to copy through; 0 means copy to every node
+OPT_CHAIN = 0
+
 # ugly globals help parallelism
 DSH_CP_CMD_ARR = None
 SOURCE_LIST = None
 FILES_STR = None
+# checksum of the tar stream, for copying through chains
+CHAIN_CHECKSUM = None
+# CHAINED[nodename] = ChainJob of the chain that the node was in
+CHAINED = {}
+
+# shell code that unpacks the tar stream in the destination dir,
+# and passes it on to the next node in the chain at the same time
+# Every node runs it as:
+#   sh -c SCRIPT chain SCRIPT DESTDIR SSH_CMD node=addr [node=addr ..]
+# The script contains no single quotes, so that it can pass itself on
+# When it can not make its temp files, it exits with 127 rather than 255,
+# which would be taken for an unreachable node
+CHAIN_SCRIPT = ('d=`mktemp -d "${TMPDIR:-/tmp}/dsh-cp.XXXXXX"` || exit 127; '
+                's="$1"; dest="$2"; ssh_cmd="$3"; me="$4"; shift 4; '
+                'q=`printf "\\047"`; '
+                'mkfifo "$d/t" "$d/s" || { rm -rf "$d"; exit 127; }; '
+                '{ mkdir -p "$dest" && cd "$dest" && tar xpf -; r=$?; '
+                'cat >/dev/null; exit $r; } <"$d/t" & t=$!; '
+                'cksum <"$d/s" >"$d/sum" & c=$!; '
+                'if [ $# -gt 0 ]; then '
+                'n="$1"; shift; '
+                'tee "$d/t" "$d/s" | { $ssh_cmd -- "${n#*=}" '
+                '"sh -c $q$s$q chain $q$s$q $q$dest$q $q$ssh_cmd$q $n $*"; '
+                'cat >/dev/null; }; '
+                'else tee "$d/t" >"$d/s"; fi; '
+                'wait $t; r=$?; wait $c; '
+                'echo "%synctool-chain% ${me%%=*} $r `cat "$d/sum"`"; '
+                'rm -rf "$d"; exit $r')
+
+CHAIN_PREFIX = '%synctool-chain% '
+CHAIN_PREFIX_LEN = len(CHAIN_PREFIX)
+
+
+class ChainJob(synctool.fanout.Job):
+    '''job that copies to a chain of nodes; every node unpacks
+    the copy and passes it on to the next node in the chain
+    The nodes report the checksum of what they received
+    '''
+
+    def __init__(self, chain):
+        '''initialize instance
+        chain is a list of tuples: (nodename, address)
+        '''
+
+        super(ChainJob, self).__init__(chain[0][0])
+        self.chain = chain
+        # received[nodename] = (exit code, checksum)
+        self.received = {}
+        # output of the chain that is not a report of a node;
+        # it is shown for the first node of the chain
+        self.lines = []
+
+    def output(self, line):
+        '''handle a line of output of the chain'''
+
+        if line[:CHAIN_PREFIX_LEN] == CHAIN_PREFIX:
+            arr = line[CHAIN_PREFIX_LEN:].split(None, 2)
+            if len(arr) == 3:
+                try:
+                    exitcode = int(arr[1])
+                except ValueError:
+                    exitcode = -1
+                self.received[arr[0]] = (exitcode, arr[2].strip())
+                return
+
+        self.lines.append(line)
+
+    def problem(self, nodename):
+        '''Returns why nodename did not receive a good copy,
+        or None if it did
+        '''
+
+        got = self.received.get(nodename)
+        if got is None:
+            return 'copy did not arrive'
+
+        if got[0] != 0:
+            return 'failed to unpack copy'
+
+        if got[1] != CHAIN_CHECKSUM:
+            return 'checksum mismatch'
+
+        return None
 
 
 def run_remote_copy(address_list, files):
@@ -91,19 +179,45 @@ def run_remote_copy(address_list, files):
     if DSH_CP_OPTIONS:
         DSH_CP_CMD_ARR.extend(shlex.split(DSH_CP_OPTIONS))
 
-    synctool.parallel.do(worker_dsh_cp, address_list)
+    if OPT_CHAIN:
+        run_chains(address_list)
+        return
+
+    synctool.fanout.do(dsh_cp_job, address_list)
 
 
-def worker_dsh_cp(addr):
-    '''do remote copy to node'''
+def dsh_cp_job(addr):
+    '''make job: do remote copy to node'''
 
     nodename = NODESET.get_nodename_from_address(addr)
     if nodename == param.NODENAME:
         # do not copy to local node; files are already here
-        return
+        return None
 
     # the fileset already has been added to DSH_CP_CMD_ARR
 
+    job = synctool.fanout.Job(nodename)
+
+    dsh_cp_cmd_arr = _rsync_cmd(nodename, addr)
+
+    msg = 'copy %s to %s' % (FILES_STR, DESTDIR)
+    if synctool.lib.DRY_RUN:
+        msg += ' (dry run)'
+    if not (synctool.lib.UNIX_CMD or param.TERSE):
+        job.output(msg)
+
+    if not synctool.lib.DRY_RUN:
+        job.add_step(dsh_cp_cmd_arr, timeout=param.RSYNC_TIMEOUT,
+                     phase='rsync')
+    else:
+        unix_out(' '.join(dsh_cp_cmd_arr) + '    # dry run')
+
+    return job
+
+
+def _rsync_cmd(nodename, addr):
+    '''Returns rsync command (array) that copies the files to node'''
+
     # use ssh connection multiplexing (if possible)
     use_multiplex = synctool.multiplex.use_mux(nodename)
 
@@ -120,18 +234,182 @@ def worker_dsh_cp(addr):
     dsh_cp_cmd_arr.append('--')
     dsh_cp_cmd_arr.extend(SOURCE_LIST)
     dsh_cp_cmd_arr.append('%s:%s' % (addr, DESTDIR))
+    return dsh_cp_cmd_arr
+
+
+def run_chains(address_list):
+    '''copy the files to chains of nodes; the master node sends
+    the files once to the first node of every chain
+    Then every node is done, and the nodes that did not receive
+    a good copy get it with rsync after all
+    '''
+
+    global CHAIN_CHECKSUM
+
+    # do not copy to local node; files are already here
+    # Nodes that are down would break the chain for the nodes behind them
+    nodes = [(NODESET.get_nodename_from_address(addr), addr)
+             for addr in address_list]
+    nodes = [x for x in nodes if x[0] != param.NODENAME and
+             not (param.HEALTH_TTL and synctool.health.is_down(x[0]))]
+
+    # divide the nodes over the chains, keeping neighbors together
+    num = min(OPT_CHAIN, len(nodes))
+    chains = []
+    start = 0
+    for i in range(num):
+        end = start + (len(nodes) - start) / (num - i)
+        chains.append(nodes[start:end])
+        start = end
+
+    jobs = [chain_job(chain) for chain in chains]
+    for job in jobs:
+        for nodename, _ in job.chain:
+            CHAINED[nodename] = job
+
+    if jobs and not synctool.lib.DRY_RUN:
+        CHAIN_CHECKSUM = _checksum()
+        if CHAIN_CHECKSUM is None:
+            # error message already printed
+            sys.exit(-1)
 
-    msg = 'copy %s to %s' % (FILES_STR, DESTDIR)
-    if synctool.lib.DRY_RUN:
-        msg += ' (dry run)'
-    if synctool.lib.OPT_NODENAME:
-        msg = ('%s: ' % nodename) + msg
-    stdout(msg)
+        # the chains run from this process, so that the tar stream
+        # is made here; there are few of them
+        synctool.fanout.run(lambda job: job, jobs, _no_output)
+
+    synctool.fanout.do(chained_job, address_list)
+
+
+def _no_output(rec):
+    '''the chains keep their output until the nodes are done'''
+
+    pass
+
+
+def chain_job(chain):
+    '''make job: copy to the first node of a chain of nodes,
+    which passes it on to the next node, and so on
+    '''
+
+    job = ChainJob(chain)
+
+    ssh_cmd_arr = shlex.split(param.SSH_CMD)
+    if synctool.multiplex.use_mux(job.nodename):
+        synctool.multiplex.ssh_args(ssh_cmd_arr, job.nodename)
+
+    # the first node of the chain runs the script with the others
+    # as arguments, and so on
+    script = pipes.quote(CHAIN_SCRIPT)
+    cmd_arr = ssh_cmd_arr[:]
+    cmd_arr.append('--')
+    cmd_arr.append(chain[0][1])
+    cmd_arr.extend(['sh', '-c', script, 'chain', script,
+                    pipes.quote(DESTDIR), pipes.quote(param.SSH_CMD)])
+    cmd_arr.extend(['%s=%s' % (nodename, addr) for nodename, addr in chain])
 
     if not synctool.lib.DRY_RUN:
-        synctool.lib.run_with_nodename(dsh_cp_cmd_arr, nodename)
+        # the nodes report whether they got a good copy
+        job.add_step(cmd_arr, 'copy %s to chain of %d nodes' %
+                     (FILES_STR, len(chain)), timeout=param.RSYNC_TIMEOUT,
+                     phase='chain', stdin=_write_tar)
     else:
-        unix_out(' '.join(dsh_cp_cmd_arr) + '    # dry run')
+        unix_out(' '.join(cmd_arr) + '    # dry run')
+
+    return job
+
+
+def chained_job(addr):
+    '''make job: nothing left to do for a node that received a good copy
+    through its chain, or else copy to the node with rsync
+    '''
+
+    nodename = NODESET.get_nodename_from_address(addr)
+    chain = CHAINED.get(nodename)
+    if chain is None:
+        # not in a chain
+        return dsh_cp_job(addr)
+
+    problem = None
+    if not synctool.lib.DRY_RUN:
+        problem = chain.problem(nodename)
+
+    if problem is not None:
+        job = dsh_cp_job(addr)
+        job.output('%s; copying with rsync' % problem)
+    else:
+        job = synctool.fanout.Job(nodename)
+        msg = 'copy %s to %s' % (FILES_STR, DESTDIR)
+        if synctool.lib.DRY_RUN:
+            msg += ' (dry run)'
+        if not (synctool.lib.UNIX_CMD or param.TERSE):
+            job.output(msg)
+
+        # it took as long as the chain
+        job.timings.extend(chain.timings)
+
+    if nodename == chain.nodename:
+        for line in chain.lines:
+            job.output(line)
+
+    return job
+
+
+def _write_tar(f):
+    '''write the files to copy as tar stream to file object f
+    The stream is the same every time, as long as the files do not change
+    '''
+
+    def _add(tar, path, arcname):
+        '''add path to tar, and what is under it in sorted order'''
+
+        tar.add(path, arcname, recursive=False)
+        if os.path.isdir(path) and not os.path.islink(path):
+            for name in sorted(os.listdir(path)):
+                _add(tar, os.path.join(path, name),
+                     os.path.join(arcname, name))
+
+    tar = tarfile.open(fileobj=f, mode='w|')
+    with tar:
+        for source in SOURCE_LIST:
+            if source[-1] == os.sep:
+                # copy the contents of the directory,
+                # like rsync does
+                for name in sorted(os.listdir(source)):
+                    _add(tar, os.path.join(source, name), name)
+            else:
+                _add(tar, source, os.path.basename(source))
+
+
+def _checksum():
+    '''Returns checksum of the tar stream as given by cksum,
+    or None on error
+    '''
+
+    unix_out('tar cf - %s | cksum' % FILES_STR)
+    try:
+        proc = subprocess.Popen(['cksum'], shell=False,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+    except OSError as err:
+        error('failed to run cksum: %s' % err.strerror)
+        return None
+
+    try:
+        _write_tar(proc.stdin)
+        proc.stdin.close()
+    except (IOError, OSError) as err:
+        error('failed to pack files: %s' % err.strerror)
+        proc.stdin.close()
+        proc.wait()
+        return None
+
+    out = proc.stdout.read()
+    proc.wait()
+    if proc.returncode != 0:
+        error('failed to run cksum')
+        return None
+
+    return out.strip()
 
 
 def check_cmd_config():
@@ -156,6 +434,7 @@ def usage():
   -X, --exclude-group=LIST    Exclude these groups from the selection
   -o, --options=options       Add options to rsync
   -p, --purge                 Delete extraneous files from dest dir
+      --chain=NUM             Copy through NUM chains of nodes
       --no-nodename           Do not prepend nodename to output
   -N, --numproc=NUM           Set number of concurrent procs
   -z, --zzz=NUM               Sleep NUM seconds between each run
@@ -171,7 +450,7 @@ DESTDIR may be ':' (colon) meaning the directory of the first source file
 def get_options():
     '''parse command-line options'''
 
-    global DESTDIR, MASTER_OPTS, OPT_AGGREGATE, DSH_CP_OPTIONS, OPT_PURGE
+    global DESTDIR, DSH_CP_OPTIONS, OPT_PURGE, OPT_CHAIN
 
     if len(sys.argv) <= 1:
         usage()
@@ -186,7 +465,7 @@ def get_options():
                                     'exclude=', 'exclude-group=', 'options=',
                                     'purge', 'no-nodename', 'numproc=',
                                     'zzz=', 'unix', 'verbose', 'quiet',
-                                    'aggregate', 'fix'])
+                                    'aggregate', 'fix', 'chain='])
     except getopt.GetoptError as reason:
         print '%s: %s' % (PROGNAME, reason)
 #        usage()
@@ -221,14 +500,7 @@ def get_options():
     check_cmd_config()
 
     # then process the other options
-    MASTER_OPTS = [sys.argv[0],]
-
     for opt, arg in opts:
-        if opt:
-            MASTER_OPTS.append(opt)
-        if arg:
-            MASTER_OPTS.append(arg)
-
         if opt in ('-h', '--help', '-?', '-c', '--conf'):
             # already done
             continue
@@ -257,6 +529,20 @@ def get_options():
             OPT_PURGE = True
             continue
 
+        if opt == '--chain':
+            try:
+                OPT_CHAIN = int(arg)
+            except ValueError:
+                print ("%s: option '%s' requires a numeric value" %
+                       (PROGNAME, opt))
+                sys.exit(1)
+
+            if OPT_CHAIN < 1:
+                print '%s: invalid value for chain' % PROGNAME
+                sys.exit(1)
+
+            continue
+
         if opt == '--no-nodename':
             synctool.lib.OPT_NODENAME = False
             continue
@@ -273,6 +559,9 @@ def get_options():
                 print '%s: invalid value for numproc' % PROGNAME
                 sys.exit(1)
 
+            # a fixed number overrides 'num_proc auto'
+            param.NUM_PROC_AUTO = False
+
             continue
 
         if opt in ('-z', '--zzz'):
@@ -308,13 +597,18 @@ def get_options():
             continue
 
         if opt in ('-a', '--aggregate'):
-            OPT_AGGREGATE = True
+            synctool.output.MODE = 'aggregate'
             continue
 
         if opt in ('-f', '--fix'):
             synctool.lib.DRY_RUN = False
             continue
 
+    if OPT_CHAIN and (OPT_PURGE or DSH_CP_OPTIONS):
+        print ('%s: option --chain can not be combined with --purge '
+               'or --options' % PROGNAME)
+        sys.exit(1)
+
     if not args:
         print '%s: missing file to copy' % PROGNAME
         sys.exit(1)
@@ -323,8 +617,6 @@ def get_options():
         print '%s: missing destination' % PROGNAME
         sys.exit(1)
 
-    MASTER_OPTS.extend(args)
-
     DESTDIR = args.pop(-1)
 
     # dest may be ':' meaning that we want to copy the source dirname
@@ -344,6 +636,12 @@ def get_options():
     if DESTDIR[-1] != os.sep:
         DESTDIR += os.sep
 
+    # the nodes in a chain pass these on in single quotes
+    if OPT_CHAIN and ("'" in DESTDIR or "'" in param.SSH_CMD):
+        print ('%s: option --chain does not support quotes in the '
+               'destination or in ssh_cmd' % PROGNAME)
+        sys.exit(1)
+
     return args
 
 
@@ -362,12 +660,6 @@ def main():
         error(str(err))
         sys.exit(1)
 
-    if OPT_AGGREGATE:
-        if not synctool.aggr.run(MASTER_OPTS):
-            sys.exit(-1)
-
-        sys.exit(0)
-
     config.init_mynodename()
 
     address_list = NODESET.addresses()
@@ -11,17 +11,18 @@
 '''ping the synctool nodes'''
 
 import sys
-import subprocess
 import getopt
 import shlex
 
 from synctool import config, param
-import synctool.aggr
+import synctool.fanout
+import synctool.health
 import synctool.lib
-from synctool.lib import verbose, error, unix_out
+from synctool.lib import verbose, error
 from synctool.main.wrapper import catch_signals
 import synctool.nodeset
-import synctool.parallel
+import synctool.output
+import synctool.probe
 import synctool.unbuffered
 
 # hardcoded name because otherwise we get "dsh_ping.py"
@@ -29,74 +30,123 @@ PROGNAME = 'dsh-ping'
 
 NODESET = synctool.nodeset.NodeSet()
 
-OPT_AGGREGATE = False
-
-MASTER_OPTS = []
+# probe the ssh port rather than using ping
+OPT_TCP = False
+OPT_BANNER = False
+PORT = synctool.probe.PORT
+TIMEOUT = synctool.probe.TIMEOUT
 
 
 def ping_nodes(address_list):
     '''ping nodes in parallel'''
 
-    synctool.parallel.do(ping_node, address_list)
+    if OPT_TCP:
+        probe_nodes(address_list)
+    else:
+        synctool.fanout.do(ping_job, address_list)
+
+
+def probe_nodes(address_list):
+    '''probe the ssh port of all nodes at once'''
+
+    verbose('probing port %d of %d nodes' % (PORT, len(address_list)))
+    results = synctool.probe.probe(address_list, PORT, TIMEOUT, OPT_BANNER)
+
+    mux = synctool.output.Multiplexer()
+    for addr, result in zip(address_list, results):
+        node = NODESET.get_nodename_from_address(addr)
+
+        if result.up:
+            msg = 'up (%.1f ms)' % (result.latency * 1000.0)
+            if result.banner:
+                msg += ' %s' % result.banner
+            elif result.banner is not None:
+                msg += ' no banner'
+        else:
+            msg = 'not responding (%s)' % result.error
 
+        mux.record((synctool.output.OUT, node, msg))
+        mux.record((synctool.output.DONE, node, int(not result.up), None,
+                    []))
 
-def ping_node(addr):
-    '''ping a single node'''
+    mux.finish()
+    synctool.health.save()
+
+
+def ping_job(addr):
+    '''make job: ping a single node'''
 
     node = NODESET.get_nodename_from_address(addr)
-    verbose('pinging %s' % node)
-    unix_out('%s %s' % (param.PING_CMD, addr))
 
-    packets_received = 0
+    job = PingJob(node)
 
     # execute ping command and show output with the nodename
     cmd = '%s %s' % (param.PING_CMD, addr)
-    cmd_arr = shlex.split(cmd)
+    job.add_step(shlex.split(cmd), 'pinging %s' % node)
+    return job
 
-    try:
-        f = subprocess.Popen(cmd_arr, shell=False, bufsize=4096,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT).stdout
-    except OSError as err:
-        error('failed to run command %s: %s' % (cmd_arr[0], err.strerror))
-        return False
-
-    with f:
-        for line in f:
-            line = line.strip()
-
-            # argh, we have to parse output here
-            #
-            # on BSD, ping says something like:
-            # "2 packets transmitted, 0 packets received, 100.0% packet loss"
-            #
-            # on Linux, ping says something like:
-            # "2 packets transmitted, 0 received, 100.0% packet loss, " \
-            # "time 1001ms"
-
-            arr = line.split()
-            if len(arr) > 3 and (arr[1] == 'packets' and
-                                 arr[2] == 'transmitted,'):
-                try:
-                    packets_received = int(arr[3])
-                except ValueError:
-                    pass
-
-                break
-
-            # some ping implementations say "hostname is alive"
-            # or "hostname is unreachable"
-            elif len(arr) == 3 and arr[1] == 'is':
-                if arr[2] == 'alive':
-                    packets_received = 100
-
-                elif arr[2] == 'unreachable':
-                    packets_received = -1
-
-    if packets_received > 0:
-        print '%s: up' % node
-    else:
-        print '%s: not responding' % node
+
+class PingJob(synctool.fanout.Job):
+    '''ping a node, parse the output and say whether it is up'''
+
+    def __init__(self, nodename):
+        '''initialize instance'''
+
+        super(PingJob, self).__init__(nodename)
+        self.packets_received = 0
+        self.done_parsing = False
+
+    def output(self, line):
+        '''parse line of output of ping'''
+
+        if self.done_parsing:
+            return
+
+        line = line.strip()
+
+        # argh, we have to parse output here
+        #
+        # on BSD, ping says something like:
+        # "2 packets transmitted, 0 packets received, 100.0% packet loss"
+        #
+        # on Linux, ping says something like:
+        # "2 packets transmitted, 0 received, 100.0% packet loss, " \
+        # "time 1001ms"
+
+        arr = line.split()
+        if len(arr) > 3 and (arr[1] == 'packets' and
+                             arr[2] == 'transmitted,'):
+            try:
+                self.packets_received = int(arr[3])
+            except ValueError:
+                pass
+
+            self.done_parsing = True
+
+        # some ping implementations say "hostname is alive"
+        # or "hostname is unreachable"
+        elif len(arr) == 3 and arr[1] == 'is':
+            if arr[2] == 'alive':
+                self.packets_received = 100
+
+            elif arr[2] == 'unreachable':
+                self.packets_received = -1
+
+    def finish(self):
+        '''print whether the node is up
+        Returns 0 if up, 1 if not responding, or -1 on error
+        '''
+
+        if self.exitcode == -1:
+            # failed to run ping; error message already printed
+            return -1
+
+        if self.packets_received > 0:
+            self.emit((synctool.output.OUT, self.nodename, 'up'))
+            return 0
+
+        self.emit((synctool.output.OUT, self.nodename, 'not responding'))
+        return 1
 
 
 def check_cmd_config():
@@ -124,22 +174,27 @@ def usage():
   -a, --aggregate                Condense output
   -N, --numproc=NUM              Set number of concurrent procs
   -z, --zzz=NUM                  Sleep NUM seconds between each run
+  -t, --tcp                      Probe the ssh port rather than ping
+  -p, --port=NUM                 Probe this port (default: %d)
+  -b, --banner                   Wait for the ssh banner
+  -T, --timeout=SECS             Probe timeout (default: %d seconds)
       --unix                     Output actions as unix shell commands
   -v, --verbose                  Be verbose
-'''
+''' % (synctool.probe.PORT, synctool.probe.TIMEOUT)
 
 
 def get_options():
     '''parse command-line options'''
 
-    global MASTER_OPTS, OPT_AGGREGATE
+    global OPT_TCP, OPT_BANNER, PORT, TIMEOUT
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'hc:vn:g:x:X:aN:qp:z:',
+        opts, args = getopt.getopt(sys.argv[1:], 'hc:vn:g:x:X:aN:qp:z:tbT:',
                                    ['help', 'conf=', 'verbose', 'node=',
                                     'group=', 'exclude=', 'exclude-group=',
                                     'aggregate', 'unix', 'quiet', 'numproc=',
-                                    'zzz='])
+                                    'zzz=', 'tcp', 'port=', 'banner',
+                                    'timeout='])
     except getopt.GetoptError as reason:
         print '%s: %s' % (PROGNAME, reason)
 #        usage()
@@ -171,17 +226,9 @@ def get_options():
 
     config.read_config()
     synctool.nodeset.make_default_nodeset()
-    check_cmd_config()
 
     # then process the other options
-    MASTER_OPTS = [sys.argv[0],]
-
     for opt, arg in opts:
-        if opt:
-            MASTER_OPTS.append(opt)
-        if arg:
-            MASTER_OPTS.append(arg)
-
         if opt in ('-h', '--help', '-?', '-c', '--conf'):
             # already done
             continue
@@ -207,7 +254,7 @@ def get_options():
             continue
 
         if opt in ('-a', '--aggregate'):
-            OPT_AGGREGATE = True
+            synctool.output.MODE = 'aggregate'
             continue
 
         if opt == '--unix':
@@ -230,6 +277,9 @@ def get_options():
                 print '%s: invalid value for numproc' % PROGNAME
                 sys.exit(1)
 
+            # a fixed number overrides 'num_proc auto'
+            param.NUM_PROC_AUTO = False
+
             continue
 
         if opt in ('-z', '--zzz'):
@@ -252,10 +302,49 @@ def get_options():
 
             continue
 
+        if opt in ('-t', '--tcp'):
+            OPT_TCP = True
+            continue
+
+        if opt in ('-b', '--banner'):
+            OPT_TCP = True
+            OPT_BANNER = True
+            continue
+
+        if opt in ('-p', '--port'):
+            try:
+                PORT = int(arg)
+            except ValueError:
+                PORT = 0
+
+            if not 0 < PORT < 65536:
+                print '%s: invalid port number' % PROGNAME
+                sys.exit(1)
+
+            OPT_TCP = True
+            continue
+
+        if opt in ('-T', '--timeout'):
+            try:
+                TIMEOUT = float(arg)
+            except ValueError:
+                print ("%s: option '%s' requires a numeric value" %
+                       (PROGNAME, opt))
+                sys.exit(1)
+
+            if TIMEOUT <= 0:
+                print '%s: invalid value for timeout' % PROGNAME
+                sys.exit(1)
+
+            continue
+
     if args != None and len(args) > 0:
         print '%s: too many arguments' % PROGNAME
         sys.exit(1)
 
+    if not OPT_TCP:
+        check_cmd_config()
+
 
 @catch_signals
 def main():
@@ -272,12 +361,6 @@ def main():
         error(str(err))
         sys.exit(1)
 
-    if OPT_AGGREGATE:
-        if not synctool.aggr.run(MASTER_OPTS):
-            sys.exit(-1)
-
-        sys.exit(0)
-
     config.init_mynodename()
 
     address_list = NODESET.addresses()
@@ -285,6 +368,10 @@ def main():
         print 'no valid nodes specified'
         sys.exit(1)
 
+    # nodes that are down are pinged all the same,
+    # and marked up or down in the health cache
+    synctool.health.PROBING = True
+
     ping_nodes(address_list)
 
 # EOB
@@ -17,13 +17,14 @@ import getopt
 import shlex
 
 from synctool import config, param
-import synctool.aggr
+import synctool.fanout
 import synctool.lib
 from synctool.lib import verbose, error
 import synctool.multiplex
 from synctool.main.wrapper import catch_signals
 import synctool.nodeset
-import synctool.parallel
+import synctool.output
+import synctool.report
 import synctool.unbuffered
 
 # hardcoded name because otherwise we get "dsh_pkg.py"
@@ -31,10 +32,7 @@ PROGNAME = 'dsh-pkg'
 
 NODESET = synctool.nodeset.NodeSet()
 
-OPT_AGGREGATE = False
-
 PASS_ARGS = None
-MASTER_OPTS = None
 
 # ugly global helps parallelism
 SSH_CMD_ARR = None
@@ -53,14 +51,16 @@ def run_remote_pkg(address_list):
         if '-T' in SSH_CMD_ARR:
             SSH_CMD_ARR.remove('-T')
 
-    synctool.parallel.do(worker_pkg, address_list)
+    synctool.fanout.do(pkg_job, address_list)
 
 
-def worker_pkg(addr):
-    '''runs ssh + synctool-pkg to the nodes in parallel'''
+def pkg_job(addr):
+    '''make job: ssh + synctool-pkg to the node'''
 
     nodename = NODESET.get_nodename_from_address(addr)
 
+    job = synctool.fanout.Job(nodename)
+
     # use ssh connection multiplexing (if possible)
     use_multiplex = synctool.multiplex.use_mux(nodename)
 
@@ -76,17 +76,12 @@ def worker_pkg(addr):
     cmd_arr.extend(shlex.split(param.PKG_CMD))
     cmd_arr.extend(PASS_ARGS)
 
-    verbose('running synctool-pkg on node %s' % nodename)
-
     # execute ssh synctool-pkg and show output with the nodename
-    if param.NUM_PROC <= 1:
-        # run with -N 1 : wait on prompts, flush output
-        print nodename + ': ',
-        synctool.lib.exec_command(cmd_arr)
-    else:
-        # run_with_nodename() shows the nodename, but
-        # does not expect any prompts while running the cmd
-        synctool.lib.run_with_nodename(cmd_arr, nodename)
+    # with -N 1 : wait on prompts, flush output
+    job.add_step(cmd_arr, 'running synctool-pkg on node %s' % nodename,
+                 interactive=param.NUM_PROC <= 1,
+                 timeout=param.EXEC_TIMEOUT, phase='pkg')
+    return job
 
 
 def rearrange_options():
@@ -187,6 +182,9 @@ def usage():
       --unix                     Output actions as unix shell commands
   -v, --verbose                  Be verbose
   -a, --aggregate                Condense output
+      --grouped                  Show output per node, when the node is done
+      --output-dir=DIR           Write output of every node to DIR/nodename
+      --report=FILE              Write report of the run in JSON format
   -f, --fix                      Perform upgrade (otherwise, do dry-run)
   -m, --manager PACKAGE_MANAGER  (Force) select this package manager
 
@@ -215,7 +213,7 @@ Note that --upgrade does a dry run unless you specify --fix
 def get_options():
     '''parse command-line options'''
 
-    global MASTER_OPTS, PASS_ARGS, OPT_AGGREGATE
+    global PASS_ARGS
 
     if len(sys.argv) <= 1:
         usage()
@@ -236,14 +234,14 @@ def get_options():
                                     'install', 'remove', 'update', 'upgrade',
                                     'clean', 'cleanup', 'manager=',
                                     'numproc=', 'zzz=', 'fix', 'verbose',
-                                    'quiet', 'unix', 'aggregate'])
+                                    'quiet', 'unix', 'aggregate', 'grouped',
+                                    'output-dir=', 'report='])
     except getopt.GetoptError as reason:
         print '%s: %s' % (PROGNAME, reason)
 #        usage()
         sys.exit(1)
 
     PASS_ARGS = []
-    MASTER_OPTS = [sys.argv[0],]
 
     # first read the config file
     for opt, arg in opts:
@@ -284,12 +282,6 @@ def get_options():
     needs_package_list = False
 
     for opt, arg in opts:
-        if opt:
-            MASTER_OPTS.append(opt)
-
-        if arg:
-            MASTER_OPTS.append(arg)
-
         if opt in ('-h', '--help', '-?', '-c', '--conf'):
             # already done
             continue
@@ -352,6 +344,9 @@ def get_options():
                 print '%s: invalid value for numproc' % PROGNAME
                 sys.exit(1)
 
+            # a fixed number overrides 'num_proc auto'
+            param.NUM_PROC_AUTO = False
+
             continue
 
         if opt in ('-z', '--zzz'):
@@ -384,7 +379,20 @@ def get_options():
             synctool.lib.UNIX_CMD = True
 
         if opt in ('-a', '--aggregate'):
-            OPT_AGGREGATE = True
+            synctool.output.MODE = 'aggregate'
+            continue
+
+        if opt == '--grouped':
+            synctool.output.MODE = 'grouped'
+            continue
+
+        if opt == '--output-dir':
+            synctool.output.check_output_dir(arg)
+            synctool.output.OUTPUT_DIR = arg
+            continue
+
+        if opt == '--report':
+            synctool.report.REPORT = synctool.report.Report(PROGNAME, arg)
             continue
 
         if opt:
@@ -397,7 +405,6 @@ def get_options():
     PASS_ARGS.append('--masterlog')
 
     if args != None:
-        MASTER_OPTS.extend(args)
         PASS_ARGS.extend(args)
     else:
         if needs_package_list:
@@ -427,12 +434,6 @@ def main():
         error(str(err))
         sys.exit(1)
 
-    if OPT_AGGREGATE:
-        if not synctool.aggr.run(MASTER_OPTS):
-            sys.exit(-1)
-
-        sys.exit(0)
-
     config.init_mynodename()
 
     if param.MASTER != param.HOSTNAME:
@@ -452,4 +453,8 @@ def main():
 
     synctool.lib.closelog()
 
+    if synctool.report.REPORT is not None:
+        synctool.report.REPORT.info['dry_run'] = synctool.lib.DRY_RUN
+        synctool.report.REPORT.write()
+
 # EOB
@@ -16,18 +16,29 @@ import os
 import sys
 import getopt
 import shlex
+import pipes
+import shutil
 import tempfile
+import cStringIO
 
 from synctool import config, param
-import synctool.aggr
+import synctool.bundle
+import synctool.durations
+import synctool.fanout
+import synctool.generation
+import synctool.history
+import synctool.journal
 import synctool.lib
 from synctool.lib import verbose, stdout, stderr, error, warning, terse
 from synctool.lib import prettypath
 import synctool.multiplex
 from synctool.main.wrapper import catch_signals
 import synctool.nodeset
+import synctool.output
 import synctool.overlay
-import synctool.parallel
+import synctool.range
+import synctool.report
+import synctool.state
 import synctool.syncstat
 import synctool.unbuffered
 import synctool.update
@@ -39,137 +50,566 @@ PROGNAME = 'synctool'
 NODESET = synctool.nodeset.NodeSet()
 
 OPT_SKIP_RSYNC = False
-OPT_AGGREGATE = False
 OPT_CHECK_UPDATE = False
 OPT_DOWNLOAD = False
+OPT_RELAY = False
+# list of wave sizes, like ['1%', '10%']
+OPT_WAVES = None
+OPT_ERROR_BUDGET = '0'
+# query of the run history, and how many seconds to look back
+OPT_HISTORY = None
+OPT_SINCE = None
+OPT_RESUME = False
+OPT_BUNDLE = False
 
 PASS_ARGS = None
-MASTER_OPTS = None
+# arguments passed on to synctool running on a relay
+RELAY_ARGS = None
+# when True, have the nodes report what they did (option --stats)
+OPT_STATS = False
 
 UPLOAD_FILE = None
 
+# FILTERS[signature] = filename of rsync filter file (see rsync_filter())
+FILTERS = {}
+# names of the group dirs in the overlay, delete, and purge dirs
+FILTER_GROUPS = None
+# rsync filter rules by signature, kept between runs in this state file
+FILTER_STATE = 'filters'
+FILTER_CACHE = None
+
+# BATCHES[signature] = (filename of rsync batch file, generation that
+# a node must have to apply it), or None (see rsync_batch())
+BATCHES = {}
+# the mirrors of what the nodes have are kept in the state dir,
+# along with the generation that they hold
+MIRROR_DIR = 'mirror'
+MIRROR_STATE = 'mirrors'
+MIRRORS = None
+
+
+def run_waves(address_list):
+    '''run synctool on target nodes in waves of increasing size
+    Returns False when the run was aborted
+    '''
+
+    waves = split_waves(address_list, OPT_WAVES)
+    budget = _count_or_percentage(OPT_ERROR_BUDGET, len(address_list))
+
+    failed = []
+    done = 0
+    for num, wave in enumerate(waves):
+        stdout('wave %d/%d: %d nodes' % (num + 1, len(waves), len(wave)))
+
+        failed.extend(run_remote_synctool(wave))
+        done += len(wave)
+
+        if len(failed) > budget:
+            error('%d failed nodes exceed the error budget of %d' %
+                  (len(failed), budget))
+            stderr('failed: %s' % synctool.range.compress(failed))
+            if done < len(address_list):
+                stderr('aborted; %d nodes were not updated' %
+                       (len(address_list) - done))
+            return False
+
+    if failed:
+        warning('%d nodes failed, within the error budget of %d' %
+                (len(failed), budget))
+
+    return True
+
+
+def split_waves(address_list, sizes):
+    '''split address_list into waves of the given sizes
+    (numbers, or percentages of the total);
+    the final wave holds the rest of the nodes
+    Returns list of lists of addresses
+    '''
+
+    total = len(address_list)
+    waves = []
+    start = 0
+    for size in sizes:
+        if start >= total:
+            break
+
+        end = start + max(1, _count_or_percentage(size, total))
+        waves.append(address_list[start:end])
+        start = end
+
+    if start < total:
+        waves.append(address_list[start:])
+
+    return waves
+
+
+def _count_or_percentage(value, total):
+    '''Returns value ('10' or '10%') as count relative to total'''
+
+    if value[-1] == '%':
+        # round up
+        return (int(value[:-1]) * total + 99) / 100
+
+    return int(value)
+
+
+def _check_count_or_percentage(opt, value):
+    '''check value of option is a number or percentage
+    Exits the program on error
+    '''
+
+    if value[-1:] == '%':
+        num = value[:-1]
+    else:
+        num = value
+
+    try:
+        num = int(num)
+    except ValueError:
+        num = -1
+
+    if num < 0 or (value[-1:] == '%' and num > 100):
+        print "option '%s' requires a number or a percentage" % opt
+        sys.exit(1)
+
 
 def run_remote_synctool(address_list):
-    '''run synctool on target nodes'''
+    '''run synctool on target nodes
+    Returns list of nodenames that failed
+    '''
+
+    address_list = synctool.durations.longest_first(address_list, NODESET)
 
-    synctool.parallel.do(worker_synctool, address_list)
+    # relayed[addr] = list of nodenames that the slave syncs
+    relayed = {}
+    if param.RELAYS and not OPT_RELAY:
+        address_list, relayed = relay_nodes(address_list)
 
+    def _make_job(addr):
+        '''make job for either a relay or a regular node'''
 
-def worker_synctool(addr):
-    '''run rsync of ROOTDIR to the nodes and ssh+synctool, in parallel'''
+        if addr in relayed:
+            return relay_job(addr, relayed[addr])
+
+        return synctool_job(addr)
+
+    # make the rsync filters in this process, so that
+    # the forked workers get them as well
+    if not OPT_SKIP_RSYNC:
+        for addr in address_list:
+            nodename = NODESET.get_nodename_from_address(addr)
+            if nodename == param.NODENAME or nodename in param.NO_RSYNC:
+                continue
+
+            filename = rsync_filter(nodename)
+            if filename and param.GENERATION_STAMP:
+                synctool.generation.digest(_filter_signature(nodename),
+                                           filename)
+            if filename and OPT_BUNDLE:
+                synctool.bundle.bundle(_filter_signature(nodename), filename)
+            elif filename and param.RSYNC_BATCH:
+                rsync_batch(nodename)
+
+    results = synctool.fanout.do(_make_job, address_list)
+    remove_batches()
+    remove_filters()
+
+    return [NODESET.get_nodename_from_address(addr)
+            for addr, exitcode in zip(address_list, results)
+            if exitcode not in (0, None)]
+
+
+def relay_nodes(address_list):
+    '''divide the nodes over the relays
+    Returns tuple: list of addresses to contact,
+    dict of relayed nodenames by address of the slave
+    '''
+
+    # the slaves that are not ignored
+    relays = []
+    for slave, groups in param.RELAYS:
+        if set(config.get_groups(slave)) & param.IGNORE_GROUPS:
+            verbose('relay %s is ignored' % slave)
+            continue
+
+        relays.append((slave, set(groups)))
+
+    direct = []
+    # by_slave[slave] = list of nodenames
+    by_slave = {}
+    for addr in address_list:
+        nodename = NODESET.get_nodename_from_address(addr)
+        groups = set(config.get_groups(nodename))
+
+        for slave, relay_groups in relays:
+            if nodename != slave and groups & relay_groups:
+                by_slave.setdefault(slave, []).append(nodename)
+                break
+        else:
+            direct.append(addr)
+
+    relayed = {}
+    relay_addrs = []
+    for slave, _ in relays:
+        if slave not in by_slave:
+            continue
+
+        addr = config.get_node_ipaddress(slave)
+        NODESET.namemap[addr] = slave
+        nodes = by_slave[slave]
+        if addr in direct:
+            # the relay runs synctool on itself as well
+            direct.remove(addr)
+            nodes.append(slave)
+
+        relayed[addr] = nodes
+        relay_addrs.append(addr)
+        verbose('relay %s syncs %d nodes' % (slave, len(nodes)))
+
+    # start the relays first; they take the longest
+    return relay_addrs + direct, relayed
+
+
+def synctool_job(addr):
+    '''make job: rsync of ROOTDIR to the node and ssh+synctool
+    Returns Job, or None on error
+    '''
 
     nodename = NODESET.get_nodename_from_address(addr)
 
     if nodename == param.NODENAME:
-        run_local_synctool()
-        return
+        return local_synctool_job()
 
-    # use ssh connection multiplexing (if possible)
-    use_multiplex = synctool.multiplex.use_mux(nodename)
+    job = synctool.fanout.Job(nodename)
+
+    ssh_cmd_arr = _ssh_cmd(nodename)
+
+    if not _add_rsync_step(job, addr, ssh_cmd_arr):
+        # error message already printed
+        return None
+
+    # run 'ssh node synctool_cmd'
+    cmd_arr = ssh_cmd_arr[:]
+    cmd_arr.append('--')
+    cmd_arr.append(addr)
+    cmd_arr.extend(shlex.split(param.SYNCTOOL_CMD))
+    cmd_arr.append('--nodename=%s' % nodename)
+    # older clients do not know option --stats; only ask nodes
+    # that get synctool itself synced along with the repository
+    if OPT_STATS and not OPT_SKIP_RSYNC and nodename not in param.NO_RSYNC:
+        cmd_arr.append('--stats')
+    cmd_arr.extend(PASS_ARGS)
+
+    job.add_step(cmd_arr, 'running synctool on node %s' % nodename,
+                 timeout=param.EXEC_TIMEOUT, phase='synctool')
+    return job
+
+
+def relay_job(addr, nodes):
+    '''make job: rsync of ROOTDIR to the slave node and
+    ssh+synctool on the slave, which runs synctool for nodes
+    Returns Job, or None on error
+    '''
+
+    slave = NODESET.get_nodename_from_address(addr)
+
+    job = RelayJob(slave, nodes)
+
+    ssh_cmd_arr = _ssh_cmd(slave)
+
+    # the slave gets a copy of the entire tree
+    if not _add_rsync_step(job, addr, ssh_cmd_arr):
+        # error message already printed
+        return None
+
+    # run 'ssh slave synctool --relay=slave --node=nodes'
+    cmd_arr = ssh_cmd_arr[:]
+    cmd_arr.append('--')
+    cmd_arr.append(addr)
+    cmd_arr.append(os.path.join(param.ROOTDIR, 'bin', 'synctool'))
+    cmd_arr.append('--relay=%s' % slave)
+    cmd_arr.append('--node=%s' % synctool.range.compress(nodes))
+    cmd_arr.extend(RELAY_ARGS)
+
+    # Note: no timeout here; the relay applies the timeouts per node
+    job.add_step(cmd_arr, 'relaying synctool through node %s' % slave,
+                 phase='relay')
+    return job
+
+
+class RelayJob(synctool.fanout.Job):
+    '''job that runs synctool on a slave node, which
+    in turn runs synctool on other nodes
+    '''
+
+    def __init__(self, nodename, nodes):
+        '''initialize instance'''
+
+        super(RelayJob, self).__init__(nodename)
+        self.nodes = set(nodes)
+        self.nodes.add(nodename)
+
+    def output(self, line):
+        '''pass on output of the relayed nodes'''
+
+        # the slave already prepended the nodename
+        if line[:15] == '%synctool-log% ':
+            arr = line[15:].split(': ', 1)
+            if len(arr) == 2 and arr[0] in self.nodes:
+                self.emit((synctool.output.LOG, arr[0], arr[1]))
+                return
+
+        elif line[:synctool.report.PREFIX_LEN] == synctool.report.PREFIX:
+            arr = line[synctool.report.PREFIX_LEN:].split(': ', 1)
+            if len(arr) == 2 and arr[0] in self.nodes:
+                for rec in synctool.report.parse(arr[0], arr[1]):
+                    self.emit(rec)
+                return
+
+        else:
+            arr = line.split(':', 1)
+            if len(arr) == 2 and arr[0] in self.nodes:
+                text = arr[1]
+                if text[:1] == ' ':
+                    text = text[1:]
+                self.emit((synctool.output.OUT, arr[0], text))
+                return
+
+        # this is output of ssh, or of the slave itself
+        super(RelayJob, self).output(line)
+
+
+def _ssh_cmd(nodename):
+    '''Returns ssh command (array) to use for nodename'''
 
     ssh_cmd_arr = shlex.split(param.SSH_CMD)
-    if use_multiplex:
+
+    # use ssh connection multiplexing (if possible)
+    if synctool.multiplex.use_mux(nodename):
         synctool.multiplex.ssh_args(ssh_cmd_arr, nodename)
 
-    # rsync ROOTDIR/dirs/ to the node
-    # if "it wants it"
-    if not (OPT_SKIP_RSYNC or nodename in param.NO_RSYNC):
-        verbose('running rsync $SYNCTOOL/ to node %s' % nodename)
+    return ssh_cmd_arr
 
-        # make rsync filter to include the correct dirs
-        tmp_filename = rsync_include_filter(nodename)
 
-        cmd_arr = shlex.split(param.RSYNC_CMD)
-        cmd_arr.append('--filter=. %s' % tmp_filename)
+def _add_rsync_step(job, addr, ssh_cmd_arr):
+    '''add step to job: rsync ROOTDIR/dirs/ to the node
+    if "it wants it"
+    Returns False on error
+    '''
 
-        # add "-e ssh_cmd" to rsync command
-        cmd_arr.extend(['-e', ' '.join(ssh_cmd_arr)])
+    nodename = job.nodename
+    if OPT_SKIP_RSYNC or nodename in param.NO_RSYNC:
+        return True
 
+    # make rsync filter to include the correct dirs
+    # (the file is shared, and deleted by remove_filters())
+    tmp_filename = rsync_filter(nodename)
+    if not tmp_filename:
+        # error message already printed
+        return False
+
+    # skip the rsync when the node already has this generation
+    stamp = None
+    if param.GENERATION_STAMP:
+        stamp = synctool.generation.digest(_filter_signature(nodename),
+                                           tmp_filename)
+        cmd_arr = ssh_cmd_arr[:]
         cmd_arr.append('--')
-        cmd_arr.append('%s/' % param.ROOTDIR)
-        cmd_arr.append('%s:%s/' % (addr, param.ROOTDIR))
-
-        # double check the rsync destination
-        # our filters are like playing with fire
-        if not param.ROOTDIR or (param.ROOTDIR == os.sep):
-            warning('cowardly refusing to rsync with rootdir == %s' %
-                    param.ROOTDIR)
-            sys.exit(-1)
+        cmd_arr.append(addr)
+        cmd_arr.extend(synctool.generation.check_cmd(stamp))
+        job.add_step(cmd_arr, 'checking generation on node %s' % nodename,
+                     timeout=param.RSYNC_TIMEOUT, phase='generation',
+                     check=True)
+
+    # double check the rsync destination
+    # our filters are like playing with fire
+    if not param.ROOTDIR or (param.ROOTDIR == os.sep):
+        warning('cowardly refusing to rsync with rootdir == %s' %
+                param.ROOTDIR)
+        sys.exit(-1)
 
-        synctool.lib.run_with_nodename(cmd_arr, nodename)
+    if stamp is None:
+        when = None
+    else:
+        # the check failed, or the batch could not be applied
+        when = 'failed'
 
-        # delete temp file
-        try:
-            os.unlink(tmp_filename)
-        except OSError:
-            # silently ignore unlink error
-            pass
+    if OPT_BUNDLE:
+        if not _add_bundle_step(job, addr, ssh_cmd_arr, tmp_filename, when):
+            # error message already printed
+            return False
 
-    # run 'ssh node synctool_cmd'
+        # the bundle could not be swapped in; rsync after all
+        when = 'failed'
+
+    _add_rsync_steps(job, addr, ssh_cmd_arr, tmp_filename, when)
+
+    if stamp is None:
+        return True
+
+    # the transfer went well; the node has this generation now
     cmd_arr = ssh_cmd_arr[:]
     cmd_arr.append('--')
     cmd_arr.append(addr)
-    cmd_arr.extend(shlex.split(param.SYNCTOOL_CMD))
-    cmd_arr.append('--nodename=%s' % nodename)
+    cmd_arr.extend(synctool.generation.stamp_cmd(stamp))
+    job.add_step(cmd_arr, 'stamping generation on node %s' % nodename,
+                 timeout=param.RSYNC_TIMEOUT, phase='generation', when='ok')
+    return True
+
+
+def _add_rsync_steps(job, addr, ssh_cmd_arr, tmp_filename, when):
+    '''add steps to job: apply rsync batch (if any) and
+    rsync ROOTDIR/dirs/ to the node
+    when is the condition to run rsync (see Job.add_step())
+    '''
+
+    nodename = job.nodename
+
+    # apply the batch when the node has the generation it was made for
+    batch = None
+    if param.RSYNC_BATCH:
+        batch = rsync_batch(nodename)
+    if batch is not None:
+        batch_filename, prev_stamp = batch
+        cmd_arr = ssh_cmd_arr[:]
+        cmd_arr.append('--')
+        cmd_arr.append(addr)
+        cmd_arr.extend(synctool.generation.check_cmd(prev_stamp))
+        cmd_arr.append('&&')
+        cmd_arr.extend(_read_batch_cmd(tmp_filename))
+        job.add_step(cmd_arr, 'applying rsync batch to node %s' % nodename,
+                     timeout=param.RSYNC_TIMEOUT, phase='batch',
+                     when='failed', stdin=batch_filename)
+
+    cmd_arr = shlex.split(param.RSYNC_CMD)
+    cmd_arr.append('--filter=. %s' % tmp_filename)
+
+    # add "-e ssh_cmd" to rsync command
+    cmd_arr.extend(['-e', ' '.join(ssh_cmd_arr)])
+
+    cmd_arr.append('--')
+    cmd_arr.append('%s/' % param.ROOTDIR)
+    cmd_arr.append('%s:%s/' % (addr, param.ROOTDIR))
+
+    if batch is not None:
+        # the batch could not be applied
+        when = 'failed'
+
+    job.add_step(cmd_arr, 'running rsync $SYNCTOOL/ to node %s' % nodename,
+                 timeout=param.RSYNC_TIMEOUT, phase='rsync', when=when)
+
+
+def _add_bundle_step(job, addr, ssh_cmd_arr, tmp_filename, when):
+    '''add step to job: unpack bundle of ROOTDIR/dirs/ on the node
+    when is the condition to run it (see Job.add_step())
+    Returns False on error
+    '''
+
+    filename = synctool.bundle.bundle(_filter_signature(job.nodename),
+                                      tmp_filename)
+    if not filename:
+        # error message already printed
+        return False
+
+    cmd_arr = ssh_cmd_arr[:]
+    cmd_arr.append('--')
+    cmd_arr.append(addr)
+    cmd_arr.append(synctool.bundle.unpack_cmd())
+    job.add_step(cmd_arr, 'unpacking bundle on node %s' % job.nodename,
+                 timeout=param.RSYNC_TIMEOUT, phase='bundle', when=when,
+                 stdin=filename)
+    return True
+
+
+def local_synctool_job():
+    '''make job: run synctool on the master node itself'''
+
+    job = synctool.fanout.Job(param.NODENAME)
+
+    cmd_arr = shlex.split(param.SYNCTOOL_CMD)
+    cmd_arr.append('--nodename=%s' % param.NODENAME)
+    if OPT_STATS:
+        cmd_arr.append('--stats')
     cmd_arr.extend(PASS_ARGS)
 
-    verbose('running synctool on node %s' % nodename)
-    synctool.lib.run_with_nodename(cmd_arr, nodename)
+    job.add_step(cmd_arr, 'running synctool on node %s' % param.NODENAME,
+                 timeout=param.EXEC_TIMEOUT, phase='synctool')
+    return job
+
+
+def rsync_filter(nodename):
+    '''Returns filename of file with rsync filter rules for nodename,
+    or None on error
+    Include only those dirs that apply for this node
+    Nodes that have the same group dirs share the same filter file
+    '''
+
+    signature = _filter_signature(nodename)
+    if signature not in FILTERS:
+        FILTERS[signature] = _make_filter_file(signature)
+
+    return FILTERS[signature]
 
 
-def run_local_synctool():
-    '''run synctool on the master node itself'''
+def _filter_signature(nodename):
+    '''Returns tuple of groups of nodename that have a group dir
+    in the overlay, delete, or purge dir (in order of importance),
+    or None for slave nodes, which get a copy of the entire tree
+    '''
+
+    global FILTER_GROUPS
+
+    if nodename in param.SLAVES:
+        return None
 
-    cmd_arr = shlex.split(param.SYNCTOOL_CMD) + PASS_ARGS
+    if FILTER_GROUPS is None:
+        FILTER_GROUPS = set()
+        for d in (param.OVERLAY_DIR, param.DELETE_DIR, param.PURGE_DIR):
+            FILTER_GROUPS |= set(os.listdir(d))
 
-    verbose('running synctool on node %s' % param.NODENAME)
-    synctool.lib.run_with_nodename(cmd_arr, param.NODENAME)
+    return tuple([g for g in config.get_groups(nodename)
+                  if g in FILTER_GROUPS])
 
 
-def rsync_include_filter(nodename):
+def _make_filter_file(signature):
     '''create temp file with rsync filter rules
-    Include only those dirs that apply for this node
-    Returns filename of the filter file
+    for nodes with the given group signature
+    Returns filename of the filter file, or None on error
     '''
 
+    if signature is None:
+        rules = ''
+    else:
+        rules = _group_filter_rules(signature)
+        if rules is None:
+            # error message already printed
+            return None
+
     try:
         (fd, filename) = tempfile.mkstemp(prefix='synctool-',
                                           dir=param.TEMP_DIR)
     except OSError as err:
         error('failed to create temp file: %s' % err.strerror)
-        sys.exit(-1)
+        return None
 
     try:
         f = os.fdopen(fd, 'w')
     except OSError as err:
         error('failed to open temp file: %s' % err.strerror)
-        sys.exit(-1)
+        return None
 
     # include $SYNCTOOL/var/ but exclude
     # the top overlay/ and delete/ dir
     with f:
-        f.write('# synctool rsync filter')
-
-        # set mygroups for this nodename
-        param.NODENAME = nodename
-        param.MY_GROUPS = config.get_my_groups()
-
-        # slave nodes get a copy of the entire tree
-        # all other nodes use a specific rsync filter
-        if nodename not in param.SLAVES:
-            if not (_write_overlay_filter(f) and
-                    _write_delete_filter(f) and
-                    _write_purge_filter(f)):
-                # an error occurred;
-                # delete temp file and exit
-                f.close()
-                try:
-                    os.unlink(filename)
-                except OSError:
-                    # silently ignore unlink error
-                    pass
+        f.write('# synctool rsync filter\n')
 
-                sys.exit(-1)
+        # the state of the master node is not synced, and
+        # the node's own state is not deleted
+        f.write('H /var/state/\n'
+                'P /var/state/\n')
+
+        f.write(rules)
 
         # Note: sbin/*.pyc is excluded to keep major differences in
         # Python versions (on master vs. client node) from clashing
@@ -177,11 +617,224 @@ def rsync_include_filter(nodename):
                 '- /lib/synctool/*.pyc\n'
                 '- /lib/synctool/pkg/*.pyc\n')
 
-    # Note: remind to delete the temp file later
+    # Note: remind to delete the temp file later (see remove_filters())
 
     return filename
 
 
+def _group_filter_rules(signature):
+    '''Returns rsync filter rules for the group dirs in signature,
+    or None on error
+    The rules are kept between runs for as long as
+    the overlay, delete, and purge dirs do not change
+    '''
+
+    global FILTER_CACHE
+
+    if FILTER_CACHE is None:
+        FILTER_CACHE = synctool.state.load(FILTER_STATE)
+        if FILTER_CACHE.get('mtimes') != _filter_mtimes():
+            FILTER_CACHE = {'mtimes': _filter_mtimes(), 'rules': {}}
+
+    key = ' '.join(signature)
+    if key in FILTER_CACHE['rules']:
+        return FILTER_CACHE['rules'][key]
+
+    f = cStringIO.StringIO()
+
+    # the _write_xxx_filter() functions work with MY_GROUPS
+    # (restore them afterwards; this runs in the master process itself)
+    saved_groups = param.MY_GROUPS
+    param.MY_GROUPS = list(signature)
+
+    ok = (_write_overlay_filter(f) and
+          _write_delete_filter(f) and
+          _write_purge_filter(f))
+
+    param.MY_GROUPS = saved_groups
+
+    if not ok:
+        # an error occurred
+        return None
+
+    rules = f.getvalue()
+    FILTER_CACHE['rules'][key] = rules
+    FILTER_CACHE['changed'] = True
+    return rules
+
+
+def _filter_mtimes():
+    '''Returns list of [path, mtime] of the dirs that the
+    rsync filter rules depend on
+    '''
+
+    dirs = [param.OVERLAY_DIR, param.DELETE_DIR, param.PURGE_DIR]
+    for g in sorted(os.listdir(param.PURGE_DIR)):
+        dirs.append(os.path.join(param.PURGE_DIR, g))
+
+    mtimes = []
+    for d in dirs:
+        try:
+            mtimes.append([d, os.stat(d).st_mtime])
+        except OSError:
+            # it will not be in the rules
+            pass
+
+    return mtimes
+
+
+def rsync_batch(nodename):
+    '''Returns tuple: filename of rsync batch file for nodename,
+    generation stamp that the node must have to apply it
+    Returns None when there is no batch for the node
+    '''
+
+    signature = _filter_signature(nodename)
+    if signature not in BATCHES:
+        BATCHES[signature] = _write_batch(signature, rsync_filter(nodename))
+
+    return BATCHES[signature]
+
+
+def _write_batch(signature, filter_file):
+    '''rsync the repository to the mirror of what nodes with signature
+    have, and record the changes in a batch file
+    Returns tuple: filename of the batch file, generation stamp
+    that the mirror had; or None when there is no batch
+    '''
+
+    global MIRRORS
+
+    if not filter_file:
+        # error message already printed
+        return None
+
+    if MIRRORS is None:
+        MIRRORS = synctool.state.load(MIRROR_STATE)
+
+    name = synctool.generation.signature_name(signature)
+    mirror = os.path.join(param.STATE_DIR, MIRROR_DIR, name)
+
+    stamp = synctool.generation.digest(signature, filter_file)
+    prev_stamp = MIRRORS.get(name)
+    if prev_stamp == stamp:
+        # nothing changed; the nodes only need the check
+        return None
+
+    if not os.path.isdir(mirror):
+        try:
+            os.makedirs(mirror, 0700)
+        except OSError as err:
+            error('failed to create directory %s: %s' % (mirror,
+                                                         err.strerror))
+            return None
+
+    try:
+        (fd, filename) = tempfile.mkstemp(prefix='synctool-batch-',
+                                          dir=param.TEMP_DIR)
+    except OSError as err:
+        error('failed to create temp file: %s' % err.strerror)
+        return None
+
+    os.close(fd)
+
+    cmd_arr = shlex.split(param.RSYNC_CMD)
+    cmd_arr.append('--filter=. %s' % filter_file)
+    cmd_arr.append('--write-batch=%s' % filename)
+    cmd_arr.append('--')
+    cmd_arr.append('%s/' % param.ROOTDIR)
+    cmd_arr.append('%s/' % mirror)
+
+    # until it is done, it is not known what the mirror holds
+    MIRRORS.pop(name, None)
+    synctool.state.save(MIRROR_STATE, MIRRORS)
+
+    verbose('writing rsync batch for mirror %s' % name)
+    if synctool.lib.exec_command(cmd_arr) != 0:
+        error('failed to write rsync batch for mirror %s' % name)
+        # the mirror is of no use anymore
+        shutil.rmtree(mirror, ignore_errors=True)
+        _remove_batch(filename)
+        return None
+
+    MIRRORS[name] = stamp
+    synctool.state.save(MIRROR_STATE, MIRRORS)
+
+    if prev_stamp is None:
+        # the mirror was new; the batch holds the entire tree,
+        # but no node is known to have the old generation
+        _remove_batch(filename)
+        return None
+
+    return (filename, prev_stamp)
+
+
+def _read_batch_cmd(filter_file):
+    '''Returns remote command (array) that applies an rsync batch
+    from stdin to the repository on the node
+    '''
+
+    cmd_arr = shlex.split(param.RSYNC_CMD)
+    cmd_arr[0] = 'rsync'
+    cmd_arr.append('--read-batch=-')
+
+    # the filter rules are not in the batch
+    # (they protect the state dir of the node)
+    with open(filter_file) as f:
+        for line in f:
+            line = line.strip()
+            if line and line[0] != '#':
+                cmd_arr.append('--filter=%s' % line)
+
+    cmd_arr.append('--')
+    cmd_arr.append('%s/' % param.ROOTDIR)
+    return [pipes.quote(x) for x in cmd_arr]
+
+
+def _remove_batch(filename):
+    '''delete rsync batch file, and the shell script
+    that rsync writes along with it
+    '''
+
+    for name in (filename, filename + '.sh'):
+        try:
+            os.unlink(name)
+        except OSError:
+            # silently ignore unlink error
+            pass
+
+
+def remove_batches():
+    '''delete the rsync batch files'''
+
+    for batch in BATCHES.values():
+        if batch is not None:
+            _remove_batch(batch[0])
+
+    BATCHES.clear()
+
+
+def remove_filters():
+    '''delete the rsync filter files,
+    and save the filter rules for the next run
+    '''
+
+    for filename in FILTERS.values():
+        if filename is None:
+            continue
+
+        try:
+            os.unlink(filename)
+        except OSError:
+            # silently ignore unlink error
+            pass
+
+    FILTERS.clear()
+
+    if FILTER_CACHE is not None and FILTER_CACHE.pop('changed', False):
+        synctool.state.save(FILTER_STATE, FILTER_CACHE)
+
+
 def _write_rsync_filter(f, overlaydir, label):
     '''helper function for writing rsync filter'''
 
@@ -418,6 +1071,10 @@ def usage():
       --color                 Use colored output (only for terse mode)
       --no-color              Do not color output
   -S, --skip-rsync            Do not sync the repository
+  -W, --waves=LIST            Update nodes in waves of these sizes
+      --error-budget=NUM      Abort waves when more nodes fail
+      --resume                Skip nodes that completed in the last run
+      --bundle                Sync the repository as a compressed bundle
       --version               Show current version number
       --check-update          Check for availibility of newer version
       --download              Download latest version
@@ -425,6 +1082,12 @@ def usage():
   -v, --verbose               Be verbose
   -q, --quiet                 Suppress informational startup messages
   -a, --aggregate             Condense output; list nodes per change
+      --grouped               Show output per node, when the node is done
+      --output-dir=DIR        Write output of every node to DIR/nodename
+      --report=FILE           Write report of the run in JSON format
+      --history=QUERY         Show run history: runs, changes, times,
+                              or the changes made to a file
+      --since=TIME            Limit history to the last TIME, like 1w
   -f, --fix                   Perform updates (otherwise, do dry-run)
 
 Note that synctool does a dry run unless you specify --fix
@@ -435,9 +1098,10 @@ Written by Walter de Jong <walter@heiho.net> (c) 2003-2015'''
 def get_options():
     '''parse command-line options'''
 
-    global PASS_ARGS, OPT_SKIP_RSYNC, OPT_AGGREGATE
-    global OPT_CHECK_UPDATE, OPT_DOWNLOAD, MASTER_OPTS
-    global UPLOAD_FILE
+    global PASS_ARGS, OPT_SKIP_RSYNC
+    global OPT_CHECK_UPDATE, OPT_DOWNLOAD
+    global UPLOAD_FILE, OPT_RELAY, RELAY_ARGS, OPT_WAVES, OPT_ERROR_BUDGET
+    global OPT_HISTORY, OPT_SINCE, OPT_RESUME, OPT_BUNDLE, OPT_STATS
 
     # check for typo's on the command-line;
     # things like "-diff" will trigger "-f" => "--fix"
@@ -445,7 +1109,7 @@ def get_options():
 
     try:
         opts, args = getopt.getopt(sys.argv[1:],
-                                   'hc:vn:g:x:X:d:1:r:u:s:o:p:efN:FTqaS',
+                                   'hc:vn:g:x:X:d:1:r:u:s:o:p:efN:FTqaSW:',
                                    ['help', 'conf=', 'verbose', 'node=',
                                     'group=', 'exclude=', 'exclude-group=',
                                     'diff=', 'single=', 'ref=', 'upload=',
@@ -454,7 +1118,11 @@ def get_options():
                                     'numproc=', 'fullpath', 'terse', 'color',
                                     'no-color', 'quiet', 'aggregate', 'unix',
                                     'skip-rsync', 'version', 'check-update',
-                                    'download'])
+                                    'download', 'relay=', 'waves=',
+                                    'error-budget=', 'grouped',
+                                    'output-dir=', 'report=', 'stats',
+                                    'history=', 'since=', 'resume',
+                                    'bundle'])
     except getopt.GetoptError as reason:
         print '%s: %s' % (PROGNAME, reason)
 #        usage()
@@ -479,7 +1147,6 @@ def get_options():
     opt_group = False
 
     PASS_ARGS = []
-    MASTER_OPTS = [sys.argv[0],]
 
     # first read the config file
     for opt, arg in opts:
@@ -530,12 +1197,6 @@ def get_options():
     # others are not. Therefore some 'continue', while others don't
 
     for opt, arg in opts:
-        if opt:
-            MASTER_OPTS.append(opt)
-
-        if arg:
-            MASTER_OPTS.append(arg)
-
         if opt in ('-h', '--help', '-?', '-c', '--conf', '--version'):
             # already done
             continue
@@ -617,6 +1278,9 @@ def get_options():
                 print 'invalid value for numproc'
                 sys.exit(1)
 
+            # a fixed number overrides 'num_proc auto'
+            param.NUM_PROC_AUTO = False
+
             continue
 
         if opt in ('-F', '--fullpath'):
@@ -634,7 +1298,43 @@ def get_options():
             param.COLORIZE = False
 
         if opt in ('-a', '--aggregate'):
-            OPT_AGGREGATE = True
+            synctool.output.MODE = 'aggregate'
+            continue
+
+        if opt == '--grouped':
+            synctool.output.MODE = 'grouped'
+            continue
+
+        if opt == '--output-dir':
+            synctool.output.check_output_dir(arg)
+            synctool.output.OUTPUT_DIR = arg
+            continue
+
+        if opt == '--report':
+            synctool.report.REPORT = synctool.report.Report(PROGNAME, arg)
+            continue
+
+        if opt == '--history':
+            if (arg not in ('runs', 'changes', 'times') and
+                    arg[:1] != os.sep):
+                print ("option '%s' requires 'runs', 'changes', 'times', "
+                       "or a full path" % opt)
+                sys.exit(1)
+
+            OPT_HISTORY = arg
+            continue
+
+        if opt == '--since':
+            OPT_SINCE = synctool.history.parse_since(arg)
+            if OPT_SINCE is None:
+                print "option '%s' requires a time like '1w' or '12h'" % opt
+                sys.exit(1)
+            continue
+
+        if opt == '--stats':
+            # used by the master to have a relay pass on
+            # the results of its nodes
+            synctool.report.FORWARD = True
             continue
 
         if opt == '--unix':
@@ -652,6 +1352,33 @@ def get_options():
             OPT_DOWNLOAD = True
             continue
 
+        if opt in ('-W', '--waves'):
+            OPT_WAVES = [x.strip() for x in arg.split(',') if x.strip()]
+            for size in OPT_WAVES:
+                _check_count_or_percentage(opt, size)
+            continue
+
+        if opt == '--error-budget':
+            _check_count_or_percentage(opt, arg)
+            OPT_ERROR_BUDGET = arg
+            continue
+
+        if opt == '--resume':
+            OPT_RESUME = True
+            continue
+
+        if opt == '--bundle':
+            OPT_BUNDLE = True
+            continue
+
+        if opt == '--relay':
+            # the master tells the slave what its nodename is
+            OPT_RELAY = True
+            param.NODENAME = arg
+            # pass log lines on to the master node
+            synctool.lib.MASTERLOG = True
+            continue
+
         if opt:
             PASS_ARGS.append(opt)
 
@@ -672,6 +1399,22 @@ def get_options():
         print 'option --overlay must be used in conjunction with --upload'
         sys.exit(1)
 
+    if OPT_SINCE is not None and not OPT_HISTORY:
+        print 'option --since must be used in conjunction with --history'
+        sys.exit(1)
+
+    if OPT_RESUME and not opt_fix:
+        print 'option --resume must be used in conjunction with --fix'
+        sys.exit(1)
+
+    if OPT_BUNDLE and OPT_SKIP_RSYNC:
+        print 'options --bundle and --skip-rsync can not be combined'
+        sys.exit(1)
+
+    if OPT_ERROR_BUDGET != '0' and not OPT_WAVES:
+        print 'option --error-budget must be used in conjunction with --waves'
+        sys.exit(1)
+
     if opt_purge:
         if not opt_upload:
             print 'option --purge must be used in conjunction with --upload'
@@ -685,17 +1428,83 @@ def get_options():
             print 'option --suffix and --purge can not be combined'
             sys.exit(1)
 
+    # a relay runs with the same options, on the nodes given by the master
+    RELAY_ARGS = PASS_ARGS[:]
+    if OPT_SKIP_RSYNC:
+        RELAY_ARGS.append('--skip-rsync')
+
     # enable logging at the master node
     PASS_ARGS.append('--masterlog')
 
+    if (synctool.report.REPORT is not None or param.RUN_HISTORY or
+            synctool.report.FORWARD):
+        # have the nodes report what they did
+        OPT_STATS = True
+        RELAY_ARGS.append('--stats')
+
+    elif not synctool.lib.DRY_RUN:
+        # the journal needs to know when relayed nodes are done;
+        # it does not need the nodes to report, as the master
+        # itself sees when they are done
+        RELAY_ARGS.append('--stats')
+
     if args != None:
-        MASTER_OPTS.extend(args)
         PASS_ARGS.extend(args)
+        RELAY_ARGS.extend(args)
 
     option_combinations(opt_diff, opt_single, opt_reference, opt_erase_saved,
                         opt_upload, opt_fix, opt_group)
 
 
+def resume(address_list):
+    '''leave out the nodes that completed in the last run
+    Returns list of addresses of nodes that are left to do
+    Exits the program when there are none
+    '''
+
+    done = synctool.journal.load()
+    if done is None:
+        # error message already printed
+        sys.exit(-1)
+
+    todo = [addr for addr in address_list
+            if NODESET.get_nodename_from_address(addr) not in done]
+
+    skipped = len(address_list) - len(todo)
+    if not todo:
+        if not synctool.lib.QUIET:
+            stdout('resuming: all %d nodes completed in the last run' %
+                   skipped)
+        sys.exit(0)
+
+    if not synctool.lib.QUIET:
+        stdout('resuming: skipping %d nodes that completed in the last run' %
+               skipped)
+    return todo
+
+
+def show_history():
+    '''answer query of the run history
+    Exits the program
+    '''
+
+    nodes = None
+    if NODESET.nodelist or NODESET.grouplist:
+        address_list = NODESET.addresses()
+        if not address_list:
+            print 'no valid nodes specified'
+            sys.exit(1)
+
+        nodes = [NODESET.get_nodename_from_address(addr)
+                 for addr in address_list]
+
+    if not synctool.history.query(OPT_HISTORY, OPT_SINCE, nodes):
+        # error message already printed
+        sys.exit(-1)
+
+    sys.exit(0)
+
+
 @catch_signals
 def main():
     '''run the program'''
@@ -725,19 +1534,23 @@ def main():
 
         sys.exit(0)
 
-    if OPT_AGGREGATE:
-        if not synctool.aggr.run(MASTER_OPTS):
-            sys.exit(-1)
-
-        sys.exit(0)
-
     config.init_mynodename()
 
-    if param.MASTER != param.HOSTNAME:
+    if OPT_RELAY:
+        # the master node has us run synctool on its behalf
+        if param.NODENAME not in param.SLAVES:
+            error('option --relay can only be used on a slave node')
+            sys.exit(-1)
+
+    elif param.MASTER != param.HOSTNAME:
         verbose('master %s != hostname %s' % (param.MASTER, param.HOSTNAME))
         error('not running on the master node')
         sys.exit(-1)
 
+    if OPT_HISTORY:
+        show_history()
+        # not reached
+
     if not _check_valid_overlaydirs():
         # error message already printed
         sys.exit(-1)
@@ -749,6 +1562,7 @@ def main():
         print 'no valid nodes specified'
         sys.exit(1)
 
+    ok = True
     if UPLOAD_FILE.filename:
         # upload a file
         if len(address_list) != 1:
@@ -763,7 +1577,10 @@ def main():
     else:
         # do regular synctool run
         # first print message about DRY RUN
-        if not synctool.lib.QUIET:
+        # (a relay leaves this to the master node)
+        if OPT_RELAY:
+            pass
+        elif not synctool.lib.QUIET:
             if synctool.lib.DRY_RUN:
                 stdout('DRY RUN, not doing any updates')
                 terse(synctool.lib.TERSE_DRYRUN, 'not doing any updates')
@@ -776,9 +1593,39 @@ def main():
             else:
                 verbose('--fix specified, applying changes')
 
+        if OPT_RESUME:
+            address_list = resume(address_list)
+
+        if not synctool.lib.DRY_RUN and not OPT_RELAY:
+            if not synctool.journal.start(OPT_RESUME):
+                # error message already printed
+                sys.exit(-1)
+
+        if param.RUN_HISTORY and not OPT_RELAY:
+            synctool.history.HISTORY = synctool.history.History(PROGNAME)
+
         make_tempdir()
-        run_remote_synctool(address_list)
+        if OPT_WAVES:
+            ok = run_waves(address_list)
+        else:
+            failed = run_remote_synctool(address_list)
+            # a relay reports failure to the master node
+            ok = not (OPT_RELAY and failed)
+
+        synctool.journal.finish()
+        synctool.durations.save()
+
+        if synctool.history.HISTORY is not None:
+            synctool.history.HISTORY.dry_run = synctool.lib.DRY_RUN
+            synctool.history.HISTORY.save()
 
     synctool.lib.closelog()
 
+    if synctool.report.REPORT is not None:
+        synctool.report.REPORT.info['dry_run'] = synctool.lib.DRY_RUN
+        synctool.report.REPORT.write()
+
+    if not ok:
+        sys.exit(1)
+
 # EOB
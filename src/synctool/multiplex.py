@@ -23,6 +23,9 @@ import synctool.syncstat
 SSH_VERSION = None
 MATCH_SSH_VERSION = re.compile(r'^OpenSSH\_(\d+)\.(\d+)')
 
+# nodenames of which the master connection was checked in this run
+CHECKED = set()
+
 
 def _make_control_path(nodename):
     '''Returns a control pathname for nodename
@@ -68,13 +71,58 @@ def use_mux(nodename):
                     (control_path, statbuf.mode & 0777))
             return False
 
+        if _auto_mux() and not _is_alive(nodename):
+            # the master process is gone; ssh will start a new one
+            verbose('control path %s is stale' % control_path)
+            try:
+                os.unlink(control_path)
+            except OSError as err:
+                warning('failed to remove %s: %s' % (control_path,
+                                                     err.strerror))
+                return False
+
+            return True
+
         verbose('control path %s already exists' % control_path)
         return True
 
+    if _auto_mux():
+        verbose('ssh will start a master connection to %s' % nodename)
+        return True
+
     verbose('there is no ssh control path')
     return False
 
 
+def _auto_mux():
+    '''Returns True if ssh should start master connections on demand'''
+
+    if not synctool.param.SSH_MULTIPLEX:
+        return False
+
+    # the master must persist after the first command, which
+    # requires ControlPersist, which is in OpenSSH 5.6 and later
+    return (synctool.param.CONTROL_PERSIST != 'none' and
+            detect_ssh() >= 56)
+
+
+def _is_alive(nodename):
+    '''Returns True if the ssh master process for nodename is running
+    The master is asked with 'ssh -O check' once per run
+    '''
+
+    if nodename in CHECKED:
+        return True
+
+    # with the ControlPath given, ssh only talks to the master
+    # over the socket; the node itself is not contacted
+    if not control(nodename, nodename, 'check'):
+        return False
+
+    CHECKED.add(nodename)
+    return True
+
+
 def control(nodename, remote_addr, ctl_cmd):
     '''Tell the ssh mux process the ctl_cmd
     Returns True on success, False otherwise
@@ -114,6 +162,13 @@ def ssh_args(ssh_cmd_arr, nodename):
 
     ssh_cmd_arr.extend(['-o', 'ControlPath=' + control_path])
 
+    if _auto_mux():
+        # the first ssh to the node becomes the master, and
+        # following commands use its connection
+        ssh_cmd_arr.extend(['-o', 'ControlMaster=auto',
+                            '-o', 'ControlPersist=' +
+                            synctool.param.CONTROL_PERSIST])
+
 
 def setup_master(node_list, persist):
     '''setup master connections to all nodes in node_list
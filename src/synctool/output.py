@@ -0,0 +1,225 @@
+#
+#   synctool.output.py    WJ116
+#
+#   synctool Copyright 2015 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''render the output of commands that ran on many nodes
+
+Jobs (see module fanout) do not print their output themselves; they
+pass records to the Multiplexer in the master process. Records are tuples:
+
+    (OUT, nodename, line)
+    (LOG, nodename, message)
+    (DONE, nodename, exitcode, status, timings)
+    (REPORT, nodename, events)
+
+where timings is a list of (phase, seconds) for the commands of the job,
+and events is a dict of counts of changes made (see module report).
+The Multiplexer renders output lines in one of these modes:
+
+    prefix      print lines as they come in, prefixed with the nodename
+    grouped     print all lines of a node together once it is done
+    aggregate   print nodes that have the same output together, at the end
+    files       write the output of every node to OUTPUT_DIR/nodename
+'''
+
+import os
+import sys
+import errno
+
+import synctool.aggr
+import synctool.durations
+import synctool.health
+import synctool.history
+import synctool.journal
+import synctool.lib
+from synctool.lib import error
+import synctool.report
+
+# record types
+OUT = 'out'
+LOG = 'log'
+DONE = 'done'
+REPORT = 'report'
+
+# render mode; set by command-line options
+MODE = 'prefix'
+# when set, output goes into files in this directory
+OUTPUT_DIR = None
+
+
+class Multiplexer(object):
+    '''class that renders records of output'''
+
+    def __init__(self):
+        '''initialize instance'''
+
+        if OUTPUT_DIR is not None:
+            self.mode = 'files'
+        else:
+            self.mode = MODE
+
+        # buffered lines to print; written out by flush()
+        self.buf = []
+        # lines[nodename] = list of lines (for grouped mode)
+        self.lines = {}
+        # files[nodename] = open file, or None on error (for files mode)
+        self.files = {}
+        self.aggr = synctool.aggr.Aggregator()
+        # in aggregate mode, show progress while the nodes report
+        self.progress = None
+        if self.mode == 'aggregate':
+            self.progress = synctool.aggr.Progress()
+
+    def record(self, rec):
+        '''handle a record'''
+
+        kind = rec[0]
+        if kind == OUT:
+            self._output(rec[1], rec[2])
+
+        elif kind == LOG:
+            # keep log lines in order with the output
+            self.flush()
+            synctool.lib.log_with_nodename(rec[1], rec[2])
+            synctool.history.record(rec)
+
+        elif kind == DONE:
+            self._done(rec[1])
+            self._report(rec)
+            synctool.durations.record(rec)
+            synctool.journal.record(rec)
+            synctool.health.record(rec)
+
+        elif kind == REPORT:
+            self._report(rec)
+
+        else:
+            raise RuntimeError('bug: unknown output record %r' % (rec,))
+
+    def _report(self, rec):
+        '''pass record on for the run report and history'''
+
+        if synctool.report.FORWARD:
+            # it is printed; keep it in order with the output
+            self.flush()
+
+        synctool.report.record(rec)
+        synctool.history.record(rec)
+
+    def _output(self, nodename, line):
+        '''render line of output of nodename'''
+
+        if self.mode == 'aggregate':
+            # format like "node: line" is split on the colon,
+            # so the line starts with a space
+            self.aggr.add(nodename, ' ' + line)
+            return
+
+        if self.mode == 'files':
+            f = self._file(nodename)
+            if f is not None:
+                f.write(line + '\n')
+            return
+
+        if synctool.lib.OPT_NODENAME:
+            line = '%s: %s' % (nodename, line)
+
+        if self.mode == 'grouped':
+            if nodename not in self.lines:
+                self.lines[nodename] = [line,]
+            else:
+                self.lines[nodename].append(line)
+        else:
+            self.buf.append(line)
+
+    def _done(self, nodename):
+        '''nodename is done'''
+
+        if self.progress is not None:
+            self.progress.update(self.aggr.summary)
+
+        elif self.mode == 'grouped':
+            self.buf.extend(self.lines.pop(nodename, []))
+
+        elif self.mode == 'files':
+            # every node gets a file, even if it had no output
+            f = self._file(nodename)
+            if f is not None:
+                f.close()
+
+            self.files[nodename] = None
+
+    def _file(self, nodename):
+        '''Returns open file for output of nodename, or None on error'''
+
+        if nodename in self.files:
+            return self.files[nodename]
+
+        filename = os.path.join(OUTPUT_DIR, nodename)
+        try:
+            f = open(filename, 'w')
+        except IOError as err:
+            error('failed to write %s: %s' % (filename, err.strerror))
+            f = None
+
+        self.files[nodename] = f
+        return f
+
+    def flush(self):
+        '''write out buffered lines'''
+
+        if not self.buf:
+            return
+
+        if self.progress is not None:
+            self.progress.clear()
+
+        # a single write for all lines
+        sys.stdout.write('\n'.join(self.buf) + '\n')
+        self.buf = []
+
+    def finish(self):
+        '''all jobs are done; write out any remaining output'''
+
+        # relayed nodes do not send a DONE record
+        for nodename in sorted(self.lines.keys()):
+            self.buf.extend(self.lines.pop(nodename))
+
+        self.flush()
+
+        if self.progress is not None:
+            self.progress.clear()
+            self.aggr.show()
+
+        elif self.mode == 'files':
+            for f in self.files.values():
+                if f is not None:
+                    f.close()
+
+            self.files = {}
+
+
+def check_output_dir(dirname):
+    '''check that the output directory exists, or make it
+    Exits the program on error
+    '''
+
+    try:
+        os.makedirs(dirname)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            error('failed to create directory %s: %s' % (dirname,
+                                                         err.strerror))
+            sys.exit(-1)
+
+    if not os.path.isdir(dirname):
+        error('not a directory: %s' % dirname)
+        sys.exit(-1)
+
+# EOB
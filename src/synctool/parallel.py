@@ -12,74 +12,485 @@
 
 # This module offers the same as Python's multiprocessing
 # but there are some issues with multiprocessing, so ...
+#
+# The parent process hands out work one item at a time; a worker
+# asks for the next item as soon as it is done with the previous one.
+# This way a slow (or timing out) node only holds up a single worker
+# rather than the whole chunk of nodes that it happened to be in
+#
+# While working on an item, a worker may send messages to the parent
+# by calling message(); they are passed to the parent's on_message
+# callback as they come in
+#
+# When a worker dies while working on an item, the parent's on_lost
+# callback gives the result for the item instead. So it does for the
+# items that are left when no worker can be spawned at all
+#
+# The parent's on_result callback may have an item done over again,
+# after a delay. The item is put at the back of the queue, so no worker
+# sits waiting for it
+#
+# With GroupLimits, an item is only handed out when none of its groups
+# already has its maximum number of items in progress; items that have
+# to wait are passed over
 
 import os
 import sys
 import errno
 import time
+import heapq
+import select
+import socket
+import struct
+import collections
+import cPickle as pickle
 
-from synctool.lib import error
+from synctool import config
+from synctool.lib import verbose, error
 from synctool.main.wrapper import catch_signals
 import synctool.param
 
 ALL_PIDS = set()
 
+# in a worker process, the socket to the parent
+WORKER_SOCK = None
+# in a worker process, the number of work items that the parent
+# has in progress at once, as of when the current item was handed out
+SLOTS = 1
+
+# messages are prefixed with their length
+HEADER = struct.Struct('!I')
+
 
-def do(func, work):
-    '''run func in parallel'''
+def do(func, work, on_message=None, flush=None, on_result=None,
+       group_limits=None, on_lost=None):
+    '''run func in parallel
+    on_message(obj) is called for messages sent by the workers
+    flush() is called before waiting for the workers
+    on_result(idx, result) is called for every result; it may return
+    a number of seconds after which to run func for the item again
+    on_lost(idx) is called when the worker died while working on item idx,
+    or when no worker could be spawned for it; it returns the result
+    for the item
+    group_limits is a GroupLimits instance for the work items
+    Returns list of results (the return values of func)
+    in the same order as work
+    '''
 
     if synctool.param.SLEEP_TIME != 0:
         synctool.param.NUM_PROC = 1
 
-    # 'part' becomes amount of work for each rank to do
     len_work = len(work)
-    if len_work <= synctool.param.NUM_PROC:
-        num_proc = len_work
-        part = 1
-    else:
-        num_proc = synctool.param.NUM_PROC
-        part = len_work / num_proc
-        if len_work % num_proc != 0:
-            part += 1
-
-    # spawn pool of workers
-    for rank in xrange(num_proc):
+    results = [None] * len_work
+    if not len_work:
+        return results
+
+    control = Concurrency()
+    if group_limits is None:
+        group_limits = GroupLimits([])
+
+    # workers[sock] = index of the work item the worker is working on
+    workers = {}
+    # started[sock] = time at which the work item was handed out
+    started = {}
+    queue = collections.deque(xrange(len_work))
+    # heap of (time, index) of items to do again
+    delayed = []
+    rank = 0
+    can_spawn = True
+
+    def _result(idx, result):
+        '''work item idx is done'''
+
+        results[idx] = result
+        group_limits.finished(idx)
+
+        if on_result is not None:
+            delay = on_result(idx, result)
+            if delay is not None:
+                heapq.heappush(delayed, (time.time() + delay, idx))
+
+    while queue or delayed or workers:
+        # items that are due go to the back of the queue
+        while delayed and delayed[0][0] <= time.time():
+            queue.append(heapq.heappop(delayed)[1])
+
+        # spawn workers while there are free slots
+        while can_spawn and len(workers) < control.limit:
+            idx = group_limits.pop(queue)
+            if idx is None:
+                break
+
+            sock = _spawn(rank, func, work, workers)
+            if sock is None:
+                # error message already printed
+                group_limits.finished(idx)
+                queue.appendleft(idx)
+                can_spawn = False
+                break
+
+            rank += 1
+
+            # hand out the first work item
+            workers[sock] = idx
+            started[sock] = time.time()
+            _send(sock, (idx, min(control.limit, len_work)))
+
+        if flush is not None:
+            flush()
+
+        timeout = None
+        if delayed:
+            timeout = max(0, delayed[0][0] - time.time())
+
+        if not workers:
+            if not delayed or not can_spawn:
+                break
+
+            # wait for the next item to become due
+            time.sleep(timeout)
+            continue
+
+        # dispatch remaining work as workers become ready
         try:
-            pid = os.fork()
-        except OSError as err:
-            error('failed to fork(): %s' % err.strerror)
-            return
+            ready, _, _ = select.select(workers.keys(), [], [], timeout)
+        except select.error as err:
+            if err.args[0] == errno.EINTR:
+                continue
+            raise
+
+        for sock in ready:
+            msg = _recv(sock)
+            if msg is None:
+                # worker died before finishing its work item;
+                # a new worker is spawned for the remaining work
+                idx = workers.pop(sock)
+                del started[sock]
+                sock.close()
+                if on_lost is not None:
+                    _result(idx, on_lost(idx))
+                else:
+                    error('worker process died')
+                    group_limits.finished(idx)
+                continue
 
-        if pid == 0:
-            # child process
-            worker(rank, func, work, part)
-            sys.exit(0)
+            idx, result = msg
+            if idx is None:
+                # message sent while working on the item
+                on_message(result)
+                continue
 
-        # parent process
-        ALL_PIDS.add(pid)
+            control.finished(time.time() - started[sock])
+            _result(idx, result)
+
+            idx = None
+            if len(workers) <= control.limit:
+                idx = group_limits.pop(queue)
+
+            if idx is not None:
+                workers[sock] = idx
+                started[sock] = time.time()
+                _send(sock, (idx, min(control.limit, len_work)))
+            else:
+                # no more work (or too many workers running,
+                # or the work left has to wait for its group);
+                # closing the socket tells the worker to exit
+                del workers[sock]
+                sock.close()
+
+    # when no worker could be spawned, the work that is left
+    # is lost; it must not go unreported
+    if queue or delayed:
+        left = list(queue) + [entry[1] for entry in delayed]
+        queue.clear()
+        del delayed[:]
+        for idx in left:
+            if on_lost is not None:
+                _result(idx, on_lost(idx))
+            else:
+                error('no worker process for work item %d' % idx)
+
+        # items that on_result wants to do again can not be done either
+        del delayed[:]
 
     # wait for all workers to exit
     join()
+    return results
+
+
+def _spawn(rank, func, work, workers):
+    '''fork a new worker process
+    Returns the parent's end of the socket to the worker,
+    or None on error
+    '''
+
+    try:
+        parent_sock, child_sock = socket.socketpair()
+    except socket.error as err:
+        error('failed to create socketpair: %s' % err.strerror)
+        return None
+
+    try:
+        pid = os.fork()
+    except OSError as err:
+        error('failed to fork(): %s' % err.strerror)
+        parent_sock.close()
+        child_sock.close()
+        return None
+
+    if pid == 0:
+        # child process
+        # close the parent's end of all sockets
+        parent_sock.close()
+        for sock in workers:
+            sock.close()
+
+        worker(rank, func, work, child_sock)
+        sys.exit(0)
+
+    # parent process
+    ALL_PIDS.add(pid)
+    child_sock.close()
+    return parent_sock
+
+
+class Concurrency(object):
+    '''the number of nodes to work on at the same time
+
+    With 'num_proc auto' the limit is adjusted during the run:
+    every time a "round" of nodes (as many as the limit) has completed,
+    the limit is grown, unless the master is overloaded or growing it
+    did not increase throughput but only made the nodes take longer
+    '''
+
+    # shrink when the 1 minute load average per CPU exceeds this
+    MAX_LOAD = 1.0
+
+    def __init__(self):
+        '''initialize instance'''
+
+        self.auto = (synctool.param.NUM_PROC_AUTO and
+                     synctool.param.SLEEP_TIME == 0)
+        if self.auto:
+            self.limit = synctool.param.NUM_PROC_MIN
+        else:
+            self.limit = synctool.param.NUM_PROC
+
+        self.grew = False
+        # throughput and latency of the previous round
+        self.prev_throughput = None
+        self.prev_latency = None
+        self._start_round()
+
+    def _start_round(self):
+        '''start measuring a new round'''
+
+        self.round_start = time.time()
+        self.round_count = 0
+        self.round_latency = 0.0
+
+    def finished(self, duration):
+        '''a node completed, taking duration seconds'''
+
+        if not self.auto:
+            return
+
+        self.round_count += 1
+        self.round_latency += duration
+        if self.round_count < self.limit:
+            return
+
+        elapsed = max(time.time() - self.round_start, 0.001)
+        throughput = self.round_count / elapsed
+        latency = self.round_latency / self.round_count
+        load = _master_load()
+
+        old_limit = self.limit
+        if load > self.MAX_LOAD:
+            self.limit = max(synctool.param.NUM_PROC_MIN, old_limit * 3 / 4)
+            reason = 'master is overloaded'
+
+        elif (self.grew and throughput < self.prev_throughput * 1.05 and
+              latency > self.prev_latency * 1.25):
+            # more nodes in flight only made each node slower
+            self.limit = max(synctool.param.NUM_PROC_MIN,
+                             old_limit - max(1, old_limit / 5))
+            reason = 'latency went up, throughput did not'
+
+        else:
+            self.limit = min(synctool.param.NUM_PROC_MAX,
+                             old_limit + max(1, old_limit / 4))
+            reason = 'room to grow'
+
+        if self.limit == old_limit:
+            reason += ', but at its bound'
+
+        verbose('num_proc auto: %d -> %d, %s (load %.2f per cpu, '
+                'latency %.2fs, throughput %.2f nodes/s)' %
+                (old_limit, self.limit, reason, load, latency, throughput))
+
+        self.grew = self.limit > old_limit
+        self.prev_throughput = throughput
+        self.prev_latency = latency
+        self._start_round()
+
+
+class GroupLimits(object):
+    '''the 'max_parallel' limits
+    Limits the number of work items that are in progress at the same time
+    per group. The work items are addresses of nodes
+    '''
+
+    def __init__(self, work):
+        '''initialize instance'''
+
+        # groups[idx] = list of limited groups of work item idx
+        self.groups = []
+        # busy[group] = number of items of group in progress
+        self.busy = {}
+
+        if not work or not synctool.param.MAX_PARALLEL:
+            return
+
+        names = config.get_nodes_by_address()
+        for addr in work:
+            nodename = names.get(addr, addr)
+            self.groups.append([group for group in config.get_groups(nodename)
+                                if group in synctool.param.MAX_PARALLEL])
+
+    def pop(self, queue):
+        '''take the first work item from queue that may start,
+        and count it as in progress
+        Returns index of the work item, or None if none may start
+        '''
+
+        if not self.groups:
+            if queue:
+                return queue.popleft()
+            return None
+
+        for pos, idx in enumerate(queue):
+            for group in self.groups[idx]:
+                if (self.busy.get(group, 0) >=
+                        synctool.param.MAX_PARALLEL[group]):
+                    break
+            else:
+                del queue[pos]
+                for group in self.groups[idx]:
+                    self.busy[group] = self.busy.get(group, 0) + 1
+                return idx
+
+        return None
+
+    def finished(self, idx):
+        '''work item idx is no longer in progress'''
+
+        if not self.groups:
+            return
+
+        for group in self.groups[idx]:
+            self.busy[group] -= 1
+
+
+def _master_load():
+    '''Returns 1 minute load average per CPU of the master node'''
+
+    try:
+        load = os.getloadavg()[0]
+    except OSError:
+        return 0.0
+
+    try:
+        ncpu = os.sysconf('SC_NPROCESSORS_ONLN')
+    except (ValueError, OSError):
+        ncpu = 1
+
+    return load / max(ncpu, 1)
 
 
 @catch_signals
-def worker(rank, func, work, part):
-    '''run func to do part of work for parallel rank'''
+def worker(rank, func, work, sock):
+    '''run func for work items handed out by the parent'''
 
-    # determine which chunk of work to do
-    lower = part * rank
-    upper = part * (rank + 1)
-    len_work = len(work)
-    if upper > len_work:
-        upper = len_work
+    global WORKER_SOCK, SLOTS
+
+    WORKER_SOCK = sock
+
+    while True:
+        msg = _recv(sock)
+        if msg is None:
+            # parent has no more work for us
+            break
+
+        idx, SLOTS = msg
+
+        result = func(work[idx])
 
-    # run all work items in sequence
-    for item in work[lower:upper]:
-        func(item)
         # this is for option --zzz
         if synctool.param.SLEEP_TIME > 0:
             time.sleep(synctool.param.SLEEP_TIME)
 
+        _send(sock, (idx, result))
+
+    sock.close()
+
+
+def message(obj):
+    '''send message from worker to parent'''
+
+    # the index None marks it as message rather than result
+    _send(WORKER_SOCK, (None, obj))
+
+
+def _send(sock, obj):
+    '''send a length-prefixed pickled message'''
+
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def _recv(sock):
+    '''receive a length-prefixed pickled message
+    Returns None on EOF
+    '''
+
+    header = _recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+
+    (length,) = HEADER.unpack(header)
+    data = _recv_exactly(sock, length)
+    if data is None:
+        return None
+
+    return pickle.loads(data)
+
+
+def _recv_exactly(sock, length):
+    '''read exactly length bytes from socket
+    Returns None on EOF
+    '''
+
+    buf = ''
+    while len(buf) < length:
+        try:
+            data = sock.recv(length - len(buf))
+        except socket.error as err:
+            if err.errno == errno.EINTR:
+                continue
+
+            if err.errno == errno.ECONNRESET:
+                return None
+
+            raise
+
+        if not data:
+            return None
+
+        buf += data
+
+    return buf
+
 
 def join():
     '''wait for parallel threads to exit'''
@@ -110,10 +521,11 @@ if __name__ == '__main__':
             '''print item'''
 
             print '[%u]: hello' % os.getpid(), item
-            time.sleep(0.1245)
+            time.sleep(0.1245 * (item % 3))
+            return item * 2
 
         synctool.param.NUM_PROC = 3
-        do(hello, range(10))
+        print do(hello, range(10))
 
 #    synctool.param.SLEEP_TIME = 2
     main()
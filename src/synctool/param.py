@@ -39,6 +39,8 @@ DELETE_DIR = None
 DELETE_LEN = 0
 PURGE_DIR = None
 PURGE_LEN = 0
+# state kept by the master node itself; it is not synced to nodes
+STATE_DIR = None
 SCRIPT_DIR = None
 TEMP_DIR = '/tmp/synctool'
 HOSTNAME = None
@@ -56,7 +58,70 @@ PACKAGE_MANAGER = None
 NUM_PROC = 16       # use sensible default
 SLEEP_TIME = 0
 
+# 'num_proc auto' adapts the number of concurrent nodes during the run
+# NUM_PROC is then set to NUM_PROC_MAX
+NUM_PROC_AUTO = False
+NUM_PROC_MIN = 4
+NUM_PROC_MAX = 128
+
+# how to run commands on many nodes: 'fork' a worker process per
+# concurrent node, or 'poll' the output of all commands from one process
+FANOUT_ENGINE = 'fork'
+
+# per node deadlines in seconds for the rsync and the remote command;
+# 0 means no deadline
+RSYNC_TIMEOUT = 0
+EXEC_TIMEOUT = 0
+
+# 'straggler_skip': when only the last STRAGGLER_SKIP percent of nodes
+# are still running, skip those that take longer than STRAGGLER_FACTOR
+# times as long as it took the others to complete
+STRAGGLER_SKIP = 0
+STRAGGLER_FACTOR = 2.0
+
+# 'pipeline': tuple (max transfers, max other commands) running at once,
+# rather than NUM_PROC nodes at once; None means no pipeline
+PIPELINE = None
+
+# 'health_cache': nodes that could not be reached are skipped ('skip')
+# or started last ('last') for HEALTH_TTL seconds; 0 means never
+HEALTH_TTL = 0
+HEALTH_ACTION = 'skip'
+
+# 'max_bandwidth': budget for all rsync transfers together,
+# in kilobytes per second; None means no limit
+MAX_BANDWIDTH = None
+
+# 'max_parallel': MAX_PARALLEL[group] = max number of nodes in group
+# to work on at once
+MAX_PARALLEL = {}
+
+# 'retry': run the job for a node that failed with one of RETRY_EXITCODES
+# again, up to RETRY_ATTEMPTS times in total; the delay in seconds before
+# the next attempt starts at RETRY_DELAY and doubles every attempt
+RETRY_ATTEMPTS = 1
+RETRY_DELAY = 5
+RETRY_EXITCODES = [255,]
+
 CONTROL_PERSIST = '1h'
+# start ssh master connections on demand
+SSH_MULTIPLEX = False
+
+# start the nodes that took longest in previous runs first
+LONGEST_FIRST = False
+
+# keep the history of runs in a database on the master node
+RUN_HISTORY = False
+
+# skip the rsync when the node has the same generation of the repository
+GENERATION_STAMP = False
+
+# rsync the changes to a mirror on the master node once with --write-batch,
+# and apply them to the nodes with --read-batch
+RSYNC_BATCH = False
+
+# dsh passes scripts along over ssh rather than syncing them with rsync
+SHIP_SCRIPTS = False
 REQUIRE_EXTENSION = True
 BACKUP_COPIES = True
 SYSLOGGING = True
@@ -80,6 +145,11 @@ MASTER = None
 # set of slaves by nodename
 SLAVES = set()
 
+# list of relays: (slave nodename, [ list of groups ])
+# the master syncs only to the slave, which in turn runs synctool
+# for the nodes in those groups
+RELAYS = []
+
 # NODES is a dict of nodes
 # each node is a list of groups, ordered by importance;
 # first listed group is most important, last group is least important
@@ -143,6 +213,9 @@ KNOWN_PACKAGE_MANAGERS = ('apt-get', 'yum', 'zypper', 'brew', 'pacman',
                           # 'urpmi', 'portage', 'port', 'swaret',
                           'bsdpkg')
 
+# list of supported fan-out engines
+KNOWN_FANOUT_ENGINES = ('fork', 'poll')
+
 ORIG_UMASK = 022
 
 
@@ -151,7 +224,7 @@ def init():
 
     global ROOTDIR, CONF_FILE
     global VAR_DIR, VAR_LEN, OVERLAY_DIR, OVERLAY_LEN, DELETE_DIR, DELETE_LEN
-    global PURGE_DIR, PURGE_LEN, SCRIPT_DIR, ORIG_UMASK
+    global PURGE_DIR, PURGE_LEN, STATE_DIR, SCRIPT_DIR, ORIG_UMASK
 
     base = os.path.abspath(os.path.dirname(sys.argv[0]))
     if not base:
@@ -169,6 +242,7 @@ def init():
     DELETE_LEN = len(DELETE_DIR) + 1
     PURGE_DIR = os.path.join(VAR_DIR, 'purge')
     PURGE_LEN = len(PURGE_DIR) + 1
+    STATE_DIR = os.path.join(VAR_DIR, 'state')
     SCRIPT_DIR = os.path.join(ROOTDIR, 'scripts')
 
     # the following only makes sense for synctool-client, but OK
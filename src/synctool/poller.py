@@ -0,0 +1,97 @@
+#
+#   synctool.poller.py    WJ126
+#
+#   synctool Copyright 2015 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''wait for events on a set of file descriptors
+
+This is used by the event loops of the fanout and the TCP probe
+'''
+
+import errno
+import math
+import time
+import select
+
+
+class Poller(object):
+    '''wait for events on a set of file descriptors
+    Uses poll() when available, or else select()
+    '''
+
+    READ = 'r'
+    WRITE = 'w'
+
+    # poll() events for READ and WRITE
+    EVENTS = {READ: (getattr(select, 'POLLIN', 0) |
+                     getattr(select, 'POLLPRI', 0)),
+              WRITE: getattr(select, 'POLLOUT', 0)}
+
+    def __init__(self):
+        '''initialize instance'''
+
+        # fds[fd] = READ or WRITE
+        self.fds = {}
+        if hasattr(select, 'poll'):
+            self.poller = select.poll()
+        else:
+            self.poller = None
+
+    def register(self, fd, what=READ):
+        '''watch fd for input (READ) or being writable (WRITE)'''
+
+        self.fds[fd] = what
+        if self.poller is not None:
+            self.poller.register(fd, self.EVENTS[what])
+
+    def modify(self, fd, what):
+        '''watch fd for READ or WRITE instead'''
+
+        self.fds[fd] = what
+        if self.poller is not None:
+            self.poller.modify(fd, self.EVENTS[what])
+
+    def unregister(self, fd):
+        '''stop watching fd'''
+
+        if self.fds.pop(fd, None) is not None and self.poller is not None:
+            self.poller.unregister(fd)
+
+    def poll(self, timeout=None):
+        '''Returns list of fds that are ready (or in error, or hung up)
+        timeout is in seconds; None means wait forever
+        '''
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        while True:
+            msecs = None
+            if deadline is not None:
+                # after being interrupted, wait only for the time left
+                timeout = max(0, deadline - time.time())
+                # round up, or else poll() returns too soon
+                msecs = int(math.ceil(timeout * 1000))
+
+            try:
+                if self.poller is not None:
+                    return [fd for fd, _ in self.poller.poll(msecs)]
+
+                rlist = [fd for fd, what in self.fds.items()
+                         if what == self.READ]
+                wlist = [fd for fd, what in self.fds.items()
+                         if what == self.WRITE]
+                rready, wready, _ = select.select(rlist, wlist, [], timeout)
+                return rready + wready
+
+            except select.error as err:
+                if err.args[0] != errno.EINTR:
+                    raise
+
+# EOB
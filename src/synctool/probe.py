@@ -0,0 +1,207 @@
+#
+#   synctool.probe.py    WJ118
+#
+#   synctool Copyright 2015 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''probe whether nodes accept connections on their ssh port
+
+All nodes are probed at once from a single event loop, by making
+non-blocking TCP connections. Optionally, the probe waits for the
+banner that the ssh daemon sends upon connecting
+'''
+
+import os
+import errno
+import time
+import socket
+import resource
+import collections
+
+import synctool.poller
+
+# default TCP port to probe
+PORT = 22
+# default time to wait for a connection (and banner), in seconds
+TIMEOUT = 5.0
+
+
+class Result(object):
+    '''the outcome of probing a node'''
+
+    def __init__(self):
+        '''initialize instance'''
+
+        self.up = False
+        # connect time, in seconds
+        self.latency = None
+        # first line sent by the server (if asked for)
+        self.banner = None
+        # reason why the node is down
+        self.error = None
+
+
+class _Probe(object):
+    '''a connection attempt in progress'''
+
+    def __init__(self, idx, sock, timeout):
+        '''initialize instance'''
+
+        self.idx = idx
+        self.sock = sock
+        self.start = time.time()
+        self.deadline = self.start + timeout
+        self.buf = ''
+        self.result = Result()
+
+
+def probe(address_list, port=PORT, timeout=TIMEOUT, banner=False):
+    '''probe all addresses
+    Returns list of Result instances in the same order as address_list
+    '''
+
+    results = [None] * len(address_list)
+
+    pending = collections.deque(xrange(len(address_list)))
+    # probes[fd] = _Probe instance
+    probes = {}
+    poller = synctool.poller.Poller()
+    limit = _max_sockets()
+    if poller.poller is None:
+        # select() can not handle more
+        limit = min(limit, 1000)
+
+    def _done(fd):
+        '''probe of fd has finished'''
+
+        task = probes.pop(fd)
+        poller.unregister(fd)
+        task.sock.close()
+        results[task.idx] = task.result
+
+    while pending or probes:
+        # start new connections while there are file descriptors left
+        while pending and len(probes) < limit:
+            idx = pending.popleft()
+            task = _connect(idx, address_list[idx], port, timeout)
+            if isinstance(task, Result):
+                # failed right away
+                results[idx] = task
+                continue
+
+            fd = task.sock.fileno()
+            probes[fd] = task
+            poller.register(fd, synctool.poller.Poller.WRITE)
+
+        if not probes:
+            continue
+
+        wait = max(0, min([x.deadline for x in probes.values()]) -
+                   time.time())
+
+        for fd in poller.poll(wait):
+            task = probes[fd]
+            result = task.result
+
+            if result.latency is None:
+                # connect() completed, or failed
+                err = task.sock.getsockopt(socket.SOL_SOCKET,
+                                           socket.SO_ERROR)
+                if err:
+                    result.error = os.strerror(err)
+                    _done(fd)
+                    continue
+
+                result.up = True
+                result.latency = time.time() - task.start
+                if not banner:
+                    _done(fd)
+                    continue
+
+                # now wait for the banner
+                task.deadline = time.time() + timeout
+                poller.modify(fd, synctool.poller.Poller.READ)
+                continue
+
+            try:
+                data = task.sock.recv(256)
+            except socket.error as err:
+                if err.errno in (errno.EINTR, errno.EAGAIN):
+                    continue
+
+                data = ''
+
+            task.buf += data
+            if data and '\n' not in task.buf and len(task.buf) < 256:
+                # wait for the rest of the line
+                continue
+
+            result.banner = task.buf.split('\n', 1)[0].strip()
+            _done(fd)
+
+        # expire connections that took too long
+        now = time.time()
+        for fd, task in probes.items():
+            if now >= task.deadline:
+                if task.result.latency is None:
+                    task.result.error = 'timed out'
+                else:
+                    # it is up, but sent no banner
+                    task.result.banner = ''
+                _done(fd)
+
+    return results
+
+
+def _connect(idx, addr, port, timeout):
+    '''start connecting to addr
+    Returns _Probe instance, or Result when it failed right away
+    '''
+
+    try:
+        family, socktype, proto, _, sockaddr = \
+            socket.getaddrinfo(addr, port, socket.AF_UNSPEC,
+                               socket.SOCK_STREAM)[0]
+    except socket.gaierror as err:
+        result = Result()
+        result.error = err.strerror
+        return result
+
+    try:
+        sock = socket.socket(family, socktype, proto)
+    except socket.error as err:
+        result = Result()
+        result.error = err.strerror
+        return result
+
+    sock.setblocking(0)
+    task = _Probe(idx, sock, timeout)
+
+    err = sock.connect_ex(sockaddr)
+    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EINTR):
+        sock.close()
+        task.result.error = os.strerror(err)
+        return task.result
+
+    return task
+
+
+def _max_sockets():
+    '''Returns the number of sockets that may be open at once'''
+
+    try:
+        soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    except (ValueError, resource.error):
+        soft = 1024
+
+    if soft == resource.RLIM_INFINITY:
+        soft = 65536
+
+    # leave some file descriptors for other uses
+    return max(1, soft - 32)
+
+# EOB
@@ -0,0 +1,195 @@
+#
+#   synctool.report.py    WJ117
+#
+#   synctool Copyright 2015 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''write a machine-readable report of a run, in JSON format
+
+The report holds, per node, the exit code, the time taken by every
+phase (rsync, running synctool, ...) and how many times every kind
+of change (like 'sync', 'new', 'fail') was made
+
+The counts of changes are printed by synctool-client as a single line
+with a magic prefix at the end of its run. A relay passes the results
+of its nodes on to the master node in the same way
+'''
+
+import sys
+import json
+import time
+
+from synctool import param
+import synctool.lib
+from synctool.lib import error
+import synctool.output
+
+# lines with this prefix carry report data rather than output
+PREFIX = '%synctool-report% '
+PREFIX_LEN = len(PREFIX)
+
+# the Report of this run; set by command-line option --report
+REPORT = None
+
+# when True, pass report data on to the master node (see option --stats)
+FORWARD = False
+
+
+class Report(object):
+    '''class holding the results of a run'''
+
+    def __init__(self, progname, filename):
+        '''initialize instance'''
+
+        self.progname = progname
+        self.filename = filename
+        self.start = time.time()
+        # extra information to include, like {'dry_run': True}
+        self.info = {}
+        # nodes[nodename] = dict with results of node
+        self.nodes = {}
+
+    def _node(self, nodename):
+        '''Returns dict with results of nodename'''
+
+        if nodename not in self.nodes:
+            self.nodes[nodename] = {'exitcode': None,
+                                    'status': None,
+                                    'phases': {},
+                                    'events': {}}
+        return self.nodes[nodename]
+
+    def done(self, nodename, exitcode, status, timings):
+        '''nodename has finished'''
+
+        node = self._node(nodename)
+
+        # a relay may report on itself twice: as relay,
+        # and for running synctool on itself
+        if node['exitcode'] in (None, 0):
+            node['exitcode'] = exitcode
+        if node['status'] is None:
+            node['status'] = status
+
+        phases = node['phases']
+        for phase, secs in timings:
+            phases[phase] = round(phases.get(phase, 0.0) + secs, 3)
+
+    def events(self, nodename, counts):
+        '''add counts of events (by name) of nodename'''
+
+        events = self._node(nodename)['events']
+        for name, count in counts.items():
+            events[name] = events.get(name, 0) + count
+
+    def write(self):
+        '''write the report to file'''
+
+        end = time.time()
+
+        # totals per phase
+        phases = {}
+        for node in self.nodes.values():
+            for phase, secs in node['phases'].items():
+                phases[phase] = round(phases.get(phase, 0.0) + secs, 3)
+
+        failed = sorted([nodename for nodename, node in self.nodes.items()
+                         if node['exitcode'] not in (0, None)])
+
+        data = {'program': self.progname,
+                'version': param.VERSION,
+                'master': param.HOSTNAME,
+                'start': _timestamp(self.start),
+                'end': _timestamp(end),
+                'duration': round(end - self.start, 3),
+                'phases': phases,
+                'failed': failed,
+                'nodes': self.nodes}
+        data.update(self.info)
+
+        if self.filename == '-':
+            json.dump(data, sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write('\n')
+            return
+
+        try:
+            with open(self.filename, 'w') as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+                f.write('\n')
+        except IOError as err:
+            error('failed to write report %s: %s' % (self.filename,
+                                                     err.strerror))
+
+
+def _timestamp(t):
+    '''Returns time t in ISO 8601 format, in UTC'''
+
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t))
+
+
+def record(rec):
+    '''handle output record (see module output)
+    for either the report, or to pass on to the master node
+    '''
+
+    kind = rec[0]
+    if kind == synctool.output.DONE:
+        nodename, exitcode, status, timings = rec[1:]
+        data = {'exitcode': exitcode, 'status': status,
+                'timings': timings}
+    elif kind == synctool.output.REPORT:
+        nodename = rec[1]
+        data = {'events': rec[2]}
+    else:
+        return
+
+    if REPORT is not None:
+        if 'events' in data:
+            REPORT.events(nodename, data['events'])
+        else:
+            REPORT.done(nodename, exitcode, status, timings)
+
+    if FORWARD:
+        # running on a relay; pass it on to the master node
+        print '%s%s: %s' % (PREFIX, nodename, json.dumps(data))
+
+
+def parse(nodename, text):
+    '''parse report data (without prefix) sent by nodename
+    Returns list of output records
+    '''
+
+    try:
+        data = json.loads(text)
+    except ValueError:
+        error('%s: invalid report data' % nodename)
+        return []
+
+    recs = []
+    if 'events' in data:
+        recs.append((synctool.output.REPORT, nodename, data['events']))
+
+    if 'exitcode' in data:
+        timings = [(phase, secs) for phase, secs in data['timings']]
+        recs.append((synctool.output.DONE, nodename, data['exitcode'],
+                     data['status'], timings))
+    return recs
+
+
+def print_events():
+    '''print counts of events of this run, as report data line
+    This is done by synctool-client at the end of the run
+    '''
+
+    counts = {}
+    for code, count in enumerate(synctool.lib.TERSE_COUNT):
+        if count:
+            counts[synctool.lib.TERSE_TXT[code].lower()] = count
+
+    print '%s%s' % (PREFIX, json.dumps({'events': counts}))
+
+# EOB
@@ -0,0 +1,86 @@
+#
+#   synctool.state.py    WJ122
+#
+#   synctool Copyright 2015 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''state files that the master node keeps between runs
+
+The files are in param.STATE_DIR, which is not synced to the nodes.
+They hold a dict in JSON format, keyed by nodename
+'''
+
+import os
+import json
+import errno
+import tempfile
+
+from synctool import param
+from synctool.lib import verbose, error
+
+
+def load(name):
+    '''load state file
+    Returns dict, which is empty if there is no (valid) state file
+    '''
+
+    filename = os.path.join(param.STATE_DIR, name)
+    try:
+        with open(filename) as f:
+            data = json.load(f)
+    except IOError as err:
+        if err.errno != errno.ENOENT:
+            error('failed to read %s: %s' % (filename, err.strerror))
+        return {}
+    except ValueError:
+        verbose('ignoring invalid state file %s' % filename)
+        return {}
+
+    if not isinstance(data, dict):
+        verbose('ignoring invalid state file %s' % filename)
+        return {}
+
+    return data
+
+
+def save(name, data):
+    '''write dict data to state file'''
+
+    try:
+        os.makedirs(param.STATE_DIR)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            error('failed to create directory %s: %s' % (param.STATE_DIR,
+                                                         err.strerror))
+            return
+
+    filename = os.path.join(param.STATE_DIR, name)
+
+    # write a new file and move it into place,
+    # so a concurrent run never reads a partial file
+    try:
+        fd, tmp_filename = tempfile.mkstemp(prefix='.%s-' % name,
+                                            dir=param.STATE_DIR)
+    except OSError as err:
+        error('failed to create temp file: %s' % err.strerror)
+        return
+
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+            f.write('\n')
+
+        os.rename(tmp_filename, filename)
+    except (IOError, OSError) as err:
+        error('failed to write %s: %s' % (filename, err.strerror))
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            # silently ignore unlink error
+            pass
+
+# EOB
@@ -403,6 +403,9 @@ def rsync_upload(up):
 
     # make command: rsync [-n] [-v] node:/path/ $overlay/group/path/
     cmd_arr = shlex.split(synctool.param.RSYNC_CMD)
+    if synctool.param.MAX_BANDWIDTH is not None:
+        # a single transfer may use all of the bandwidth
+        cmd_arr.append('--bwlimit=%d' % synctool.param.MAX_BANDWIDTH)
 
     # opts is just for the 'visual aspect'; it is displayed when --verbose
     opts = ' '